@@ -0,0 +1,45 @@
+"""Compares reading through the memory-mapped block source with the unbuffered file source.
+
+For both sources the time to open the file, to the first record and to the end of a full scan of the records
+are measured from the start of the open."""
+
+import time
+
+from fp5dump.fp5file.fp5file import FP5File
+
+from .common import evict_page_cache, parse_args
+
+
+def measure(filename, use_mmap, cold):
+    if cold:
+        evict_page_cache(filename)
+
+    start = time.perf_counter()
+
+    with FP5File(filename, use_mmap=use_mmap, use_block_cache=False) as fp5file:
+        opened = time.perf_counter()
+
+        records = fp5file.data.sub_nodes(b'\x05')
+        next(records)
+        first_record = time.perf_counter()
+
+        record_count = 1 + sum(1 for _ in records)
+        full_scan = time.perf_counter()
+
+    return (opened - start, first_record - start, full_scan - start, record_count)
+
+
+def main():
+    args = parse_args("time to first record and full scan time with and without mmap")
+
+    for (name, use_mmap) in (('mmap', True), ('unbuffered', False)):
+        results = [measure(args.filename, use_mmap, args.cold) for _ in range(args.repeat)]
+
+        (opened, first_record, full_scan) = (min(result[column] for result in results) for column in range(3))
+
+        print("%-10s open %.3fs  first record %.3fs  full scan %.3fs  (%d records)" %
+              (name, opened, first_record, full_scan, results[0][3]))
+
+
+if __name__ == '__main__':
+    main()
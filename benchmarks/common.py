@@ -0,0 +1,39 @@
+"""Helpers of the benchmarks. They are run from the root of the repository, e.g.
+
+    python -m benchmarks.block_source [--repeat N] [--cold] [fp5 file]
+
+Every benchmark reads tests/data/sample.fp5 unless another file is given. The sample holds only 300 records, so
+its timings are dominated by fixed costs, larger files give more telling numbers."""
+
+import argparse
+import logging
+import os
+
+SAMPLE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'data', 'sample.fp5')
+
+
+def parse_args(description, cold=True):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('filename', nargs='?', default=SAMPLE_FILE,
+                        help='the fp5 file to read, tests/data/sample.fp5 by default')
+    parser.add_argument('--repeat', default=5, type=int, metavar='N',
+                        help='runs every measurement N times and reports the fastest run')
+
+    if cold:
+        parser.add_argument('--cold', action='store_true',
+                            help='evicts the file from the page cache before every run')
+
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+
+    return args
+
+
+def evict_page_cache(filename):
+    """Drops the pages of `filename` from the page cache, where the platform supports it."""
+
+    if hasattr(os, 'posix_fadvise'):
+        with open(filename, 'rb') as file:
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
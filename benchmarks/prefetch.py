@@ -0,0 +1,45 @@
+"""Scans the records with the blocks read ahead on a background thread at several depths.
+
+Prefetching pays off on cold, fragmented files on slow disks, on a file in the page cache the hand-off between
+the threads costs more than it saves. Depth 0 reads the blocks on the parsing thread."""
+
+import time
+
+from fp5dump.fp5file.fp5file import FP5File
+
+from .common import evict_page_cache, parse_args
+
+DEPTHS = (0, 2, 8, 32)
+
+
+def measure(filename, depth, cold):
+    if cold:
+        evict_page_cache(filename)
+
+    with FP5File(filename, use_mmap=False, prefetch_depth=depth, use_block_cache=False) as fp5file:
+        # the counters include the blocks read while opening the file
+        counters = (fp5file.prefetched_blocks, fp5file.prefetch_waits, fp5file.prefetch_wait_time)
+
+        start = time.perf_counter()
+
+        record_count = sum(1 for _ in fp5file.data.sub_nodes(b'\x05'))
+
+        elapsed = time.perf_counter() - start
+
+        return (elapsed, fp5file.prefetched_blocks - counters[0], fp5file.prefetch_waits - counters[1],
+                fp5file.prefetch_wait_time - counters[2], record_count)
+
+
+def main():
+    args = parse_args("full scan time with the blocks read ahead at several depths, from the unbuffered file source")
+
+    for depth in DEPTHS:
+        (elapsed, blocks, waits, wait_time, record_count) = min(measure(args.filename, depth, args.cold)
+                                                                for _ in range(args.repeat))
+
+        print("depth %-3d full scan %.3fs  waited for %d of %d blocks (%.3fs)  (%d records)" %
+              (depth, elapsed, waits, blocks, wait_time, record_count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Compares following the data chain with reading the data blocks in one sweep through the file (the physical
+scan order), for the memory-mapped and the unbuffered file source.
+
+The physical order avoids random reads on fragmented files, use --cold to see the difference."""
+
+import time
+
+from fp5dump.fp5file.fp5file import FP5File
+
+from .common import evict_page_cache, parse_args
+
+
+def measure(filename, scan_order, use_mmap, cold):
+    if cold:
+        evict_page_cache(filename)
+
+    with FP5File(filename, use_mmap=use_mmap, use_block_cache=False) as fp5file:
+        if cold:
+            # opening the file reads some of the blocks again
+            evict_page_cache(filename)
+
+        start = time.perf_counter()
+
+        record_count = sum(1 for _ in fp5file.data.sub_nodes(b'\x05', scan_order=scan_order))
+
+        return (time.perf_counter() - start, record_count)
+
+
+def main():
+    args = parse_args("full scan time in chain and in physical order")
+
+    for (source, use_mmap) in (('mmap', True), ('unbuffered', False)):
+        for scan_order in ('chain', 'physical'):
+            (elapsed, record_count) = min(measure(args.filename, scan_order, use_mmap, args.cold)
+                                          for _ in range(args.repeat))
+
+            print("%-10s %-8s full scan %.3fs  (%d records)" % (source, scan_order, elapsed, record_count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Compares handing records from a worker process to the writing process through a SharedRecordRing with a
+pickled multiprocessing.Queue, as the record exports with --jobs do.
+
+The records are the COPY rows PostgresExporter encodes, the queue is also measured with the record dicts
+a worker would send without encoding them itself. Only the hand-off is timed, the records are prepared first."""
+
+import multiprocessing
+import os
+import sys
+import time
+from collections import OrderedDict
+
+from fp5dump.fp5file.fp5file import FP5File
+from fp5dump.fp5file.postgresexporter import PostgresExporter
+from fp5dump.fp5file.sharedring import BATCH_END, SharedRecordRing, shared_memory
+
+from .common import parse_args
+
+
+def put_into_ring(ring, records):
+    for record in records:
+        ring.put(record)
+
+    ring.send(BATCH_END)
+
+
+def put_into_queue(record_queue, records):
+    for record in records:
+        record_queue.put(record)
+
+    record_queue.put(None)
+
+
+def hand_off_through_ring(records):
+    ring = SharedRecordRing()
+
+    try:
+        producer = multiprocessing.Process(target=put_into_ring, args=(ring, records))
+
+        start = time.perf_counter()
+        producer.start()
+
+        for record in ring.receive(producer):
+            pass
+
+        elapsed = time.perf_counter() - start
+
+        producer.join()
+    finally:
+        ring.unlink()
+
+    return elapsed
+
+
+def hand_off_through_queue(records):
+    record_queue = multiprocessing.Queue(1000)
+    producer = multiprocessing.Process(target=put_into_queue, args=(record_queue, records))
+
+    start = time.perf_counter()
+    producer.start()
+
+    while record_queue.get() is not None:
+        pass
+
+    elapsed = time.perf_counter() - start
+
+    producer.join()
+
+    return elapsed
+
+
+def main():
+    args = parse_args("records per second handed from a worker process to the writer", cold=False)
+
+    if shared_memory is None:
+        sys.exit("multiprocessing.shared_memory is not available")
+
+    # generate_export_definition resets the locale to the default of the environment, which therefore has to exist
+    os.environ['LC_ALL'] = 'C'
+
+    with FP5File(args.filename, use_block_cache=False) as fp5file:
+        # sub_nodes reuses the dict of a record, so it is copied
+        record_dicts = [(record_id_bin, OrderedDict(record)) for (record_id_bin, record) in fp5file.data.sub_nodes(b'\x05')]
+
+        export_definition = fp5file.generate_export_definition(use_locale='C')
+
+        if export_definition is None:
+            sys.exit("could not generate an export definition")
+
+        exporter = PostgresExporter(fp5file, export_definition, 'public', '')
+        exporter.set_locale()
+
+        rows = list(exporter.encode_records(iter(record_dicts)))
+
+    row_bytes = sum(len(row) for row in rows)
+
+    print("%d records, %d bytes per COPY row" % (len(rows), row_bytes // len(rows)))
+
+    for (name, hand_off, records) in (('queue of record dicts', hand_off_through_queue, record_dicts),
+                                      ('queue of COPY rows', hand_off_through_queue, rows),
+                                      ('ring of COPY rows', hand_off_through_ring, rows)):
+        elapsed = min(hand_off(records) for _ in range(args.repeat))
+
+        print("%-22s %9.0f records/s  %6.1f MB/s" % (name, len(rows) / elapsed, row_bytes / 1e6 / elapsed))
+
+
+if __name__ == '__main__':
+    main()
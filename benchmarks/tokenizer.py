@@ -0,0 +1,55 @@
+"""Measures the throughput of the tokenizer on the data chain, which is loaded into memory first so no reads
+are timed.
+
+- records: builds every record, BlockChain.sub_nodes(05)
+- fields: the same, keeping a single field of every record
+- tokens: only splits the blocks into tokens, BlockChain.tokens"""
+
+import time
+
+from fp5dump.fp5file.blocksource import BytesBlockSource
+from fp5dump.fp5file.fp5file import FP5File
+
+from .common import parse_args
+
+SCANS = (
+    ('records', lambda data: data.sub_nodes(b'\x05')),
+    ('fields', lambda data: data.sub_nodes(b'\x05', token_ids_to_return={b'\x02'})),
+    ('tokens', lambda data: data.tokens()),
+)
+
+
+def main():
+    args = parse_args("tokenizer throughput on the data chain held in memory", cold=False)
+
+    with open(args.filename, 'rb') as file:
+        source = BytesBlockSource(file.read(), args.filename)
+
+    with FP5File(args.filename, source=source, use_block_cache=False) as fp5file:
+        data = fp5file.data
+
+        data_bytes = sum(fp5file.directory.length[fp5file.block_id_to_block_pos[block_id] >> 10]
+                         for block_id in data.order)
+        token_count = sum(1 for _ in data.tokens())
+
+        print("%d data blocks, %.1f MB, %d tokens" % (data.length, data_bytes / 1e6, token_count))
+
+        for (name, scan) in SCANS:
+            timings = []
+
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+
+                for _ in scan(data):
+                    pass
+
+                timings.append(time.perf_counter() - start)
+
+            elapsed = min(timings)
+
+            print("%-8s %.3fs  %.1f MB/s  %.2fM tokens/s" % (name, elapsed, data_bytes / 1e6 / elapsed,
+                                                           token_count / 1e6 / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,13 +11,35 @@ import sys
 try:
     from fp5file.fp5file import FP5File, FieldExportDefinition
     from fp5file.blockchain import encode_vli, decode_vli
+    from fp5file.blocksource import IO_POLICIES
 except ImportError:
     from .fp5file.fp5file import FP5File, FieldExportDefinition
     from .fp5file.blockchain import encode_vli, decode_vli
+    from .fp5file.blocksource import IO_POLICIES
+
+
+def __record_id__(value):
+    try:
+        record_id = int(value)
+    except ValueError:
+        record_id = None
+
+    if record_id is None or encode_vli(record_id) is None:
+        raise argparse.ArgumentTypeError("'%s' is not a valid record id" % value)
+
+    return record_id
+
+
+def __open_fp5file__(args, encoding=None):
+    filename = '-' if args.input is sys.stdin else args.input.name
+
+    return FP5File(filename, encoding=encoding, use_mmap=not args.no_mmap, member=args.member,
+                   cache_dir=args.cache_dir, cache_size_limit=args.cache_size_limit * 1024 * 1024,
+                   prefetch_depth=args.prefetch, io_policy=args.io_policy, use_block_cache=not args.no_block_cache)
 
 
 def __list_fields__(args):
-    with FP5File(args.input.name, encoding=args.encoding) as fp5file:
+    with __open_fp5file__(args, encoding=args.encoding) as fp5file:
         print("ID TYPE[REPETITIONS] IS_STORED NAME")
 
         for field_id in sorted(fp5file.fields.keys()):
@@ -35,7 +57,7 @@ def __list_fields__(args):
 
 
 def __count_records__(args):
-    with FP5File(args.input.name) as fp5file:
+    with __open_fp5file__(args) as fp5file:
         print(fp5file.records_count)
 
     return True
@@ -43,26 +65,31 @@ def __count_records__(args):
 
 def __dump_blocks__(args):
     if 'index' in args.type:
-        with FP5File(args.input.name) as fp5file:
+        with __open_fp5file__(args) as fp5file:
             return fp5file.dump_index_blocks(args.output)
     elif 'data' in args.type:
         if args.with_path:
             match = re.match("^'?((([0-9a-fA-F]{2})+/)?([0-9a-fA-F]{2})+)'?$", args.with_path)
 
             if match:
-                with FP5File(args.input.name) as fp5file:
+                with __open_fp5file__(args) as fp5file:
                     return fp5file.dump_blocks_with_path([binascii.unhexlify(x) for x in match.group(1).split('/')], args.output)
             else:
                 logging.error("path '%s' is invalid, should look like: '05', '03/02', '04/05/03'" % args.with_path)
 
                 return False
         else:
-            with FP5File(args.input.name) as fp5file:
+            with __open_fp5file__(args) as fp5file:
                 return fp5file.dump_data_blocks(args.output)
 
 
+def __cache_blocks__(args):
+    with __open_fp5file__(args) as fp5file:
+        return fp5file.write_block_cache()
+
+
 def __dump_records__(args):
-    with FP5File(args.input.name, encoding=args.encoding) as fp5file:
+    with __open_fp5file__(args, encoding=args.encoding) as fp5file:
         if not args.definition:
             fields_to_dump = fp5file.generate_export_definition(include_fields=args.include_fields,
                                                                 include_fields_like=args.include_fields_like,
@@ -89,11 +116,15 @@ def __dump_records__(args):
                                           filename=args.output,
                                           drop_empty_columns=args.drop_empty_columns,
                                           show_progress=args.progress,
-                                          table_name=args.table)
+                                          table_name=args.table,
+                                          scan_order=args.scan_order,
+                                          jobs=args.jobs,
+                                          first_record_to_process=args.from_record,
+                                          last_record_to_process=args.to_record)
 
 
 def __insert_records__(args):
-    with FP5File(args.input.name, encoding=args.encoding) as fp5file:
+    with __open_fp5file__(args, encoding=args.encoding) as fp5file:
         if not args.definition:
             fields_to_dump = fp5file.generate_export_definition(include_fields=args.include_fields,
                                                                 include_fields_like=args.include_fields_like,
@@ -122,7 +153,11 @@ def __insert_records__(args):
                                                         schema=args.schema,
                                                         drop_empty_columns=args.drop_empty_columns,
                                                         show_progress=args.progress,
-                                                        table_name=args.table)
+                                                        table_name=args.table,
+                                                        scan_order=args.scan_order,
+                                                        jobs=args.jobs,
+                                                        first_record_to_process=args.from_record,
+                                                        last_record_to_process=args.to_record)
         else:
             logging.error("a schema has to be specified if records should be inserted into a db")
 
@@ -202,7 +237,7 @@ def __update_records_determine_action__(fp5file, fields_to_dump, psycopg2_connec
 
 
 def __update_records__(args):
-    with FP5File(args.input.name, encoding=args.encoding) as fp5file:
+    with __open_fp5file__(args, encoding=args.encoding) as fp5file:
         if not args.definition:
             fields_to_dump = fp5file.generate_export_definition(include_fields=args.include_fields,
                                                                 include_fields_like=args.include_fields_like,
@@ -227,25 +262,28 @@ def __update_records__(args):
 
         action, first_record_to_process = __update_records_determine_action__(fp5file, fields_to_dump, args.pg, args.schema, args.limit_updated_rows)
 
+        if args.from_record is not None and (first_record_to_process is None or first_record_to_process < args.from_record):
+            first_record_to_process = args.from_record
+
         if action == 'full':
-            return fp5file.insert_records_into_postgres(fields_to_dump,
-                                                        psycopg2_connect_string=args.pg,
-                                                        schema=args.schema,
-                                                        show_progress=args.progress,
-                                                        table_name=args.table)
+            # the table is missing or has other columns and is loaded again, which a slice of the records cannot do
+            if args.from_record is not None or args.to_record is not None:
+                logging.error("the table has to be loaded in full, --from-record and --to-record cannot be used")
 
-        elif action == 'update':
-            return fp5file.update_records_into_postgres(fields_to_dump,
+                return False
+
+            return fp5file.insert_records_into_postgres(fields_to_dump,
                                                         psycopg2_connect_string=args.pg,
                                                         schema=args.schema,
                                                         show_progress=args.progress,
                                                         table_name=args.table)
 
-        elif action == 'partial-update':
+        elif action == 'update' or action == 'partial-update':
             return fp5file.update_records_into_postgres(fields_to_dump,
                                                         psycopg2_connect_string=args.pg,
                                                         schema=args.schema,
                                                         first_record_to_process=first_record_to_process,
+                                                        last_record_to_process=args.to_record,
                                                         show_progress=args.progress,
                                                         table_name=args.table)
 
@@ -283,6 +321,24 @@ def main():
     main_parser.add_argument('--version', action='version', version=version)
     main_parser.add_argument('-v', '--verbosity', default=0, action='count',
                              help='sets the verbosity level. -v = info -vv = debug')
+    main_parser.add_argument('--no-mmap', action='store_true',
+                             help='read blocks with unbuffered reads instead of memory-mapping the file')
+    main_parser.add_argument('--cache-dir', default=None,
+                             help='a directory to cache the block order and field catalog of opened files in, '
+                                  're-opening an unchanged file will load them from there')
+    main_parser.add_argument('--cache-size-limit', default=1024, type=int,
+                             help='the size in MB the cache directory may grow to before the least recently '
+                                  'used entries are removed. defaults to 1024')
+    main_parser.add_argument('--prefetch', default=0, type=int, metavar='DEPTH',
+                             help='read up to DEPTH data blocks ahead on a background thread while records are '
+                                  'parsed. useful for fragmented files on slow disks or network mounts')
+    main_parser.add_argument('--no-block-cache', action='store_true',
+                             help='read the data blocks from the fp5 file even if there is a valid block cache')
+    main_parser.add_argument('--member', default=None,
+                             help='read the fp5 file with this name from inside the zip or tar archive given as file')
+    main_parser.add_argument('--io-policy', default='default', choices=IO_POLICIES,
+                             help='how the file uses the page cache. sequential reads ahead, drop-behind also '
+                                  'evicts blocks once they are read to keep other caches (e.g. postgres) warm')
 
     sub_parsers = main_parser.add_subparsers(dest='action')
 
@@ -334,6 +390,15 @@ def main():
     dump_blocks_parser.add_argument('--with-path',
                                     help='dumps only data block containing nodes of a certain path. e.g. \'03/01\'')
 
+    # cache-blocks
+
+    cache_blocks_parser = sub_parsers.add_parser('cache-blocks',
+                                                 help='copies the data blocks of a fp5 file in their logical order to '
+                                                      'a cache file next to it, which is read instead while it is valid')
+
+    cache_blocks_parser.add_argument('input', type=argparse.FileType('r'),
+                                     help='the fp5 file to cache the data blocks of')
+
     # dump-records
 
     dump_records_parser = sub_parsers.add_parser('dump-records',
@@ -392,6 +457,20 @@ def main():
     dump_records_parser.add_argument('--progress', '-p', action='store_true',
                                      help='show progress while dumping records')
 
+    dump_records_parser.add_argument('--scan-order', choices=['chain', 'physical'], default='chain',
+                                     help='read the data blocks following their chain or in one sweep through the file, which '
+                                          'avoids random reads on fragmented files but keeps blocks read ahead of their turn in memory')
+
+    dump_records_parser.add_argument('--jobs', '-j', default=1, type=int, metavar='N',
+                                     help='decode the records on N processes, each of them opens the input file again. '
+                                          'the output is the same as with a single process')
+
+    dump_records_parser.add_argument('--from-record', default=None, type=__record_id__, metavar='ID',
+                                     help='only process the records with an id of at least ID')
+
+    dump_records_parser.add_argument('--to-record', default=None, type=__record_id__, metavar='ID',
+                                     help='only process the records with an id of at most ID, the records after it are not read')
+
     # insert-records
 
     insert_records_parser = sub_parsers.add_parser('insert-records',
@@ -455,6 +534,20 @@ def main():
     insert_records_parser.add_argument('--progress', '-p', action='store_true',
                                        help='show progress while dumping records')
 
+    insert_records_parser.add_argument('--scan-order', choices=['chain', 'physical'], default='chain',
+                                       help='read the data blocks following their chain or in one sweep through the file, which '
+                                            'avoids random reads on fragmented files but keeps blocks read ahead of their turn in memory')
+
+    insert_records_parser.add_argument('--jobs', '-j', default=1, type=int, metavar='N',
+                                       help='decode the records on N processes, each of them opens the input file again. '
+                                            'the output is the same as with a single process')
+
+    insert_records_parser.add_argument('--from-record', default=None, type=__record_id__, metavar='ID',
+                                       help='only process the records with an id of at least ID')
+
+    insert_records_parser.add_argument('--to-record', default=None, type=__record_id__, metavar='ID',
+                                       help='only process the records with an id of at most ID, the records after it are not read')
+
     # update-records
     update_records_parser = sub_parsers.add_parser('update-records',
                                                    help='updates an existing table by getting the last record id in '
@@ -519,8 +612,18 @@ def main():
     update_records_parser.add_argument('--progress', '-p', action='store_true',
                                        help='show progress while dumping records')
 
+    update_records_parser.add_argument('--from-record', default=None, type=__record_id__, metavar='ID',
+                                       help='only process the records with an id of at least ID')
+
+    update_records_parser.add_argument('--to-record', default=None, type=__record_id__, metavar='ID',
+                                       help='only process the records with an id of at most ID, the records after it are not read')
+
     args = main_parser.parse_args()
 
+    if getattr(args, 'from_record', None) is not None and getattr(args, 'to_record', None) is not None and \
+            args.from_record > args.to_record:
+        main_parser.error("--from-record %d is after --to-record %d" % (args.from_record, args.to_record))
+
     logger = logging.getLogger('fp5dump')
 
     logging_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -542,6 +645,8 @@ def main():
         result_ok = __count_records__(args)
     elif args.action == "dump-blocks":
         result_ok = __dump_blocks__(args)
+    elif args.action == "cache-blocks":
+        result_ok = __cache_blocks__(args)
     elif args.action == "dump-records":
         result_ok = __dump_records__(args)
     elif args.action == "insert-records":
@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import struct
+import tempfile
+from array import array
+
+from .blockchain import MAX_COPY_RUN_BLOCKS
+from .blocksource import open_block_source
+from .sidecarcache import SidecarCache
+
+BLOCK_CACHE_MAGIC = b'FP5DUMP\x00BLOCKS\x00\x01'
+BLOCK_CACHE_SUFFIX = '.blocks'
+
+
+class BlockCache(object):
+    """A copy of the data blocks of a file in their logical order, so they can be read front to back.
+
+    The blocks are stored in `<filename>.blocks`, the order they were written in and the fingerprint of
+    the fp5 file in `<filename>.blocks.map`. A cache whose fingerprint or order no longer matches is ignored."""
+
+    def __init__(self, fp5file, source):
+        super(BlockCache, self).__init__()
+
+        self.fp5file = fp5file
+        self.source = source
+
+    @staticmethod
+    def path(fp5file):
+        return fp5file.filename + BLOCK_CACHE_SUFFIX
+
+    @staticmethod
+    def write(fp5file):
+        """Writes the data blocks of `fp5file` and their map next to the fp5 file."""
+
+        logger = logging.getLogger('fp5dump.fp5file.blockcache')
+
+        blocks_path = BlockCache.path(fp5file)
+        map_path = blocks_path + '.map'
+
+        order = array('I', fp5file.data.order)
+
+        metadata_bytes = json.dumps({
+            "fingerprint": SidecarCache.fingerprint(fp5file),
+            "block_count": len(order)
+        }).encode()
+
+        blocks_dir = os.path.dirname(os.path.abspath(blocks_path))
+
+        (fd, temp_blocks_path) = tempfile.mkstemp(dir=blocks_dir, suffix=".tmp")
+        os.chmod(temp_blocks_path, 0o644)
+
+        with os.fdopen(fd, "wb") as file:
+            for (order_pos, run_length, run_pos) in fp5file.data.runs(max_run_length=MAX_COPY_RUN_BLOCKS):
+                fp5file.source.copy_to(file, run_pos, run_length * 0x400)
+                fp5file.source.consumed(run_pos, run_length * 0x400)
+
+        (fd, temp_map_path) = tempfile.mkstemp(dir=blocks_dir, suffix=".tmp")
+        os.chmod(temp_map_path, 0o644)
+
+        with os.fdopen(fd, "wb") as file:
+            file.write(struct.pack("<16sQ", BLOCK_CACHE_MAGIC, len(metadata_bytes)))
+            file.write(metadata_bytes)
+            file.write(memoryview(order).cast('B'))
+
+        # without a map the blocks are never used, so an interrupted update cannot pair a map with other blocks
+        if os.path.exists(map_path):
+            os.remove(map_path)
+
+        os.replace(temp_blocks_path, blocks_path)
+        os.replace(temp_map_path, map_path)
+
+        logger.info("wrote %d data blocks to \"%s\"" % (len(order), blocks_path))
+
+        return True
+
+    @staticmethod
+    def open(fp5file, use_mmap=True, io_policy='default'):
+        """Returns the block cache of `fp5file` if there is a valid one, None otherwise."""
+
+        logger = logging.getLogger('fp5dump.fp5file.blockcache')
+
+        blocks_path = BlockCache.path(fp5file)
+        map_path = blocks_path + '.map'
+
+        try:
+            with open(map_path, "rb") as file:
+                (magic, metadata_length) = struct.unpack("<16sQ", file.read(24))
+
+                if magic != BLOCK_CACHE_MAGIC:
+                    raise ValueError("unexpected magic number")
+
+                metadata = json.loads(file.read(metadata_length).decode())
+
+                order = array('I')
+                order.frombytes(file.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            logger.warning("ignoring unreadable block cache map \"%s\": %s" % (map_path, e))
+
+            return None
+
+        if metadata["fingerprint"] != SidecarCache.fingerprint(fp5file) or order != array('I', fp5file.data.order):
+            logger.info("block cache \"%s\" is stale" % blocks_path)
+
+            return None
+
+        try:
+            source = open_block_source(blocks_path, use_mmap=use_mmap, io_policy=io_policy)
+        except OSError as e:
+            logger.warning("could not open block cache \"%s\": %s" % (blocks_path, e))
+
+            return None
+
+        if source.size != len(order) * 0x400:
+            logger.warning("block cache \"%s\" is incomplete" % blocks_path)
+
+            source.close()
+
+            return None
+
+        logger.info("reading data blocks from \"%s\"" % blocks_path)
+
+        return BlockCache(fp5file, source)
+
+    def close(self):
+        if self.source:
+            self.source.close()
+            self.source = None
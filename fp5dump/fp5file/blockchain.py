@@ -1,21 +1,67 @@
-import struct
+import logging
 from array import array
 
 from collections import OrderedDict
 
+from .blockprefetcher import BlockPrefetcher
+
+# the number of consecutive blocks read at once
+MAX_RUN_BLOCKS = 0x40
+
+# the number of consecutive blocks copied at once by the block dumps, which do not parse them
+MAX_COPY_RUN_BLOCKS = 0x4000
+
+# the kinds of tokens, TOKEN_KINDS maps the first byte of a token to its kind
+TOKEN_FIELD_REF_SIMPLE = 1  # 0x40 - 0x7F: length byte, payload
+TOKEN_FIELD_REF_LONG = 2  # 0x01 - 0x3F: field ref of 0x01 - 0x3F bytes, length byte, payload
+TOKEN_CHILD = 3  # 0x00: length byte, payload
+TOKEN_KEY = 4  # 0x81 - 0xBF: key of 0x01 - 0x3F bytes
+TOKEN_PARTIAL = 5  # 0xFF: field ref, 2 length bytes, payload
+TOKEN_LENGTH_CHECK = 6  # 0x01 0xFF 0x05: 5 length bytes, only yielded by BlockChain.tokens
+TOKEN_POP = 7  # 0xC0
+TOKEN_PUSH = 8  # 0xC1 - 0xFD: path part of 0x01 - 0x3D bytes
+TOKEN_INVALID = 9
+
+
+def token_table_entry(token):
+    """Returns the kind, the payload offset and the payload length of a token starting with the byte `token`.
+
+    The length of the payload of field refs and child tokens is stored in the byte before their payload,
+    their payload length is 0 here. Keys and path parts have no length byte, their payload follows the first byte."""
+
+    if token == 0x00:
+        return TOKEN_CHILD, 2, 0
+    elif token <= 0x3F:
+        return TOKEN_FIELD_REF_LONG, 2 + token, 0
+    elif token <= 0x7F:
+        return TOKEN_FIELD_REF_SIMPLE, 2, 0
+    elif 0x81 <= token <= 0xBF:
+        return TOKEN_KEY, 1, token - 0x80
+    elif token == 0xC0:
+        return TOKEN_POP, 1, 0
+    elif 0xC1 <= token <= 0xFD:
+        return TOKEN_PUSH, 1, token - 0xC0
+    elif token == 0xFF:
+        return TOKEN_PARTIAL, 0, 0
+    else:
+        return TOKEN_INVALID, 0, 0
+
+
+TOKEN_KINDS = bytes(token_table_entry(token)[0] for token in range(0x100))
+TOKEN_PAYLOAD_OFFSETS = bytes(token_table_entry(token)[1] for token in range(0x100))
+TOKEN_PAYLOAD_LENGTHS = bytes(token_table_entry(token)[2] for token in range(0x100))
+
+# the field refs of simple field ref tokens, so they are not created for every token
+SIMPLE_FIELD_REFS = tuple(bytes([token & 0xBF]) for token in range(0x100))
+
+# the length of a field ref by its first byte, 0 if the byte does not start a field ref
+FIELD_REF_LENGTHS = bytes([1] * 0x80 + [2] * 0x40 + [3] * 0x20 + [4] * 0x10 + [5] * 0x08 + [0] * 0x08)
+
 
 def split_field_and_sub_ref(src):
-    if 0x00 <= src[0] <= 0x7F:
-        field_ref_len = 1
-    elif 0x80 <= src[0] <= 0xBF:
-        field_ref_len = 2
-    elif 0xC0 <= src[0] <= 0xDF:
-        field_ref_len = 3
-    elif 0xE0 <= src[0] <= 0xEF:
-        field_ref_len = 4
-    elif 0xF0 <= src[0] <= 0xF7:
-        field_ref_len = 5
-    else:
+    field_ref_len = FIELD_REF_LENGTHS[src[0]]
+
+    if not field_ref_len:
         return None, None
 
     if field_ref_len < len(src):
@@ -115,6 +161,440 @@ def encode_vli(src):
         return None
 
 
+def span_tokens(data, cursor, end, payload_views=False):
+    """A generator that splits `data` from `cursor` to `end` into tokens, see BlockChain.tokens.
+
+    With `payload_views` the payloads are memoryviews into `data` instead of copies, refs are bytes."""
+
+    logger = logging.getLogger('fp5dump.fp5file.blockchain')
+
+    token_kinds = TOKEN_KINDS
+    token_payload_lengths = TOKEN_PAYLOAD_LENGTHS
+    simple_field_refs = SIMPLE_FIELD_REFS
+
+    pop_token = (TOKEN_POP, None, None)
+
+    payloads = memoryview(data) if payload_views else data
+
+    while cursor < end:
+        char_at_cursor = data[cursor]
+        token_kind = token_kinds[char_at_cursor]
+
+        # FieldRefSimple
+        if token_kind == TOKEN_FIELD_REF_SIMPLE:
+            payload_start = cursor + 2
+            cursor = payload_start + data[cursor + 1]
+
+            yield (TOKEN_FIELD_REF_SIMPLE, simple_field_refs[char_at_cursor], payloads[payload_start:cursor])
+
+        # FieldRefLong
+        elif token_kind == TOKEN_FIELD_REF_LONG:
+            payload_start = cursor + 2 + char_at_cursor
+            payload_end = payload_start + data[payload_start - 1]
+
+            # Length Check
+            if char_at_cursor == 0x01 and data[cursor + 1] == 0xFF and data[cursor + 2] == 0x05:
+                cursor = payload_end
+
+                yield (TOKEN_LENGTH_CHECK, None, int.from_bytes(data[payload_start:payload_end], byteorder='big'))
+            else:
+                cursor = payload_end
+
+                yield (TOKEN_FIELD_REF_LONG, data[payload_start - 1 - char_at_cursor:payload_start - 1], payloads[payload_start:payload_end])
+
+        # parse 0xCN
+        elif token_kind == TOKEN_PUSH:
+            payload_start = cursor + 1
+            cursor = payload_start + token_payload_lengths[char_at_cursor]
+
+            yield (TOKEN_PUSH, data[payload_start:cursor], None)
+
+        # parse 0xC0
+        elif token_kind == TOKEN_POP:
+            cursor += 1
+
+            yield pop_token
+
+        # parse 0x8N
+        elif token_kind == TOKEN_KEY:
+            payload_start = cursor + 1
+            cursor = payload_start + token_payload_lengths[char_at_cursor]
+
+            yield (TOKEN_KEY, data[payload_start:cursor], None)
+
+        # parse 0xFF
+        elif token_kind == TOKEN_PARTIAL:
+            char_at_cursor = data[cursor + 1]
+
+            # FieldRefLong + DataLong
+            if 0x01 <= char_at_cursor <= 0x04:
+                check_counter = decode_vli(data[cursor + 2:cursor + 2 + char_at_cursor])
+
+                payload_start = cursor + 4 + char_at_cursor
+                payload_end = payload_start + (data[payload_start - 2] << 8) + data[payload_start - 1]
+
+            # FieldRefSimple + DataLong
+            elif 0x40 <= char_at_cursor < 0x80:
+                check_counter = char_at_cursor - 0x40
+
+                payload_start = cursor + 4
+                payload_end = payload_start + (data[cursor + 2] << 8) + data[cursor + 3]
+            else:
+                logger.error("unhandled 0xFF token: %r" % data[cursor:cursor + 20])
+                break
+
+            cursor = payload_end
+
+            yield (TOKEN_PARTIAL, check_counter, payloads[payload_start:payload_end])
+
+        # 0x00
+        elif token_kind == TOKEN_CHILD:
+            payload_start = cursor + 2
+            cursor = payload_start + data[cursor + 1]
+
+            yield (TOKEN_CHILD, None, payloads[payload_start:cursor])
+        else:
+            logger.error("incomplete parsing block data")
+            break
+
+    if cursor != end:
+        print("Parsing incomplete: expected: %d got: %d" % (cursor, end))
+
+        raise Exception("Parsing incomplete")
+
+
+def build_nodes(spans, search_path, yield_children=True, start_node_path=None, token_ids_to_return=None,
+                payload_views=False, stop_node_path=None, search_path_data_found=False):
+    """A generator that splits the tokens of `spans` and builds the nodes below `search_path` from them, see
+    BlockChain.sub_nodes for the arguments. BlockChain.sub_nodes and RecordView build their nodes here.
+
+    `spans` is an iterable of tuples of (data, cursor, end, closes_chain), the tokens of `data` from `cursor` to
+    `end` follow each other. With `closes_chain` the pop at `end` of the span closes the chain and ends the nodes.
+
+    The tokens are split inline rather than taken from `span_tokens`, a generator per token costs too much here."""
+
+    logger = logging.getLogger('fp5dump.fp5file.blockchain')
+
+    search_path_len = len(search_path)
+    relative_level_to_search_path = -search_path_len
+
+    path = []
+
+    current_node_stack = []
+
+    current_node_dict = OrderedDict()
+    current_node_bytes = None
+
+    not_interested_in_current_sub_node = False
+    current_sub_token_path = None
+
+    # the field refs of a projection are resolved once, not for every token
+    if token_ids_to_return is not None:
+        simple_refs_to_return = [False] * 0x40
+
+        for field_ref in token_ids_to_return:
+            if len(field_ref) == 1 and field_ref[0] < 0x40:
+                simple_refs_to_return[field_ref[0]] = True
+
+        long_refs_to_return = {b'\xfc': True}
+    else:
+        simple_refs_to_return = None
+        long_refs_to_return = None
+
+    token_kinds = TOKEN_KINDS
+    token_payload_offsets = TOKEN_PAYLOAD_OFFSETS
+    token_payload_lengths = TOKEN_PAYLOAD_LENGTHS
+    simple_field_refs = SIMPLE_FIELD_REFS
+
+    for (data, cursor, data_len, closes_chain) in spans:
+        # the payloads of dropped tokens are never sliced, the returned ones are views only if asked for
+        payloads = memoryview(data) if payload_views else data
+
+        while cursor < data_len:
+            char_at_cursor = data[cursor]
+            token_kind = token_kinds[char_at_cursor]
+
+            # skip fast through data we are not interested in
+            if not_interested_in_current_sub_node and token_kind < TOKEN_POP:
+                if token_kind <= TOKEN_CHILD:
+                    payload_start = cursor + token_payload_offsets[char_at_cursor]
+                    payload_end = payload_start + data[payload_start - 1]
+                elif token_kind == TOKEN_KEY:
+                    payload_end = cursor + 1 + token_payload_lengths[char_at_cursor]
+                else:
+                    char_at_cursor = data[cursor + 1]
+
+                    if 0x01 <= char_at_cursor <= 0x04:
+                        payload_start = cursor + 4 + char_at_cursor
+                        payload_end = payload_start + (data[payload_start - 2] << 8) + data[payload_start - 1]
+                    elif 0x40 <= char_at_cursor < 0x80:
+                        payload_start = cursor + 4
+                        payload_end = payload_start + (data[cursor + 2] << 8) + data[cursor + 3]
+                    else:
+                        logger.error("unhandled 0xFF token: %r" % data[cursor:cursor + 20])
+                        break
+
+                cursor = payload_end
+
+                continue
+
+            # FieldRefSimple
+            if token_kind == TOKEN_FIELD_REF_SIMPLE:
+                payload_start = cursor + 2
+                payload_end = payload_start + data[cursor + 1]
+
+                if current_node_bytes is None:
+                    field_ref_bin = simple_field_refs[char_at_cursor]
+
+                    if token_ids_to_return is None or \
+                            not (relative_level_to_search_path != 0 and not yield_children) and (relative_level_to_search_path != 1 and yield_children) \
+                            or simple_refs_to_return[field_ref_bin[0]]:
+                        current_node_dict[field_ref_bin] = payloads[payload_start:payload_end]
+                else:
+                    check_counter = char_at_cursor - 0x40
+
+                    if len(current_node_bytes) == check_counter - 1:
+                        current_node_bytes.append(payloads[payload_start:payload_end])
+                    else:
+                        logger.error("wrong partial data counter %d != %d" % (check_counter, len(current_node_bytes)))
+
+                        raise Exception("Parsing incomplete")
+
+                cursor = payload_end
+
+            # FieldRefLong
+            elif token_kind == TOKEN_FIELD_REF_LONG:
+                payload_start = cursor + 2 + char_at_cursor
+                payload_end = payload_start + data[payload_start - 1]
+
+                # Length Check
+                if char_at_cursor == 0x01 and data[cursor + 1] == 0xFF and data[cursor + 2] == 0x05:
+                    length_check = int.from_bytes(data[payload_start:payload_end], byteorder='big')
+
+                    if current_node_bytes:
+                        current_node_bytes = b''.join(current_node_bytes)
+
+                        if len(current_node_bytes) != length_check:
+                            logger.error("length check failed %d != %d\n%s" % (length_check, len(current_node_bytes), current_node_bytes))
+
+                            raise Exception("Parsing incomplete")
+                    elif len(current_node_dict) == 1 and b'\x01' in current_node_dict:
+                        if len(current_node_dict[b'\x01']) == length_check:
+                            current_node_bytes = current_node_dict[b'\x01']
+                            current_node_dict.clear()
+                        else:
+                            logger.error("length check failed %d != %d\n%s" % (length_check, len(current_node_dict[b'\x01']), current_node_dict[b'\x01']))
+
+                            raise Exception("Parsing incomplete")
+                    elif len(current_node_dict) == 2 and b'\x01' in current_node_dict:
+                        if len(current_node_dict[b'\x01']) != length_check:
+                            logger.error("length check failed %d != %d\n%s" % (length_check, len(current_node_dict[b'\x01']), current_node_dict[b'\x01']))
+
+                            raise Exception("Parsing incomplete")
+                    else:
+                        # logger.error("length check found, but no dict[0x41] or bytes")
+                        current_node_bytes = None
+
+                    cursor = payload_end
+
+                    continue
+
+                field_ref_bin_combined = data[cursor + 1:payload_start - 1]
+
+                if current_node_bytes is None:
+                    if token_ids_to_return is None or \
+                            not (relative_level_to_search_path != 0 and not yield_children) and (relative_level_to_search_path != 1 and yield_children):
+                        return_token = True
+                    else:
+                        return_token = long_refs_to_return.get(field_ref_bin_combined)
+
+                        if return_token is None:
+                            field_ref_len = FIELD_REF_LENGTHS[field_ref_bin_combined[0]]
+                            return_token = long_refs_to_return[field_ref_bin_combined] = \
+                                field_ref_len != 0 and field_ref_bin_combined[:field_ref_len] in token_ids_to_return
+
+                    if return_token:
+                        current_node_dict[field_ref_bin_combined] = payloads[payload_start:payload_end]
+                else:
+                    check_counter = decode_vli(field_ref_bin_combined)
+
+                    if len(current_node_bytes) != check_counter - 1:
+                        logger.error("wrong partial data counter %d != %d" % (check_counter, len(current_node_bytes)))
+
+                        raise Exception("Parsing incomplete")
+
+                    current_node_bytes.append(payloads[payload_start:payload_end])
+
+                cursor = payload_end
+
+            # parse 0xCN
+            elif token_kind == TOKEN_PUSH:
+                payload_start = cursor + 1
+                payload_end = payload_start + token_payload_lengths[char_at_cursor]
+
+                path.append(data[payload_start:payload_end])
+
+                relative_level_to_search_path += 1
+
+                if path[:search_path_len] > search_path:
+                    return
+
+                if stop_node_path is not None and path[:len(stop_node_path)] >= stop_node_path:
+                    return
+
+                if not search_path_data_found:
+                    if start_node_path is not None:
+                        if path[:len(start_node_path)] >= start_node_path:
+                            search_path_data_found = True
+
+                    elif path[:search_path_len] == search_path:
+                        search_path_data_found = True
+
+                if relative_level_to_search_path == 0:
+                    current_sub_token_path = None
+                elif relative_level_to_search_path == 1 and not yield_children:
+                    current_sub_token_path = path[-1]
+                elif relative_level_to_search_path == 2 and yield_children:
+                    current_sub_token_path = path[-1]
+
+                if not search_path_data_found:
+                    not_interested_in_current_sub_node = True
+                elif current_sub_token_path is not None and token_ids_to_return is not None and current_sub_token_path not in token_ids_to_return:
+                    not_interested_in_current_sub_node = True
+                else:
+                    not_interested_in_current_sub_node = False
+
+                if not not_interested_in_current_sub_node:
+                    if current_node_bytes is not None:
+                        current_node_dict = OrderedDict()
+                        current_node_dict[b'\x01'] = current_node_bytes
+
+                    current_node_stack.append(current_node_dict)
+
+                    current_node_dict = OrderedDict()
+                    current_node_bytes = None
+
+                cursor = payload_end
+
+            # parse 0xC0
+            elif token_kind == TOKEN_POP:
+                # the pop closing the chain
+                if closes_chain and cursor + 1 == data_len:
+                    return None
+
+                if not yield_children and relative_level_to_search_path == 0 and search_path_data_found:
+                    yield (None, current_node_dict)
+
+                    return
+                elif yield_children and relative_level_to_search_path == 0 and search_path_data_found:
+                    for (field_ref_bin, paylod) in current_node_dict.items():
+                        yield (field_ref_bin, paylod)
+
+                    return
+                elif yield_children and relative_level_to_search_path == 1 and search_path_data_found:
+                    if current_node_dict:
+                        yield (path[-1], current_node_dict)
+
+                        current_node_dict.clear()
+
+                field_ref_bin = path.pop()
+                relative_level_to_search_path -= 1
+
+                if not not_interested_in_current_sub_node:
+                    parent_node = current_node_stack.pop()
+
+                    if current_node_dict:
+                        parent_node[field_ref_bin] = current_node_dict
+                    elif current_node_bytes is not None:
+                        parent_node[field_ref_bin] = current_node_bytes
+
+                    current_node_dict = parent_node
+                    current_node_bytes = None
+
+                if (relative_level_to_search_path == 1 and yield_children) or (relative_level_to_search_path == 0 and not yield_children):
+                    current_sub_token_path = None
+                elif (relative_level_to_search_path == 2 and yield_children) or (relative_level_to_search_path == 1 and not yield_children):
+                    current_sub_token_path = path[-1]
+
+                if not search_path_data_found:
+                    not_interested_in_current_sub_node = True
+                elif current_sub_token_path is not None and token_ids_to_return is not None and current_sub_token_path not in token_ids_to_return:
+                    not_interested_in_current_sub_node = True
+                else:
+                    not_interested_in_current_sub_node = False
+
+                cursor += 1
+
+            # parse 0x8N
+            elif token_kind == TOKEN_KEY:
+                payload_start = cursor + 1
+                payload_end = payload_start + token_payload_lengths[char_at_cursor]
+
+                current_node_dict[data[payload_start:payload_end]] = None
+
+                cursor = payload_end
+
+            # parse 0xFF
+            elif token_kind == TOKEN_PARTIAL:
+                if current_node_bytes is None:
+                    current_node_bytes = []
+
+                char_at_cursor = data[cursor + 1]
+
+                # FieldRefLong + DataLong
+                if 0x01 <= char_at_cursor <= 0x04:
+                    check_counter = decode_vli(data[cursor + 2:cursor + 2 + char_at_cursor])
+
+                    payload_start = cursor + 4 + char_at_cursor
+                    payload_end = payload_start + (data[payload_start - 2] << 8) + data[payload_start - 1]
+
+                # FieldRefSimple + DataLong
+                elif 0x40 <= char_at_cursor < 0x80:
+                    check_counter = char_at_cursor - 0x40
+
+                    payload_start = cursor + 4
+                    payload_end = payload_start + (data[cursor + 2] << 8) + data[cursor + 3]
+                else:
+                    logger.error("unhandled 0xFF token: %r" % data[cursor:cursor + 20])
+                    break
+
+                if len(current_node_bytes) != check_counter - 1:
+                    logger.error("wrong partial data counter %d expected %d" % (check_counter, len(current_node_bytes) + 1))
+
+                current_node_bytes.append(payloads[payload_start:payload_end])
+
+                cursor = payload_end
+
+            # 0x00
+            elif token_kind == TOKEN_CHILD:
+                payload_start = cursor + 2
+                payload_end = payload_start + data[cursor + 1]
+
+                cursor = payload_end
+            else:
+                logger.error("incomplete parsing block data")
+                break
+
+        if cursor != data_len:
+            print("Parsing incomplete: expected: %d got: %d" % (cursor, data_len))
+
+            raise Exception("Parsing incomplete")
+
+
+def prefix_path(data, cursor):
+    """Returns the path left open by the path prefix of a block, the first `cursor` bytes of its `data`."""
+
+    path = []
+
+    for (token_kind, ref, payload) in span_tokens(data, 0, cursor):
+        if token_kind == TOKEN_PUSH:
+            path.append(ref)
+        elif token_kind == TOKEN_POP and path:
+            path.pop()
+
+    return path
+
+
 class BlockChain(object):
     """Saves the blocks (and their order) belonging to one index/data level."""
 
@@ -124,6 +604,7 @@ class BlockChain(object):
         self.level = level
         self.fp5file = fp5file
         self.order = None
+        self.block_id_to_order_pos = None
         self.length = 0
 
         self.first_block_pos = None
@@ -137,8 +618,34 @@ class BlockChain(object):
 
         return None
 
-    def sub_nodes(self, search_path=None, yield_children=True, start_node_path=None, token_ids_to_return=None):
-        """A generator that returns all token belonging for a given path."""
+    def order_pos(self, block_id):
+        """Returns the position of `block_id` in `order`."""
+
+        order_pos = self.block_id_to_order_pos[block_id]
+
+        if self.order[order_pos] != block_id:
+            raise ValueError("block 0x%08X is not part of block chain %d" % (block_id, self.level))
+
+        return order_pos
+
+    def sub_nodes(self, search_path=None, yield_children=True, start_node_path=None, token_ids_to_return=None,
+                  scan_order='chain', payload_views=False, stop_node_path=None, start_block_id=None):
+        """A generator that returns all token belonging for a given path.
+
+        The blocks are split into the same tokens `tokens` yields. With `scan_order` 'physical' the blocks are
+        read in one sweep through the file, see read_blocks_physical.
+
+        With `token_ids_to_return` only the tokens of these fields are kept, the payloads of the others are
+        not even sliced out of the blocks. The payloads are bytes, with `payload_views` they are memoryviews
+        into the blocks instead. Values made up of several parts are joined into bytes either way.
+
+        With `start_node_path` the generator starts with the node of that path or the first one after it, with
+        `stop_node_path` it stops before the node of that path or the first one after it, with `start_block_id` the
+        blocks are read from that block on instead of the one the index gives for the start path. Together
+        they parse one range of FP5File.partition_records."""
+
+        if type(stop_node_path) is bytes:
+            stop_node_path = stop_node_path.split(b'/')
 
         if start_node_path is not None and search_path is not None:
             search_path_data_found = False
@@ -149,353 +656,314 @@ class BlockChain(object):
             if type(search_path) is bytes:
                 search_path = search_path.split(b'/')
 
-            start_block_id = self.fp5file.find_first_block_id_for_path(start_node_path)
+            if start_block_id is None:
+                start_order_pos = self.node_order_pos(search_path, start_node_path)
+
+                if start_order_pos is not None:
+                    start_block_id = self.order[start_order_pos]
         elif search_path is None:
             search_path_data_found = True
-            start_block_id = self.order[0]
+
+            if start_block_id is None:
+                start_block_id = self.order[0]
         else:
             search_path_data_found = False
 
             if type(search_path) is bytes:
                 search_path = search_path.split(b'/')
 
-            start_block_id = self.fp5file.find_first_block_id_for_path(search_path)
+            if start_block_id is None:
+                start_block_id = self.fp5file.find_first_block_id_for_path(search_path)
 
-        search_path_len = len(search_path)
-        relative_level_to_search_path = -search_path_len
+        yield from build_nodes(self.spans(self.order_pos(start_block_id), scan_order), search_path, yield_children,
+                               start_node_path, token_ids_to_return, payload_views, stop_node_path, search_path_data_found)
 
-        file = self.fp5file.file
-        order = self.order
-        block_id_to_block_pos = self.fp5file.block_id_to_block_pos
+    def spans(self, order_pos=0, scan_order='chain'):
+        """A generator that yields the blocks of the chain from `order_pos` on as spans for build_nodes.
 
-        path = []
+        The path prefix at the start of every block but the first is skipped, as the path continues from the
+        block before."""
+
+        directory = self.fp5file.directory
 
         is_first_block = True
-        block_chain_end_reached = False
 
-        current_block_id = start_block_id
-        current_block_order_pos = order.index(current_block_id)
-        current_block_file_pos = block_id_to_block_pos[current_block_id]
+        for (block_order_pos, block_id, block_pos, data) in self.blocks(order_pos, scan_order):
+            if not is_first_block:
+                cursor = directory.skip_bytes[block_pos >> 10] - 1
+            else:
+                cursor = 0
 
-        current_node_stack = []
+            yield (data, cursor, len(data), block_order_pos + 1 == self.length)
 
-        current_node_dict = OrderedDict()
-        current_node_bytes = None
+            is_first_block = False
 
-        not_interested_in_current_sub_node = False
-        current_sub_token_path = None
+    def tokens(self, order_pos=0, scan_order='chain', payload_views=False):
+        """A generator that splits the blocks of the chain from `order_pos` on into tokens, the same build_nodes
+        splits them into.
 
-        while not block_chain_end_reached:
-            if not search_path_data_found:
-                self.fp5file.logging.debug(" data block 0x%02X 0x%08X @ 0x%08X" % (0, current_block_id, current_block_file_pos))
+        Yields a tuple of (token_kind, ref, payload) per token:
 
-            file.seek(current_block_file_pos + 0x0A)
-            (current_block_skip_bytes, current_block_length) = struct.unpack_from(">HH", file.read(0x04))
+        - TOKEN_FIELD_REF_SIMPLE, TOKEN_FIELD_REF_LONG: the field ref and the payload
+        - TOKEN_PARTIAL: the counter of the part and the payload, the parts of one value follow each other
+        - TOKEN_LENGTH_CHECK: None and the length of the value the parts before it add up to
+        - TOKEN_KEY: the key and None
+        - TOKEN_PUSH: the path part and None
+        - TOKEN_POP: None and None, the pop closing the chain is not yielded
+        - TOKEN_CHILD: None and the payload
 
-            data_len = current_block_length
-            data = file.read(data_len)
+        The path prefix at the start of every block but the first is skipped, as the path continues from the
+        block before. With `scan_order` 'physical' the blocks are read in one sweep through the file.
+        With `payload_views` the payloads are memoryviews into the block instead of copies, refs are bytes."""
 
-            if not is_first_block:
-                cursor = current_block_skip_bytes - 1
+        for (data, cursor, end, closes_chain) in self.spans(order_pos, scan_order):
+            if not closes_chain:
+                yield from span_tokens(data, cursor, end, payload_views)
             else:
-                cursor = 0
+                # hold back every token by one, the pop closing the chain is the last one in the last block
+                last_token = None
 
-            while cursor < data_len:
-                char_at_cursor = data[cursor]
-
-                # skip fast through data we are not interested in
-                if not_interested_in_current_sub_node and (char_at_cursor < 0xC0 or char_at_cursor == 0xFF):
-                    if 0x01 <= char_at_cursor <= 0x3F:
-                        payload_start = cursor + 2 + char_at_cursor
-                        payload_end = payload_start + data[payload_start - 1]
-                    elif 0x40 <= char_at_cursor <= 0x7F:
-                        payload_start = cursor + 2
-                        payload_end = payload_start + data[cursor + 1]
-                    elif 0x81 <= char_at_cursor <= 0xBF:
-                        payload_start = cursor + 1
-                        payload_end = payload_start + (data[cursor] - 0x80)
-                    elif char_at_cursor == 0xFF:
-                        char_at_cursor = data[cursor + 1]
-
-                        if 0x01 <= char_at_cursor <= 0x04:
-                            payload_start = cursor + 4 + char_at_cursor
-                            payload_end = payload_start + int.from_bytes(data[cursor + 2 + char_at_cursor:cursor + 4 + char_at_cursor], byteorder='big')
-                        elif 0x40 <= char_at_cursor < 0x80:
-                            payload_start = cursor + 4
-                            payload_end = payload_start + int.from_bytes(data[cursor + 2:cursor + 4], byteorder='big')
-                        else:
-                            self.fp5file.logging.error("unhandled 0xFF token: %r" % data[cursor:cursor + 20])
-                            break
-                    elif 0x00 == char_at_cursor:
-                        payload_start = cursor + 2
-                        payload_end = payload_start + data[cursor + 1]
-                    else:
-                        self.fp5file.logging.error("unhandled token: %r" % data[cursor:cursor + 20])
-                        break
+                for token in span_tokens(data, cursor, end, payload_views):
+                    if last_token is not None:
+                        yield last_token
 
-                    cursor = payload_end
+                    last_token = token
 
-                    continue
+                if last_token is not None and last_token[0] != TOKEN_POP:
+                    yield last_token
 
-                # Length Check
-                if char_at_cursor == 0x01 and data[cursor + 1] == 0xFF and data[cursor + 2] == 0x05:
-                    payload_start = cursor + 3
-                    payload_end = payload_start + 5
-                    length_check = int.from_bytes(data[payload_start:payload_end], byteorder='big')
+    def first_child_path(self, search_path, order_pos):
+        """Returns the path of the first child node of `search_path` that is opened in the block at `order_pos`
+        of the chain or a later one, together with the position of that block. Returns (None, None) if the
+        search path is closed before.
 
-                    if current_node_bytes:
-                        current_node_bytes = b''.join(current_node_bytes)
+        The path that is open at the start of the block is taken from its path prefix, so the chain does not
+        have to be parsed from the start."""
 
-                        if len(current_node_bytes) != length_check:
-                            self.fp5file.logging.error("length check failed %d != %d\n%s" % (length_check, len(current_node_bytes), current_node_bytes))
-                            break
-                    elif len(current_node_dict) == 1 and b'\x01' in current_node_dict:
-                        if len(current_node_dict[b'\x01']) == length_check:
-                            current_node_bytes = current_node_dict[b'\x01']
-                            current_node_dict.clear()
-                        else:
-                            self.fp5file.logging.error("length check failed %d != %d\n%s" % (length_check, len(current_node_dict[b'\x01']), current_node_dict[b'\x01']))
-                            break
-                    elif len(current_node_dict) == 2 and b'\x01' in current_node_dict:
-                        if len(current_node_dict[b'\x01']) != length_check:
-                            self.fp5file.logging.error("length check failed %d != %d\n%s" % (length_check, len(current_node_dict[b'\x01']), current_node_dict[b'\x01']))
-                            break
-                    else:
-                        # self.fp5file.logging.error("length check found, but no dict[0x41] or bytes")
-                        current_node_bytes = None
+        directory = self.fp5file.directory
 
-                    cursor = payload_end
+        search_path = list(search_path)
+        search_path_len = len(search_path)
 
-                    continue
+        path = None
 
-                # FieldRefLong
-                if 0x01 <= char_at_cursor <= 0x3F:
-                    field_ref_len = char_at_cursor
-                    field_ref_bin_combined = data[cursor + 1:cursor + 1 + field_ref_len]
-                    field_ref_bin, field_sub_ref_bin = split_field_and_sub_ref(field_ref_bin_combined)
+        for (block_order_pos, block_id, block_pos, data) in self.read_blocks(order_pos):
+            cursor = directory.skip_bytes[block_pos >> 10] - 1 if block_order_pos > 0 else 0
 
-                    payload_start = cursor + 2 + char_at_cursor
-                    payload_end = payload_start + data[payload_start - 1]
+            if path is None:
+                path = prefix_path(data, cursor)
 
-                    if current_node_bytes is None:
-                        if token_ids_to_return is None or field_ref_bin_combined == b'\xfc' or \
-                                not (relative_level_to_search_path != 0 and not yield_children) and (relative_level_to_search_path != 1 and yield_children) \
-                                or field_ref_bin in token_ids_to_return:
-                            current_node_dict[field_ref_bin_combined] = data[payload_start:payload_end]
-                        # else:
-                        #     print(field_ref_bin, data[payload_start:payload_end])
+            for (token_kind, ref, payload) in span_tokens(data, cursor, len(data)):
+                if token_kind == TOKEN_PUSH:
+                    path.append(ref)
 
-                    else:
-                        check_counter = decode_vli(field_ref_bin_combined)
+                    if len(path) == search_path_len + 1 and path[:search_path_len] == search_path:
+                        return (path, block_order_pos)
 
-                        if len(current_node_bytes) != check_counter - 1:
-                            self.fp5file.logging.error("wrong partial data counter %d != %d" % (check_counter, len(current_node_bytes)))
+                elif token_kind == TOKEN_POP:
+                    if path == search_path or not path:
+                        return (None, None)
 
-                            break
+                    path.pop()
 
-                        current_node_bytes.append(data[payload_start:payload_end])
+        return (None, None)
 
-                    cursor = payload_end
+    def node_order_pos(self, search_path, node_path):
+        """Returns the position of the block the child node `node_path` of `search_path` is (or would be)
+        opened in, None if the index has no block for it.
 
-                    continue
+        The index may lead to a block after that one, so the blocks before it are checked until one is found
+        that starts before the node."""
 
-                # FieldRefSimple
-                elif 0x40 <= char_at_cursor <= 0x7F:
-                    payload_start = cursor + 2
-                    payload_end = payload_start + data[cursor + 1]
+        block_id = self.fp5file.find_first_block_id_for_path(node_path)
 
-                    if current_node_bytes is None:
-                        field_ref_bin = bytes([char_at_cursor & 0xBF])
+        if block_id is None:
+            return None
 
-                        if token_ids_to_return is None or \
-                                not (relative_level_to_search_path != 0 and not yield_children) and (relative_level_to_search_path != 1 and yield_children) \
-                                or field_ref_bin in token_ids_to_return:
-                            current_node_dict[field_ref_bin] = data[payload_start:payload_end]
-                        # else:
-                        #     print(field_ref_bin, data[payload_start:payload_end])
-                    else:
-                        check_counter = char_at_cursor - 0x40
+        search_path = list(search_path)
+        node_path = list(node_path)
 
-                        if len(current_node_bytes) == check_counter - 1:
-                            current_node_bytes.append(data[payload_start:payload_end])
-                        else:
-                            self.fp5file.logging.error("wrong partial data counter %d != %d" % (check_counter, len(current_node_bytes)))
-                            break
+        order_pos = self.order_pos(block_id)
 
-                    cursor = payload_end
-                    continue
+        while order_pos > 0:
+            (block_id, block_pos, data) = self.read_block(order_pos)
 
-                # parse 0x8N
-                elif 0x81 <= char_at_cursor <= 0xBF:
-                    payload_start = cursor + 1
-                    payload_end = payload_start + (data[cursor] - 0x80)
+            open_path = prefix_path(data, self.fp5file.directory.skip_bytes[block_pos >> 10] - 1)
 
-                    current_node_dict[data[payload_start:payload_end]] = None
+            if open_path[:len(node_path)] < node_path:
+                if len(open_path) > len(search_path):
+                    break
 
-                    cursor = payload_end
-                    continue
+                (child_path, child_order_pos) = self.first_child_path(search_path, order_pos)
 
-                # parse 0xC0
-                elif char_at_cursor == 0xC0:
-                    if current_block_order_pos + 1 == self.length and cursor + 1 == data_len:
-                        return None
-                    else:
-                        if not yield_children and relative_level_to_search_path == 0 and search_path_data_found:
-                            yield (None, current_node_dict)
+                if child_order_pos != order_pos or child_path <= node_path:
+                    break
 
-                            return
-                        elif yield_children and relative_level_to_search_path == 0 and search_path_data_found:
-                            for (field_ref_bin, paylod) in current_node_dict.items():
-                                yield (field_ref_bin, paylod)
+            order_pos -= 1
 
-                            return
-                        elif yield_children and relative_level_to_search_path == 1 and search_path_data_found:
-                            if current_node_dict:
-                                yield (path[-1], current_node_dict)
+        return order_pos
 
-                                current_node_dict.clear()
+    def runs(self, order_pos=0, max_run_length=MAX_RUN_BLOCKS, end_order_pos=None):
+        """A generator that splits the chain from `order_pos` on into runs of blocks stored in consecutive slots.
 
-                        field_ref_bin = path.pop()
-                        relative_level_to_search_path -= 1
+        Yields tuples of (order_pos, run_length, block_pos) with at most `max_run_length` blocks per run.
+        The runs stop before `end_order_pos` if it is given."""
 
-                        if not not_interested_in_current_sub_node:
-                            parent_node = current_node_stack.pop()
+        order = self.order
+        block_id_to_block_pos = self.fp5file.block_id_to_block_pos
 
-                            if current_node_dict:
-                                parent_node[field_ref_bin] = current_node_dict
-                            elif current_node_bytes is not None:
-                                parent_node[field_ref_bin] = current_node_bytes
+        if end_order_pos is None:
+            end_order_pos = self.length
 
-                            current_node_dict = parent_node
-                            current_node_bytes = None
+        while order_pos < end_order_pos:
+            block_pos = block_id_to_block_pos[order[order_pos]]
+            run_length = 1
 
-                        if (relative_level_to_search_path == 1 and yield_children) or (relative_level_to_search_path == 0 and not yield_children):
-                            current_sub_token_path = None
-                        elif (relative_level_to_search_path == 2 and yield_children) or (relative_level_to_search_path == 1 and not yield_children):
-                            current_sub_token_path = path[-1]
+            while order_pos + run_length < end_order_pos and run_length < max_run_length and \
+                    block_id_to_block_pos[order[order_pos + run_length]] == block_pos + run_length * 0x400:
+                run_length += 1
 
-                        if not search_path_data_found:
-                            not_interested_in_current_sub_node = True
-                        elif current_sub_token_path is not None and token_ids_to_return is not None and current_sub_token_path not in token_ids_to_return:
-                            not_interested_in_current_sub_node = True
-                        else:
-                            not_interested_in_current_sub_node = False
+            self.fp5file.block_runs += 1
+            self.fp5file.block_run_blocks += run_length
 
-                        cursor += 1
+            yield (order_pos, run_length, block_pos)
 
-                        continue
+            order_pos += run_length
 
-                # parse 0xCN
-                elif 0xC1 <= char_at_cursor < 0xFE:
-                    payload_start = cursor + 1
-                    payload_end = payload_start + (char_at_cursor - 0xC0)
+    def read_blocks(self, order_pos=0):
+        """A generator that reads the blocks of the chain from `order_pos` on, one run of consecutive blocks at a time.
 
-                    path.append(data[payload_start:payload_end])
+        The data chain is read from the block cache of the file if it has one. Yields tuples of
+        (order_pos, block_id, block_pos, data) where data excludes the block header."""
 
-                    relative_level_to_search_path += 1
+        lengths = self.fp5file.directory.length
+        order = self.order
+        block_id_to_block_pos = self.fp5file.block_id_to_block_pos
 
-                    if path[:search_path_len] > search_path:
-                        return
+        if self.level == 0 and self.fp5file.block_cache is not None:
+            # the cache holds the blocks in their logical order, so the chain is one long run
+            source = self.fp5file.block_cache.source
+            runs = ((run_order_pos, min(MAX_RUN_BLOCKS, self.length - run_order_pos), run_order_pos * 0x400)
+                    for run_order_pos in range(order_pos, self.length, MAX_RUN_BLOCKS))
+        else:
+            source = self.fp5file.source
+            runs = self.runs(order_pos)
 
-                    if not search_path_data_found:
-                        if start_node_path is not None:
-                            if path[:len(start_node_path)] == start_node_path:
-                                search_path_data_found = True
+        next_run = next(runs, None)
 
-                        elif path[:search_path_len] == search_path:
-                            search_path_data_found = True
+        while next_run is not None:
+            (run_order_pos, run_length, run_pos) = next_run
 
-                    if relative_level_to_search_path == 0:
-                        current_sub_token_path = None
-                    elif relative_level_to_search_path == 1 and not yield_children:
-                        current_sub_token_path = path[-1]
-                    elif relative_level_to_search_path == 2 and yield_children:
-                        current_sub_token_path = path[-1]
-
-                    if not search_path_data_found:
-                        not_interested_in_current_sub_node = True
-                    elif current_sub_token_path is not None and token_ids_to_return is not None and current_sub_token_path not in token_ids_to_return:
-                        not_interested_in_current_sub_node = True
-                    else:
-                        not_interested_in_current_sub_node = False
+            # let the kernel fetch the following run while this one is parsed
+            next_run = next(runs, None)
 
-                    if not not_interested_in_current_sub_node:
-                        if current_node_bytes is not None:
-                            current_node_dict = OrderedDict()
-                            current_node_dict[b'\x01'] = current_node_bytes
+            if next_run is not None:
+                source.will_need(next_run[2], next_run[1] * 0x400)
 
-                        current_node_stack.append(current_node_dict)
+            run_data = source.read(run_pos, run_length * 0x400)
 
-                        current_node_dict = OrderedDict()
-                        current_node_bytes = None
+            for run_index in range(run_length):
+                block_id = order[run_order_pos + run_index]
+                block_pos = block_id_to_block_pos[block_id]
+                data_start = run_index * 0x400 + 0x0E
 
-                    cursor = payload_end
+                yield (run_order_pos + run_index, block_id, block_pos, run_data[data_start:data_start + lengths[block_pos >> 10]])
 
-                    continue
+            source.consumed(run_pos, run_length * 0x400)
 
-                # parse 0xFF
-                elif char_at_cursor == 0xFF:
-                    if current_node_bytes is None:
-                        current_node_bytes = []
+    def read_block(self, order_pos):
+        """Reads the single block at `order_pos` of the chain, from the block cache of the file if it has one.
 
-                    char_at_cursor = data[cursor + 1]
+        Returns a tuple of (block_id, block_pos, data) as read_blocks."""
 
-                    # FieldRefLong + DataLong
-                    if 0x01 <= char_at_cursor <= 0x04:
-                        field_ref_bin = data[cursor + 2:cursor + 2 + char_at_cursor]
-                        check_counter = decode_vli(field_ref_bin)
+        block_id = self.order[order_pos]
+        block_pos = self.fp5file.block_id_to_block_pos[block_id]
+        data_len = self.fp5file.directory.length[block_pos >> 10]
 
-                        payload_start = cursor + 4 + char_at_cursor
-                        payload_end = payload_start + int.from_bytes(data[cursor + 2 + char_at_cursor:cursor + 4 + char_at_cursor], byteorder='big')
+        if self.level == 0 and self.fp5file.block_cache is not None:
+            data = self.fp5file.block_cache.source.read(order_pos * 0x400 + 0x0E, data_len)
+        else:
+            data = self.fp5file.source.read(block_pos + 0x0E, data_len)
 
-                    # FieldRefSimple + DataLong
-                    elif 0x40 <= char_at_cursor < 0x80:
-                        field_ref_bin = data[cursor + 1:cursor + 2]
-                        check_counter = decode_vli(field_ref_bin, True)
+        return (block_id, block_pos, data)
 
-                        payload_start = cursor + 4
-                        payload_end = payload_start + int.from_bytes(data[cursor + 2:cursor + 4], byteorder='big')
-                    else:
-                        self.fp5file.logging.error("unhandled 0xFF token: %r" % data[cursor:cursor + 20])
-                        break
+    def read_blocks_physical(self, order_pos=0):
+        """Same as read_blocks, but reads the blocks in the order they are stored in the file.
 
-                    if len(current_node_bytes) != check_counter - 1:
-                        self.fp5file.logging.error("wrong partial data counter %d expected %d" % (check_counter, len(current_node_bytes) + 1))
+        The file is swept once from front to back and blocks are handed out as soon as all blocks before them
+        in the chain have been. Blocks read ahead of their turn are kept in memory, for a heavily fragmented
+        file that can be most of the chain."""
 
-                    current_node_bytes.append(data[payload_start:payload_end])
+        if self.level == 0 and self.fp5file.block_cache is not None:
+            # the block cache is in logical order already
+            yield from self.read_blocks(order_pos)
 
-                    cursor = payload_end
+            return
 
-                    continue
-                # 0x00
-                elif 0x00 == char_at_cursor:
-                    payload_start = cursor + 2
-                    payload_end = payload_start + data[cursor + 1]
+        lengths = self.fp5file.directory.length
+        order = self.order
+        block_id_to_block_pos = self.fp5file.block_id_to_block_pos
+        source = self.fp5file.source
 
-                    cursor = payload_end
-                    continue
-                else:
-                    self.fp5file.logging.error("incomplete parsing block data")
-                    break
+        block_positions = sorted((block_id_to_block_pos[order[block_order_pos]], block_order_pos)
+                                 for block_order_pos in range(order_pos, self.length))
 
-            if cursor != data_len:
-                print("Parsing incomplete: expected: %d got: %d" % (cursor, data_len))
+        pending_blocks = {}
+        next_order_pos = order_pos
 
-                raise Exception("Parsing incomplete")
+        run_start = 0
 
-            is_first_block = False
+        while run_start < len(block_positions):
+            run_pos = block_positions[run_start][0]
+            run_end = run_start + 1
 
-            if current_block_order_pos < self.length:
-                current_block_order_pos += 1
-                current_block_id = order[current_block_order_pos]
-                current_block_file_pos = block_id_to_block_pos[current_block_id]
-            else:
-                block_chain_end_reached = True
+            while run_end < len(block_positions) and run_end - run_start < MAX_RUN_BLOCKS and \
+                    block_positions[run_end][0] == run_pos + (run_end - run_start) * 0x400:
+                run_end += 1
 
-    def get_first_block_ref(self):
-        self.fp5file.file.seek(self.first_block_pos + 0x0E)
+            run_data = source.read(run_pos, (run_end - run_start) * 0x400)
+
+            for (block_pos, block_order_pos) in block_positions[run_start:run_end]:
+                data_start = block_pos - run_pos + 0x0E
+
+                pending_blocks[block_order_pos] = run_data[data_start:data_start + lengths[block_pos >> 10]]
+
+            source.consumed(run_pos, (run_end - run_start) * 0x400)
+
+            while next_order_pos in pending_blocks:
+                block_id = order[next_order_pos]
+
+                yield (next_order_pos, block_id, block_id_to_block_pos[block_id], pending_blocks.pop(next_order_pos))
+
+                next_order_pos += 1
+
+            run_start = run_end
 
-        data = self.fp5file.file.read(6)
+    def blocks(self, order_pos=0, scan_order='chain'):
+        """Same as read_blocks (or read_blocks_physical for `scan_order` 'physical'), but reads ahead on a
+        background thread if the file has a prefetch depth."""
+
+        if scan_order == 'physical':
+            blocks = self.read_blocks_physical(order_pos)
+        elif scan_order == 'chain':
+            blocks = self.read_blocks(order_pos)
+        else:
+            raise ValueError("unknown scan order %r" % scan_order)
+
+        if self.fp5file.prefetch_depth <= 0:
+            yield from blocks
+
+            return
+
+        prefetcher = BlockPrefetcher(self.fp5file, blocks, self.fp5file.prefetch_depth)
+
+        try:
+            yield from prefetcher
+        finally:
+            prefetcher.close()
+
+    def get_first_block_ref(self):
+        data = self.fp5file.source.read(self.first_block_pos + 0x0E, 6)
 
         if data.startswith(b'\x00\x04'):
             return int.from_bytes(data[2:], byteorder='big')
@@ -505,11 +973,12 @@ class BlockChain(object):
         return None
 
     def order_blocks(self):
-        file = self.fp5file.file
+        directory = self.fp5file.directory
 
         block_id_to_block_pos = self.fp5file.block_id_to_block_pos
 
         self.order = array('I', b'\x00\x00\x00\x00' * self.length)
+        self.block_id_to_order_pos = array('I', b'\x00\x00\x00\x00' * (self.fp5file.largest_block_id + 1))
 
         order_pos = 0
 
@@ -528,12 +997,10 @@ class BlockChain(object):
                 else:
                     block_pos = self.fp5file.block_prev_id_to_block_pos[current_block__prev_id]
 
-                file.seek(block_pos + 6)
-                current_block__next_id = struct.unpack_from(">I", file.read(4))[0]
+                current_block__next_id = directory.next_id[block_pos >> 10]
 
                 if current_block__next_id != 0x00000000:
-                    file.seek(self.fp5file.block_prev_id_to_block_pos[next_block__prev_id] + 2)
-                    next_block__prev_id = struct.unpack_from(">I", file.read(4))[0]
+                    next_block__prev_id = directory.prev_id[self.fp5file.block_prev_id_to_block_pos[next_block__prev_id] >> 10]
                 else:
                     next_block__prev_id = None
 
@@ -550,6 +1017,7 @@ class BlockChain(object):
                     print("duplicate block_id to block_pos %r -> %r" % (current_block__id, block_pos))
 
                 self.order[order_pos] = current_block__id
+                self.block_id_to_order_pos[current_block__id] = order_pos
 
                 order_pos += 1
 
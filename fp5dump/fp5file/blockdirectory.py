@@ -0,0 +1,86 @@
+import struct
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if numpy is not None:
+    BLOCK_HEADER_DTYPE = numpy.dtype({'names': ['deleted_flag', 'level', 'prev_id', 'next_id', 'skip_bytes', 'length'],
+                                      'formats': ['u1', 'u1', '>u4', '>u4', '>u2', '>u2'],
+                                      'offsets': [0x00, 0x01, 0x02, 0x06, 0x0A, 0x0C],
+                                      'itemsize': 0x400})
+
+BLOCK_HEADER_SCAN_CHUNK_SIZE = 0x400 * 0x4000
+
+
+class BlockDirectory(object):
+    """The header fields of every block in the file, read once and indexed by `block_pos >> 10`."""
+
+    fields = ('deleted_flag', 'level', 'prev_id', 'next_id', 'skip_bytes', 'length')
+
+    def __init__(self, source, file_size):
+        super(BlockDirectory, self).__init__()
+
+        self.block_count = file_size // 0x400
+
+        self.deleted_flag = array('B', bytes(self.block_count))
+        self.level = array('B', bytes(self.block_count))
+        self.prev_id = array('I', bytes(4 * self.block_count))
+        self.next_id = array('I', bytes(4 * self.block_count))
+        self.skip_bytes = array('H', bytes(2 * self.block_count))
+        self.length = array('H', bytes(2 * self.block_count))
+
+        if numpy is not None:
+            self.read_headers_vectorized(source, file_size)
+        else:
+            self.read_headers(source, file_size)
+
+    @staticmethod
+    def from_columns(columns):
+        """Creates a directory from previously read columns, e.g. arrays restored from a cache file."""
+
+        directory = BlockDirectory.__new__(BlockDirectory)
+        directory.block_count = len(columns['level'])
+
+        for field in BlockDirectory.fields:
+            setattr(directory, field, columns[field])
+
+        return directory
+
+    def read_headers(self, source, file_size):
+        """Decodes the headers from the root block on, BLOCK_HEADER_SCAN_CHUNK_SIZE bytes at a time."""
+
+        for chunk_pos in range(0x800, file_size, BLOCK_HEADER_SCAN_CHUNK_SIZE):
+            chunk = source.view(chunk_pos, min(BLOCK_HEADER_SCAN_CHUNK_SIZE, file_size - chunk_pos))
+
+            first_slot = chunk_pos >> 10
+            last_slot = first_slot + len(chunk) // 0x400
+
+            for (field, values) in zip(self.fields, zip(*struct.iter_unpack(">BBIIHH1010x", chunk))):
+                column = getattr(self, field)
+                column[first_slot:last_slot] = array(column.typecode, values)
+
+            source.consumed(chunk_pos, len(chunk))
+
+    def read_headers_vectorized(self, source, file_size):
+        """Same as read_headers, but decodes each chunk through a strided numpy view."""
+
+        columns = [(field, self.as_numpy(field)) for field in self.fields]
+
+        for chunk_pos in range(0x800, file_size, BLOCK_HEADER_SCAN_CHUNK_SIZE):
+            headers = numpy.frombuffer(source.view(chunk_pos, min(BLOCK_HEADER_SCAN_CHUNK_SIZE, file_size - chunk_pos)),
+                                       dtype=BLOCK_HEADER_DTYPE)
+
+            first_slot = chunk_pos >> 10
+
+            for (field, column) in columns:
+                column[first_slot:first_slot + len(headers)] = headers[field]
+
+            source.consumed(chunk_pos, len(headers) * 0x400)
+
+    def as_numpy(self, field):
+        column = getattr(self, field)
+
+        return numpy.frombuffer(column, dtype=column.typecode)
@@ -0,0 +1,85 @@
+import logging
+import queue
+import threading
+import time
+
+
+class BlockPrefetcher(object):
+    """Runs a block generator of a block chain (e.g. BlockChain.read_blocks) on a background thread.
+
+    Up to `depth` blocks are read ahead into a bounded queue while the consumer parses the current one.
+    `waits` counts how often the consumer found the queue empty and had to wait for the read."""
+
+    def __init__(self, fp5file, blocks, depth):
+        super(BlockPrefetcher, self).__init__()
+
+        self.logging = logging.getLogger('fp5dump.fp5file.blockprefetcher')
+
+        self.fp5file = fp5file
+        self.blocks_to_read = blocks
+
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+
+        self.blocks = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+        self.thread = threading.Thread(target=self.read_blocks, name="fp5dump-prefetch", daemon=True)
+        self.thread.start()
+
+    def read_blocks(self):
+        try:
+            for block in self.blocks_to_read:
+                if self.stopped.is_set():
+                    return
+
+                self.queue.put(block)
+        except Exception as e:
+            if not self.stopped.is_set():
+                self.queue.put(e)
+
+            return
+
+        if not self.stopped.is_set():
+            self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            try:
+                block = self.queue.get_nowait()
+            except queue.Empty:
+                self.waits += 1
+
+                wait_start = time.perf_counter()
+                block = self.queue.get()
+                self.wait_time += time.perf_counter() - wait_start
+
+            if block is None:
+                return
+
+            if isinstance(block, Exception):
+                raise block
+
+            self.blocks += 1
+
+            yield block
+
+    def close(self):
+        self.stopped.set()
+
+        # unblock the reader if it waits for free space, it stops before putting another block
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+        self.thread.join()
+
+        fp5file = self.fp5file
+        fp5file.prefetched_blocks += self.blocks
+        fp5file.prefetch_waits += self.waits
+        fp5file.prefetch_wait_time += self.wait_time
+
+        self.logging.debug("prefetched %d blocks, waited %d times for %.3fs" % (self.blocks, self.waits, self.wait_time))
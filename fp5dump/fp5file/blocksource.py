@@ -0,0 +1,446 @@
+import mmap
+import os
+import struct
+import sys
+import tarfile
+import threading
+import zipfile
+
+try:
+    import pyzstd
+except ImportError:
+    pyzstd = None
+
+# shorter ranges are cheaper to copy through a buffered write than with a syscall of their own
+KERNEL_COPY_MIN_LENGTH = 0x4000
+
+# how the page cache is used: default leaves it to the kernel, sequential announces the access pattern and
+# reads ahead, drop-behind additionally evicts ranges once they have been read
+IO_POLICIES = ('default', 'sequential', 'drop-behind')
+
+
+def fadvise(file, offset, length, advice):
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(file.fileno(), offset, length, getattr(os, advice))
+        except OSError:
+            pass
+
+
+def memory_footprint():
+    """Returns the resident set size of the process and the size of the page cache in kB, None if unknown."""
+
+    footprint = {"rss": None, "cached": None}
+
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    footprint["rss"] = int(line.split()[1])
+
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("Cached:"):
+                    footprint["cached"] = int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return footprint
+
+
+def kernel_copy(in_file, offset, length, out_file):
+    """Copies `length` bytes at `offset` of `in_file` to the current position of `out_file` inside the kernel.
+
+    Returns the number of bytes copied, which is less than `length` if neither copy_file_range() nor
+    sendfile() could be used for the files."""
+
+    try:
+        out_fd = out_file.fileno()
+    except (OSError, ValueError):
+        return 0
+
+    out_file.flush()
+
+    copied = 0
+
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+
+        try:
+            while copied < length:
+                if method == 'copy_file_range':
+                    count = os.copy_file_range(in_file.fileno(), out_fd, length - copied, offset + copied)
+                else:
+                    count = os.sendfile(out_fd, in_file.fileno(), offset + copied, length - copied)
+
+                if count == 0:
+                    break
+
+                copied += count
+        except OSError:
+            continue
+
+        break
+
+    return copied
+
+
+class FileBlockSource(object):
+    """Reads block data with positional reads from an unbuffered file handle.
+
+    os.pread() leaves the file offset alone, so any number of threads may read concurrently. Where it is
+    not available seek() + read() are serialized with a lock."""
+
+    local_file = True
+    in_memory = False
+
+    def __init__(self, filename, io_policy='default'):
+        super(FileBlockSource, self).__init__()
+
+        self.filename = filename
+        self.file = open(filename, "rb", buffering=0)
+        self.size = os.fstat(self.file.fileno()).st_size
+
+        self.lock = threading.Lock()
+
+        self.io_policy = io_policy
+
+        if self.io_policy != 'default':
+            fadvise(self.file, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+
+    def read(self, offset, length):
+        if hasattr(os, 'pread'):
+            data = os.pread(self.file.fileno(), length, offset)
+
+            # pread may return less than requested, e.g. when interrupted by a signal
+            while len(data) < length and offset + len(data) < self.size:
+                chunk = os.pread(self.file.fileno(), length - len(data), offset + len(data))
+
+                if not chunk:
+                    break
+
+                data += chunk
+
+            return data
+
+        with self.lock:
+            self.file.seek(offset)
+
+            return self.file.read(length)
+
+    def view(self, offset, length):
+        return memoryview(self.read(offset, length))
+
+    def unpack_from(self, fmt, offset):
+        return struct.unpack(fmt, self.read(offset, struct.calcsize(fmt)))
+
+    def copy_to(self, file, offset, length):
+        """Writes `length` bytes at `offset` to `file`, without copying them through python where possible."""
+
+        copied = kernel_copy(self.file, offset, length, file) if length >= KERNEL_COPY_MIN_LENGTH else 0
+
+        if copied < length:
+            file.write(self.view(offset + copied, length - copied))
+
+    def will_need(self, offset, length):
+        """Hints that the range is read soon."""
+
+        if self.io_policy != 'default':
+            fadvise(self.file, offset, length, 'POSIX_FADV_WILLNEED')
+
+    def consumed(self, offset, length):
+        """Hints that the range has been read and is not needed again."""
+
+        if self.io_policy == 'drop-behind':
+            fadvise(self.file, offset, length, 'POSIX_FADV_DONTNEED')
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class MmapBlockSource(object):
+    """Reads block data from a read-only memory map of the file.
+
+    Header probes are decoded directly from the mapping and `view()` hands out
+    memoryview slices without copying, so no syscall is issued per block."""
+
+    local_file = True
+    in_memory = False
+
+    def __init__(self, filename, io_policy='default'):
+        super(MmapBlockSource, self).__init__()
+
+        self.filename = filename
+        self.file = open(filename, "rb", buffering=0)
+        self.size = os.fstat(self.file.fileno()).st_size
+
+        try:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            self.file.close()
+            raise
+
+        self.memoryview = memoryview(self.mmap)
+
+        self.io_policy = io_policy
+
+        if self.io_policy != 'default':
+            fadvise(self.file, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+            self.madvise(0, self.size, 'MADV_SEQUENTIAL')
+
+    def madvise(self, offset, length, advice):
+        if hasattr(self.mmap, 'madvise') and hasattr(mmap, advice) and length > 0:
+            try:
+                self.mmap.madvise(getattr(mmap, advice), offset, length)
+            except (OSError, ValueError):
+                pass
+
+    def read(self, offset, length):
+        return self.mmap[offset:offset + length]
+
+    def view(self, offset, length):
+        return self.memoryview[offset:offset + length]
+
+    def unpack_from(self, fmt, offset):
+        return struct.unpack_from(fmt, self.mmap, offset)
+
+    def copy_to(self, file, offset, length):
+        """Writes `length` bytes at `offset` to `file`, without copying them through python where possible."""
+
+        copied = kernel_copy(self.file, offset, length, file) if length >= KERNEL_COPY_MIN_LENGTH else 0
+
+        if copied < length:
+            file.write(self.view(offset + copied, length - copied))
+
+    def will_need(self, offset, length):
+        """Hints that the range is read soon."""
+
+        if self.io_policy != 'default':
+            page_start = offset - offset % mmap.PAGESIZE
+
+            self.madvise(page_start, offset + length - page_start, 'MADV_WILLNEED')
+
+    def consumed(self, offset, length):
+        """Hints that the range has been read and is not needed again.
+
+        Only whole pages are released, so blocks sharing a page with the range stay mapped."""
+
+        if self.io_policy == 'drop-behind':
+            page_start = -(-offset // mmap.PAGESIZE) * mmap.PAGESIZE
+            page_end = (offset + length) // mmap.PAGESIZE * mmap.PAGESIZE
+
+            if page_end > page_start:
+                self.madvise(page_start, page_end - page_start, 'MADV_DONTNEED')
+                fadvise(self.file, page_start, page_end - page_start, 'POSIX_FADV_DONTNEED')
+
+    def close(self):
+        if self.mmap:
+            try:
+                self.memoryview.release()
+                self.mmap.close()
+            except BufferError:
+                # views handed out by view() are still alive, the mapping is freed with them
+                pass
+
+            self.mmap = None
+            self.file.close()
+
+
+class BytesBlockSource(object):
+    """Reads block data from a bytes-like object held in memory."""
+
+    local_file = False
+    # the whole file is held in memory, e.g. an archive member decompressed when it was opened
+    in_memory = True
+
+    def __init__(self, data, name='<memory>'):
+        super(BytesBlockSource, self).__init__()
+
+        self.filename = name
+        self.data = data
+        self.memoryview = memoryview(data)
+        self.size = len(self.memoryview)
+
+    def read(self, offset, length):
+        return bytes(self.memoryview[offset:offset + length])
+
+    def view(self, offset, length):
+        return self.memoryview[offset:offset + length]
+
+    def unpack_from(self, fmt, offset):
+        return struct.unpack_from(fmt, self.memoryview, offset)
+
+    def copy_to(self, file, offset, length):
+        file.write(self.view(offset, length))
+
+    def will_need(self, offset, length):
+        pass
+
+    def consumed(self, offset, length):
+        pass
+
+    def close(self):
+        self.data = None
+
+
+class WindowBlockSource(object):
+    """Reads block data from the range `offset` to `offset + size` of another source.
+
+    Used for members stored uncompressed inside an archive, which can be read in place."""
+
+    local_file = False
+    in_memory = False
+
+    def __init__(self, source, offset, size, name):
+        super(WindowBlockSource, self).__init__()
+
+        if offset + size > source.size:
+            raise ValueError("%s exceeds the size of %s" % (name, source.filename))
+
+        self.filename = name
+        self.source = source
+        self.offset = offset
+        self.size = size
+
+    def read(self, offset, length):
+        return self.source.read(self.offset + offset, max(0, min(length, self.size - offset)))
+
+    def view(self, offset, length):
+        return self.source.view(self.offset + offset, max(0, min(length, self.size - offset)))
+
+    def unpack_from(self, fmt, offset):
+        if offset + struct.calcsize(fmt) > self.size:
+            raise struct.error("unpack_from requires a buffer of at least %d bytes" % (offset + struct.calcsize(fmt)))
+
+        return self.source.unpack_from(fmt, self.offset + offset)
+
+    def copy_to(self, file, offset, length):
+        self.source.copy_to(file, self.offset + offset, max(0, min(length, self.size - offset)))
+
+    def will_need(self, offset, length):
+        self.source.will_need(self.offset + offset, length)
+
+    def consumed(self, offset, length):
+        self.source.consumed(self.offset + offset, length)
+
+    def close(self):
+        self.source.close()
+
+
+class ZstdBlockSource(object):
+    """Reads block data from a file compressed in the seekable zstd format, using pyzstd."""
+
+    local_file = False
+    in_memory = False
+
+    def __init__(self, filename):
+        super(ZstdBlockSource, self).__init__()
+
+        if pyzstd is None:
+            raise ImportError("reading zstd compressed files requires pyzstd")
+
+        self.filename = filename
+        self.file = pyzstd.SeekableZstdFile(filename, "r")
+        self.size = self.file.seek(0, os.SEEK_END)
+
+        self.lock = threading.Lock()
+
+    def read(self, offset, length):
+        with self.lock:
+            self.file.seek(offset)
+
+            return self.file.read(length)
+
+    def view(self, offset, length):
+        return memoryview(self.read(offset, length))
+
+    def unpack_from(self, fmt, offset):
+        return struct.unpack(fmt, self.read(offset, struct.calcsize(fmt)))
+
+    def copy_to(self, file, offset, length):
+        file.write(self.view(offset, length))
+
+    def will_need(self, offset, length):
+        pass
+
+    def consumed(self, offset, length):
+        pass
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def open_archive_member(filename, member, use_mmap=True, io_policy='default'):
+    """Returns a source for `member` of the zip or tar archive `filename`.
+
+    Members stored without compression are read in place, all others are decompressed into memory."""
+
+    name = "%s:%s" % (filename, member)
+
+    if zipfile.is_zipfile(filename):
+        with zipfile.ZipFile(filename) as archive:
+            info = archive.getinfo(member)
+
+            if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x01:
+                source = open_block_source(filename, use_mmap, io_policy)
+
+                # the local header may carry a different extra field than the central directory
+                (name_length, extra_length) = source.unpack_from("<HH", info.header_offset + 26)
+
+                return WindowBlockSource(source, info.header_offset + 30 + name_length + extra_length,
+                                         info.file_size, name)
+
+            return BytesBlockSource(archive.read(info), name)
+
+    if tarfile.is_tarfile(filename):
+        try:
+            archive = tarfile.open(filename, "r:")
+            compressed = False
+        except tarfile.ReadError:
+            archive = tarfile.open(filename)
+            compressed = True
+
+        with archive:
+            info = archive.getmember(member)
+
+            if not info.isfile():
+                raise ValueError("%s is not a regular file" % name)
+
+            if not compressed and not info.issparse():
+                return WindowBlockSource(open_block_source(filename, use_mmap, io_policy), info.offset_data, info.size, name)
+
+            return BytesBlockSource(archive.extractfile(info).read(), name)
+
+    raise ValueError("%s is neither a zip nor a tar archive" % filename)
+
+
+def open_block_source(filename, use_mmap=True, io_policy='default', member=None):
+    """Returns a source for `filename`.
+
+    `-` reads from stdin, `member` selects a file inside a zip or tar archive and `.zst` files are read
+    as seekable zstd. Local files are memory-mapped, falling back to unbuffered reads."""
+
+    if io_policy not in IO_POLICIES:
+        raise ValueError("unknown io policy %r" % io_policy)
+
+    if filename == '-':
+        return BytesBlockSource(sys.stdin.buffer.read(), '<stdin>')
+
+    if member is not None:
+        return open_archive_member(filename, member, use_mmap, io_policy)
+
+    if filename.endswith('.zst'):
+        return ZstdBlockSource(filename)
+
+    if use_mmap:
+        try:
+            return MmapBlockSource(filename, io_policy)
+        except (ValueError, OSError):
+            pass
+
+    return FileBlockSource(filename, io_policy)
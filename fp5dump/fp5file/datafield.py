@@ -18,6 +18,10 @@ class DataField(object):
         self.indexed = False
 
     def __getattr__(self, attribute):
+        # lets pickle tell that there is no __setstate__ and the like, fields are sent to worker processes
+        if attribute.startswith('__'):
+            raise AttributeError(attribute)
+
         if attribute == "typename":
             if self.type == 1:
                 return "TEXT"
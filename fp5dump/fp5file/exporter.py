@@ -1,23 +1,99 @@
+from abc import ABCMeta, abstractmethod
+from bisect import bisect_left, bisect_right
 from collections import OrderedDict, deque
+import multiprocessing
+import queue
 import sys
 import logging
 import time
 import locale
+import traceback
 import parsedatetime as pdt
 
+from .blockchain import encode_vli
+from .sharedring import BATCH_END, RING_POLL_INTERVAL, SharedRecordRing, shared_memory
 
-class Exporter(object):
+# the records are split into at least this many partitions per worker process, so all of them stay busy until the end
+PARTITIONS_PER_JOB = 4
+
+# and into partitions of at most about this many data blocks, which bounds the encoded records held per partition
+PARTITION_BLOCKS = 1024
+
+# the attributes of the fp5 file an export definition may set after it was opened, copied to the worker processes
+WORKER_FP5FILE_ATTRIBUTES = ('locale', 'encoding', 'db_name')
+
+# the exporter of a worker process, see Exporter.encoded_partitions
+worker_exporter = None
+
+
+def open_worker_exporter(exporter, fp5file_class, open_args, fp5file_attributes):
+    """Initializes a worker process of Exporter.encoded_partitions, the fp5 file is opened again for `exporter`
+    and given the `fp5file_attributes` of the fp5 file of the parent process."""
+
+    global worker_exporter
+
+    exporter.fp5file = fp5file_class(**open_args)
+
+    for (name, value) in fp5file_attributes.items():
+        setattr(exporter.fp5file, name, value)
+
+    exporter.set_locale()
+
+    worker_exporter = exporter
+
+
+def encode_partition(partition):
+    """Encodes the records of `partition` in a worker process of a pool.
+
+    Returns the encoded records together with the sampled errors and the fields with values found in them."""
+
+    exporter = worker_exporter
+    exporter.start_partition()
+
+    encoded_records = list(exporter.encode_records(exporter.records(partition)))
+
+    return (encoded_records, exporter.sampled_error_calls, exporter.table_fields_present)
+
+
+def encode_partitions(exporter, fp5file_class, open_args, fp5file_attributes, partitions, ring, results):
+    """Runs a worker process that encodes `partitions` one after the other and sends the records through `ring`
+    (a SharedRecordRing). The sampled errors and fields with values of every partition are put into `results`,
+    or the traceback if encoding failed."""
+
+    try:
+        open_worker_exporter(exporter, fp5file_class, open_args, fp5file_attributes)
+
+        for partition in partitions:
+            exporter.start_partition()
+
+            for encoded_record in exporter.encode_records(exporter.records(partition)):
+                ring.put(encoded_record)
+
+            ring.send(BATCH_END)
+
+            results.put((exporter.sampled_error_calls, exporter.table_fields_present))
+    except Exception:
+        results.put(traceback.format_exc())
+
+        ring.send_error()
+
+
+class Exporter(object, metaclass=ABCMeta):
     def __init__(self, fp5file, export_definition,
-                 first_record_to_process=None, table_name=None, show_progress=False, drop_empty_columns=False):
+                 first_record_to_process=None, last_record_to_process=None, table_name=None, show_progress=False,
+                 drop_empty_columns=False, scan_order='chain', jobs=1):
 
         super(Exporter, self).__init__()
 
         self.fp5file = fp5file
         self.export_definition = export_definition
         self.first_record_to_process = first_record_to_process
+        self.last_record_to_process = last_record_to_process
         self.table_name = table_name
         self.show_progress = show_progress
         self.drop_empty_columns = drop_empty_columns
+        self.scan_order = scan_order
+        self.jobs = jobs
 
         self.logging = logging.getLogger('fp5dump.fp5file.fp5file')
 
@@ -38,10 +114,22 @@ class Exporter(object):
         self.records_to_process_count = 0
 
         self.sampled_errors_for_fields = OrderedDict()
+        self.table_fields_present = set()
+
+        # the calls of aggregate_errors that sampled an error, recorded in worker processes only
+        self.sampled_error_calls = None
 
         self.decimal_point_char = b'.'[0]
         self.thousands_separator_char = b','[0]
 
+        # bounds that cannot be record ids are rejected before anything is written
+        self.record_range()
+
+        if self.drop_empty_columns and self.is_slice():
+            self.logging.warning("not dropping empty columns, other slices of the records may fill them")
+
+            self.drop_empty_columns = False
+
     def set_locale(self):
         if not self.fp5file.locale:
             time_locale = locale.getlocale(locale.LC_TIME)
@@ -64,7 +152,198 @@ class Exporter(object):
 
             self.ptd_parser = pdt.Calendar(pdt.Constants(time_locale))
         except locale.Error:
-            self.logging.warn("could not set locale to '%s'" % self.fp5file.locale)
+            self.logging.warn("could not set locale to '%s'" % (self.fp5file.locale,))
+
+    def __getstate__(self):
+        # a worker process opens the fp5 file itself, see open_worker_exporter
+        state = self.__dict__.copy()
+        state.update(fp5file=None, ptd_parser=None)
+
+        return state
+
+    def is_slice(self):
+        """Returns whether only a range of the records is exported. The table then holds the records of other
+        slices as well, so it is not dropped before they are inserted."""
+
+        return self.first_record_to_process is not None or self.last_record_to_process is not None
+
+    def record_range(self):
+        """Returns the paths of the first record to export and of the one following the last, each None if the
+        records are not bounded on that side. Raises a ValueError if a bound cannot be the id of a record."""
+
+        for record_id in (self.first_record_to_process, self.last_record_to_process):
+            if record_id is not None and encode_vli(record_id) is None:
+                raise ValueError("record id %r is out of range" % record_id)
+
+        if self.first_record_to_process is not None:
+            start_node_path = [b'\x05', encode_vli(self.first_record_to_process)]
+        else:
+            start_node_path = None
+
+        # no record follows the largest id there can be
+        if self.last_record_to_process is not None and encode_vli(self.last_record_to_process + 1) is not None:
+            stop_node_path = [b'\x05', encode_vli(self.last_record_to_process + 1)]
+        else:
+            stop_node_path = None
+
+        return (start_node_path, stop_node_path)
+
+    def count_records_to_process(self):
+        """Returns the number of records of the file between first_record_to_process and last_record_to_process."""
+
+        records_index = self.fp5file.records_index
+
+        if self.first_record_to_process is not None:
+            first_index = bisect_left(records_index, self.first_record_to_process)
+        else:
+            first_index = 0
+
+        if self.last_record_to_process is not None:
+            stop_index = bisect_right(records_index, self.last_record_to_process)
+        else:
+            stop_index = len(records_index)
+
+        return max(0, stop_index - first_index)
+
+    def records(self, partition=None):
+        """Returns an iterator over the records to export as tuples of (record_id_bin, record_tokens), over the
+        records of `partition` (a RecordPartition) only if given. The iterator stops after the last record to
+        export, the blocks following it are not read."""
+
+        token_ids_to_return = set(self.export_definition.keys())
+
+        if partition is not None:
+            # a partition is read following the chain, a sweep through the file would read far beyond its end
+            return self.fp5file.data.sub_nodes(b'\x05', start_node_path=partition.start_node_path,
+                                               token_ids_to_return=token_ids_to_return,
+                                               stop_node_path=partition.stop_node_path,
+                                               start_block_id=partition.first_block_id)
+
+        (start_node_path, stop_node_path) = self.record_range()
+
+        return self.fp5file.data.sub_nodes(b'\x05', start_node_path=start_node_path, token_ids_to_return=token_ids_to_return,
+                                           scan_order=self.scan_order, stop_node_path=stop_node_path)
+
+    @abstractmethod
+    def encode_records(self, records):
+        """A generator that yields the bytes of every record of `records`, as written by `run`."""
+
+    def start_partition(self):
+        self.sampled_errors_for_fields = OrderedDict()
+        self.sampled_error_calls = []
+        self.table_fields_present = set()
+
+    def use_workers(self):
+        if self.jobs <= 1:
+            return False
+
+        if self.fp5file.open_args is None:
+            self.logging.warning("using a single process, \"%s\" cannot be opened again by the workers" % self.fp5file.filename)
+
+            return False
+
+        if self.fp5file.source.in_memory:
+            self.logging.warning("using a single process, every worker would hold \"%s\" in memory again" % self.fp5file.source.filename)
+
+            return False
+
+        return True
+
+    def worker_open_args(self):
+        """Returns the arguments a worker process opens the fp5 file with and the attributes it then copies, see
+        open_worker_exporter. The labels of the fields are decoded while opening, so the current encoding is
+        passed on as well."""
+
+        open_args = dict(self.fp5file.open_args, encoding=self.fp5file.encoding)
+        fp5file_attributes = dict((name, getattr(self.fp5file, name)) for name in WORKER_FP5FILE_ATTRIBUTES)
+
+        return (open_args, fp5file_attributes)
+
+    def encoded_partitions(self):
+        """A generator that encodes the records on `jobs` worker processes, each opens the fp5 file itself.
+
+        Yields an iterable over the encoded records of every partition (see FP5File.partition_records) in
+        record order, it has to be consumed before the next one is requested. The errors and the fields with
+        values the workers found are merged into this exporter."""
+
+        (start_node_path, stop_node_path) = self.record_range()
+
+        partition_count = max(self.jobs * PARTITIONS_PER_JOB, self.fp5file.data.length // PARTITION_BLOCKS)
+        partitions = self.fp5file.partition_records(partition_count, start_node_path=start_node_path,
+                                                    stop_node_path=stop_node_path)
+
+        self.logging.info("encoding %d partitions of records on %d processes" % (len(partitions), self.jobs))
+
+        if shared_memory is None:
+            for (encoded_records, sampled_error_calls, table_fields_present) in self.encoded_partitions_pickled(partitions):
+                self.merge_partition(sampled_error_calls, table_fields_present)
+
+                yield encoded_records
+
+            return
+
+        (open_args, fp5file_attributes) = self.worker_open_args()
+
+        rings = []
+        workers = []
+
+        try:
+            # the partitions are dealt out in turn, so the records of every worker arrive in the order they are needed
+            for job in range(self.jobs):
+                ring = SharedRecordRing()
+                rings.append(ring)
+
+                results = multiprocessing.Queue()
+                worker = multiprocessing.Process(target=encode_partitions, name="fp5dump-encode-%d" % job, daemon=True,
+                                                 args=(self, type(self.fp5file), open_args, fp5file_attributes,
+                                                       partitions[job::self.jobs], ring, results))
+                worker.start()
+                workers.append((worker, results))
+
+            for partition_index in range(len(partitions)):
+                ring = rings[partition_index % self.jobs]
+                (worker, results) = workers[partition_index % self.jobs]
+
+                yield ring.receive(worker)
+
+                while True:
+                    try:
+                        result = results.get(timeout=RING_POLL_INTERVAL)
+                        break
+                    except queue.Empty:
+                        if not worker.is_alive():
+                            raise Exception("worker process %s exited with code %s" % (worker.name, worker.exitcode))
+
+                if type(result) is str:
+                    raise Exception("worker process %s failed:\n%s" % (worker.name, result))
+
+                self.merge_partition(*result)
+        finally:
+            for (worker, results) in workers:
+                if worker.is_alive():
+                    worker.terminate()
+
+                worker.join()
+
+            for ring in rings:
+                ring.unlink()
+
+    def encoded_partitions_pickled(self, partitions):
+        """Same as encoded_partitions, but returns the encoded records from a process pool, for Pythons without
+        multiprocessing.shared_memory."""
+
+        (open_args, fp5file_attributes) = self.worker_open_args()
+
+        with multiprocessing.Pool(self.jobs, initializer=open_worker_exporter,
+                                  initargs=(self, type(self.fp5file), open_args, fp5file_attributes)) as pool:
+            yield from pool.imap(encode_partition, partitions)
+
+    def merge_partition(self, sampled_error_calls, table_fields_present):
+        # replayed in record order, the same errors are sampled as in a single process
+        for (field_id_bin, record_id, error_value) in sampled_error_calls:
+            self.aggregate_errors(field_id_bin, record_id, error_value)
+
+        self.table_fields_present |= table_fields_present
 
     @staticmethod
     def reset_locale():
@@ -77,6 +356,9 @@ class Exporter(object):
         if len(self.sampled_errors_for_fields[field_id_bin]) < 100:
             self.sampled_errors_for_fields[field_id_bin][record_id] = error_value
 
+            if self.sampled_error_calls is not None:
+                self.sampled_error_calls.append((field_id_bin, record_id, error_value))
+
     def format_errors(self):
         error_texts = []
 
@@ -2,33 +2,74 @@ from collections import namedtuple, OrderedDict
 import locale
 import os
 import re
-import struct
 import logging
 import sys
+import threading
 import yaml
 import codecs
 import yaml.constructor
 
 from array import array
+from io import BytesIO
 import parsedatetime as pdt
 from binascii import hexlify, unhexlify
 
-from .block import Block
-from .blockchain import BlockChain, decode_vli
+from .blockcache import BlockCache
+from .blockchain import MAX_COPY_RUN_BLOCKS, BlockChain, decode_vli, encode_vli, prefix_path, split_field_and_sub_ref
+from .blockdirectory import BlockDirectory
+from .blocksource import memory_footprint, open_block_source
+from .indextree import IndexTree
+from .recordview import RecordView, split_records
+from .sidecarcache import SidecarCache
 from .datafield import DataField
 
 from .psqlexporter import PsqlExporter
 from .postgresexporter import PostgresExporter
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the number of data blocks get_record keeps split into records
+RECORD_BLOCK_CACHE_SIZE = 256
+
 
 class FP5File(object):
     """Wrapper for FP5 file object"""
 
-    def __init__(self, filename, encoding=None, locale=None):
+    def __init__(self, filename, encoding=None, locale=None, use_mmap=True, cache_dir=None,
+                 cache_size_limit=1024 * 1024 * 1024, prefetch_depth=0, io_policy='default', member=None,
+                 source=None, use_block_cache=True):
+        """Opens `filename`, or reads from `source` if given, in which case `filename` only names the outputs.
+
+        `filename` may be `-` for stdin, a `.zst` file in the seekable zstd format or, together with `member`,
+        a zip or tar archive."""
+
         super(FP5File, self).__init__()
 
         self.logging = logging.getLogger('fp5dump.fp5file.fp5file')
 
+        # what a worker process needs to open the file again, a stream or a given source cannot be reopened
+        if source is None and filename != '-':
+            self.open_args = dict(filename=filename, encoding=encoding, locale=locale, use_mmap=use_mmap,
+                                  cache_dir=cache_dir, cache_size_limit=cache_size_limit, prefetch_depth=prefetch_depth,
+                                  io_policy=io_policy, member=member, use_block_cache=use_block_cache)
+        else:
+            self.open_args = None
+
+        if source is None:
+            source = open_block_source(filename if filename == '-' else os.path.abspath(os.path.expanduser(filename)),
+                                       use_mmap=use_mmap, io_policy=io_policy, member=member)
+
+        # outputs are named after the fp5 file, placed next to the archive it was read from
+        if member is not None:
+            filename = os.path.join(os.path.dirname(filename), os.path.basename(member))
+        elif filename == '-':
+            filename = 'stdin'
+        elif filename.endswith('.zst'):
+            filename = filename[:-4]
+
         self.filename = filename
 
         self.locale = locale
@@ -50,6 +91,10 @@ class FP5File(object):
         self.index = None
         self.data = None
 
+        self.index_tree = None
+        self.record_blocks = OrderedDict()
+        self.record_blocks_lock = threading.Lock()
+
         self.enums = []
 
         self.file_size = 0
@@ -61,21 +106,49 @@ class FP5File(object):
         self.filename_string = ""
         self.server_addr_string = ""
 
+        self.prefetch_depth = prefetch_depth
+        self.prefetched_blocks = 0
+        self.prefetch_waits = 0
+        self.prefetch_wait_time = 0.0
+
+        self.block_runs = 0
+        self.block_run_blocks = 0
+
+        self.directory = None
+        self.block_cache = None
         self.block_prev_id_to_block_pos = None
         self.block_id_to_block_pos = None
 
         self.logging.info('opening "%s"' % self.basename)
 
-        self.file = open(os.path.abspath(os.path.expanduser(self.filename)), "rb", buffering=0)
+        self.source = source
+
+        self.logging.debug("reading blocks with %s, io policy %s" % (type(self.source).__name__, io_policy))
+        self.log_memory_footprint()
 
         self.largest_block_id = 0x00000000
 
+        self.cache = None
+
+        if cache_dir and self.source.local_file:
+            self.cache = SidecarCache(cache_dir, cache_size_limit)
+        elif cache_dir:
+            self.logging.info("not caching %s, only local files are cached" % self.source.filename)
+
         self.read_header()
-        self.get_blocks()
-        self.order_block_indices()
 
-        self.get_field_index()
-        self.get_record_index()
+        if not self.cache or not self.cache.load(self):
+            self.get_blocks()
+            self.order_block_indices()
+
+            self.get_field_index()
+            self.get_record_index()
+
+            if self.cache:
+                self.cache.store(self)
+
+        if use_block_cache and self.source.local_file:
+            self.block_cache = BlockCache.open(self, use_mmap=use_mmap, io_policy=io_policy)
 
     def __enter__(self):
         return self
@@ -125,8 +198,28 @@ class FP5File(object):
     def close(self):
         self.logging.info("closing %s" % self.basename)
 
-        if self.file:
-            self.file.close()
+        if self.block_runs:
+            self.logging.info("read %d blocks in %d runs, %.1f blocks per run" % (self.block_run_blocks, self.block_runs, self.block_run_blocks / self.block_runs))
+
+        if self.prefetched_blocks:
+            self.logging.info("prefetched %d blocks, waited for %d of them (%.3fs)" % (self.prefetched_blocks, self.prefetch_waits, self.prefetch_wait_time))
+
+        self.log_memory_footprint()
+
+        if self.source:
+            self.source.close()
+
+        if self.cache:
+            self.cache.close()
+
+        if self.block_cache:
+            self.block_cache.close()
+
+    def log_memory_footprint(self):
+        footprint = memory_footprint()
+
+        if footprint["rss"] is not None and footprint["cached"] is not None:
+            self.logging.info("resident set %d kB, page cache %d kB" % (footprint["rss"], footprint["cached"]))
 
     def read_header(self):
         if not self.read_header_fp5():
@@ -134,33 +227,33 @@ class FP5File(object):
                 self.logging.error("could not read a valid fp5 or fp3 header")
 
     def read_header_fp3(self):
-        self.file_size = os.path.getsize(self.filename)
+        self.file_size = self.source.size
 
         if self.file_size % 0x400 != 0:
             raise Exception("File size is not a multiple of 0x400")
 
-        self.file.seek(0)
-        magic = self.file.read(0x0F)
+        file = BytesIO(self.source.read(0, 0x800))
+        magic = file.read(0x0F)
 
-        unknown1 = self.file.read(0x1F1)
-        unknown2 = self.file.read(0x0D)
-        hbam = self.file.read(0x0D)
-        unknown3 = self.file.read(0x03)
+        unknown1 = file.read(0x1F1)
+        unknown2 = file.read(0x0D)
+        hbam = file.read(0x0D)
+        unknown3 = file.read(0x03)
 
-        version_string_length = int.from_bytes(self.file.read(0x01), byteorder='big')
-        self.version_string = self.file.read(version_string_length)
+        version_string_length = int.from_bytes(file.read(0x01), byteorder='big')
+        self.version_string = file.read(version_string_length)
 
-        unknown4 = self.file.read(0x02)
-        unknown5 = self.file.read(0x1BA - version_string_length)
-        copyright_string = self.file.read(0x26)
+        unknown4 = file.read(0x02)
+        unknown5 = file.read(0x1BA - version_string_length)
+        copyright_string = file.read(0x26)
 
-        filename_string_length = int.from_bytes(self.file.read(0x01), byteorder='big')
-        self.filename_string = self.file.read(filename_string_length)
-        unknown6 = self.file.read(0xFF - filename_string_length)
+        filename_string_length = int.from_bytes(file.read(0x01), byteorder='big')
+        self.filename_string = file.read(filename_string_length)
+        unknown6 = file.read(0xFF - filename_string_length)
 
-        server_addr_string_length = int.from_bytes(self.file.read(0x01), byteorder='big')
-        self.server_addr_string = self.file.read(server_addr_string_length)
-        unknown7 = self.file.read(0x2FF - server_addr_string_length)
+        server_addr_string_length = int.from_bytes(file.read(0x01), byteorder='big')
+        self.server_addr_string = file.read(server_addr_string_length)
+        unknown7 = file.read(0x2FF - server_addr_string_length)
 
         if magic != unhexlify(b'0001000000020001000500020002C0'):
             self.logging.error("unexpected magic number %s" % magic)
@@ -174,34 +267,34 @@ class FP5File(object):
         return True
 
     def read_header_fp5(self):
-        self.file_size = os.path.getsize(self.filename)
+        self.file_size = self.source.size
 
         if self.file_size % 0x400 != 0:
             raise Exception("File size is not a multiple of 0x400")
 
-        self.file.seek(0)
-        magic = self.file.read(0x0F)
+        file = BytesIO(self.source.read(0, 0x800))
+        magic = file.read(0x0F)
 
-        unknown1 = self.file.read(0x1CB)
-        copyright_string = self.file.read(0x25)
-        unknown2 = self.file.read(0x0E)
-        hbam = self.file.read(0x0D)
-        unknown3 = self.file.read(0x03)
+        unknown1 = file.read(0x1CB)
+        copyright_string = file.read(0x25)
+        unknown2 = file.read(0x0E)
+        hbam = file.read(0x0D)
+        unknown3 = file.read(0x03)
 
-        version_string_length = int.from_bytes(self.file.read(0x01), byteorder='big')
-        self.version_string = self.file.read(version_string_length)
-        version_string_padding = self.file.read(0x1E2 - version_string_length)
+        version_string_length = int.from_bytes(file.read(0x01), byteorder='big')
+        self.version_string = file.read(version_string_length)
+        version_string_padding = file.read(0x1E2 - version_string_length)
 
-        filename_string_length = int.from_bytes(self.file.read(0x01), byteorder='big')
-        self.filename_string = self.file.read(filename_string_length)
-        filename_string_padding = self.file.read(0xFF - filename_string_length)
+        filename_string_length = int.from_bytes(file.read(0x01), byteorder='big')
+        self.filename_string = file.read(filename_string_length)
+        filename_string_padding = file.read(0xFF - filename_string_length)
 
-        server_addr_string_length = int.from_bytes(self.file.read(0x01), byteorder='big')
-        self.server_addr_string = self.file.read(server_addr_string_length)
-        server_addr_string_length = self.file.read(0xBF - server_addr_string_length)
+        server_addr_string_length = int.from_bytes(file.read(0x01), byteorder='big')
+        self.server_addr_string = file.read(server_addr_string_length)
+        server_addr_string_length = file.read(0xBF - server_addr_string_length)
 
-        unknown4 = self.file.read(0x0C)
-        unknown5 = self.file.read(0x234)
+        unknown4 = file.read(0x0C)
+        unknown5 = file.read(0x234)
 
         if magic != unhexlify(b'0001000000020001000500020002C0'):
             self.logging.error("unexpected magic number %s" % magic)
@@ -470,50 +563,100 @@ class FP5File(object):
         return export_definition
 
     def get_blocks(self):
-        try:
-            pos = 0x800
+        self.directory = BlockDirectory(self.source, self.file_size)
 
-            (deleted_flag, self.block_chain_levels, prev_id, self.largest_block_id) \
-                = struct.unpack_from(">BBII", self.file.read(0x0A))
+        pos = 0x800
+        slot = pos >> 10
 
-            self.block_prev_id_to_block_pos = array('I', b'\x00\x00\x00\x00' * (self.largest_block_id + 1))
-            self.block_id_to_block_pos = array('I', b'\x00\x00\x00\x00' * (self.largest_block_id + 1))
+        self.block_chain_levels = self.directory.level[slot]
+        self.largest_block_id = self.directory.next_id[slot]
 
-            for i in range(0, self.block_chain_levels + 1):
-                self.block_chains.append(BlockChain(self, i))
+        self.block_prev_id_to_block_pos = array('I', b'\x00\x00\x00\x00' * (self.largest_block_id + 1))
+        self.block_id_to_block_pos = array('I', b'\x00\x00\x00\x00' * (self.largest_block_id + 1))
 
-            self.index = self.block_chains[self.block_chain_levels]
-            self.index.first_block_pos = pos
-            self.index.length = 1
+        for i in range(0, self.block_chain_levels + 1):
+            self.block_chains.append(BlockChain(self, i))
 
-            self.data = self.block_chains[0]
+        self.index = self.block_chains[self.block_chain_levels]
+        self.index.first_block_pos = pos
+        self.index.length = 1
 
-            pos = 0xC00
+        self.data = self.block_chains[0]
 
-            while pos < self.file_size:
-                self.file.seek(pos)
+        if numpy is not None:
+            self.link_blocks_vectorized()
+        else:
+            self.link_blocks()
 
-                (deleted_flag, level, prev_id) = struct.unpack_from(">BBI", self.file.read(0x06))
+        self.logging.info("blocks read")
 
-                if deleted_flag != 0xff:
-                    if prev_id == 0x00000000:
-                        if not self.block_chains[level].first_block_pos:
-                            self.block_chains[level].first_block_pos = pos
-                            self.block_chains[level].length += 1
-                    else:
+    def link_blocks(self):
+        """Finds the first block and the length of every chain and maps prev_ids to block positions."""
+
+        directory = self.directory
+
+        for slot in range(0xC00 >> 10, directory.block_count):
+            if directory.deleted_flag[slot] != 0xff:
+                pos = slot << 10
+                level = directory.level[slot]
+                prev_id = directory.prev_id[slot]
+
+                if prev_id == 0x00000000:
+                    if not self.block_chains[level].first_block_pos:
+                        self.block_chains[level].first_block_pos = pos
                         self.block_chains[level].length += 1
+                else:
+                    self.block_chains[level].length += 1
 
-                        if self.block_prev_id_to_block_pos[prev_id] == 0x00000000:
-                            self.block_prev_id_to_block_pos[prev_id] = pos
-                        else:
-                            self.logging.error("block with duplicate prev_id 0x%08X found for level %d" % (prev_id, level))
+                    if self.block_prev_id_to_block_pos[prev_id] == 0x00000000:
+                        self.block_prev_id_to_block_pos[prev_id] = pos
+                    else:
+                        self.logging.error("block with duplicate prev_id 0x%08X found for level %d" % (prev_id, level))
 
-                pos += 0x400
+    def link_blocks_vectorized(self):
+        """Same as link_blocks, but operates on numpy views of the block directory."""
 
-        except Exception as e:
-            raise e
+        block_prev_id_to_block_pos = numpy.frombuffer(self.block_prev_id_to_block_pos, dtype=numpy.uint32)
 
-        self.logging.info("blocks read")
+        first_slot = 0xC00 >> 10
+
+        levels = self.directory.as_numpy('level')[first_slot:]
+        prev_ids = self.directory.as_numpy('prev_id')[first_slot:]
+        positions = (first_slot + numpy.arange(len(levels), dtype=numpy.int64)) << 10
+
+        not_deleted = self.directory.as_numpy('deleted_flag')[first_slot:] != 0xff
+        first_in_chain = not_deleted & (prev_ids == 0x00000000)
+        linked = not_deleted & (prev_ids != 0x00000000)
+
+        # first block of each chain: the first block of a level without prev_id
+        first_levels, first_indices = numpy.unique(levels[first_in_chain], return_index=True)
+
+        for (level, pos) in zip(first_levels.tolist(), positions[first_in_chain][first_indices].tolist()):
+            if not self.block_chains[level].first_block_pos:
+                self.block_chains[level].first_block_pos = pos
+                self.block_chains[level].length += 1
+
+        for (level, count) in enumerate(numpy.bincount(levels[linked]).tolist()):
+            if count:
+                self.block_chains[level].length += count
+
+        # prev_id -> block_pos, the first block claiming a prev_id wins
+        linked_prev_ids = prev_ids[linked]
+        linked_levels = levels[linked]
+        linked_positions = positions[linked]
+
+        unique_prev_ids, first_indices = numpy.unique(linked_prev_ids, return_index=True)
+        unclaimed = block_prev_id_to_block_pos[unique_prev_ids] == 0x00000000
+
+        block_prev_id_to_block_pos[unique_prev_ids[unclaimed]] = linked_positions[first_indices[unclaimed]]
+
+        if len(linked_prev_ids) != numpy.count_nonzero(unclaimed):
+            claimed = numpy.zeros(len(linked_prev_ids), dtype=bool)
+            claimed[first_indices[unclaimed]] = True
+
+            for duplicate_index in numpy.flatnonzero(~claimed).tolist():
+                self.logging.error("block with duplicate prev_id 0x%08X found for level %d" % (
+                    linked_prev_ids[duplicate_index], linked_levels[duplicate_index]))
 
     def order_block_indices(self):
         for level in reversed(range(0, self.block_chain_levels + 1)):
@@ -540,9 +683,9 @@ class FP5File(object):
                 if level > 0:
                     block_chain = self.block_chains[level]
 
-                    for block_id in block_chain.order:
-                        self.file.seek(self.block_id_to_block_pos[block_id])
-                        file.write(self.file.read(0x400))
+                    for (order_pos, run_length, run_pos) in block_chain.runs(max_run_length=MAX_COPY_RUN_BLOCKS):
+                        self.source.copy_to(file, run_pos, run_length * 0x400)
+                        self.source.consumed(run_pos, run_length * 0x400)
 
         return True
 
@@ -553,12 +696,17 @@ class FP5File(object):
             output_filename = self.filename + ".data"
 
         with open(output_filename, "wb") as file:
-            for block_id in self.data.order:
-                self.file.seek(self.block_id_to_block_pos[block_id])
-                file.write(self.file.read(0x400))
+            for (order_pos, run_length, run_pos) in self.data.runs(max_run_length=MAX_COPY_RUN_BLOCKS):
+                self.source.copy_to(file, run_pos, run_length * 0x400)
+                self.source.consumed(run_pos, run_length * 0x400)
 
         return True
 
+    def write_block_cache(self):
+        self.logging.info("write block cache")
+
+        return BlockCache.write(self)
+
     def dump_blocks_with_path(self, search_path, output_filename=None):
         self.logging.info("dump data with path %r" % search_path)
 
@@ -570,159 +718,139 @@ class FP5File(object):
         if not output_filename:
             output_filename = self.filename + "." + search_path_bin.decode() + ".data"
 
-        start_block_id = self.find_first_block_id_for_path(search_path)
-        start_block_pos = self.data.order.index(start_block_id)
+        block_range = self.block_range_for_path(search_path)
 
-        search_path_bin_len = len(search_path_bin)
+        if block_range is None:
+            return False
 
-        if start_block_pos:
-            with open(output_filename, "wb") as file:
-                for block_id in self.data.order[start_block_pos:]:
-                    block = Block(self.file, self.block_id_to_block_pos[block_id], block_id)
+        with open(output_filename, "wb") as file:
+            for (order_pos, run_length, run_pos) in self.data.runs(block_range.start, MAX_COPY_RUN_BLOCKS, block_range.stop):
+                self.source.copy_to(file, run_pos, run_length * 0x400)
+                self.source.consumed(run_pos, run_length * 0x400)
 
-                    block_first_token_path = block.get_first_token_path(self.file)
+        return True
 
-                    if block_first_token_path[:search_path_bin_len] != search_path_bin:
-                        break
+    def block_range_for_path(self, search_path):
+        """Returns the range of data chain positions (indices into `self.data.order`) of the blocks holding
+        the nodes of `search_path` and its sub nodes, None if the path cannot be located.
 
-                    self.file.seek(self.block_id_to_block_pos[block_id])
-                    file.write(self.file.read(0x400))
+        The range is taken from the separator keys of the index: it starts at the block in which the path is
+        opened and ends at the last block before the first separator that sorts after every sub path. For a path
+        that is not in the file this is the block it would be stored in."""
 
-        return True
-
-    def find_first_block_id_for_path(self, search_path):
         if type(search_path) is bytes:
             search_path = search_path.split(b'/')
 
-        last_payload = None
-
-        for block_chain_level in reversed(range(1, self.block_chain_levels + 1)):
-            block_chain = self.block_chains[block_chain_level]
-
-            order = block_chain.order
-            path = []
+        if self.index_tree is None:
+            self.index_tree = IndexTree(self)
 
-            is_first_block = True
-            block_chain_end_reached = False
+        first_block_id = self.index_tree.find_first_block_id(search_path)
+        last_block_id = self.index_tree.find_last_block_id(search_path)
 
-            current_block_id = block_chain.order[0] if last_payload is None else int.from_bytes(last_payload, byteorder='big')
-            current_block_order_pos = block_chain.order.index(current_block_id)
-            current_block_file_pos = self.block_id_to_block_pos[current_block_id]
+        if first_block_id is None or last_block_id is None:
+            self.logging.error("could not find blocks for path %r" % search_path)
+            return None
 
-            last_payload = None
+        first_order_pos = self.data.order_pos(first_block_id)
+        last_order_pos = self.data.order_pos(last_block_id)
 
-            while not block_chain_end_reached:
-                self.logging.debug("index block 0x%02X 0x%08X @ 0x%08X" % (block_chain_level, current_block_id, current_block_file_pos))
+        self.logging.debug("path %r is stored in data blocks %d to %d of the chain" %
+                           (search_path, first_order_pos, last_order_pos))
 
-                self.file.seek(current_block_file_pos + 0x0A)
-                (current_block_skip_bytes, current_block_length) = struct.unpack_from(">HH", self.file.read(0x04))
+        return range(first_order_pos, max(first_order_pos, last_order_pos) + 1)
 
-                data_len = current_block_length
-                data = self.file.read(data_len)
+    def partition_records(self, partition_count, search_path=(b'\x05',), start_node_path=None, stop_node_path=None):
+        """Splits the child nodes of `search_path` (the records by default) into up to `partition_count`
+        ranges spanning about the same number of data blocks.
 
-                if not is_first_block:
-                    cursor = current_block_skip_bytes - 1
-                else:
-                    cursor = 0
+        Returns a list of RecordPartition in chain order. Every range but the first starts with the node
+        `start_node_path` and every range but the last ends before `stop_node_path`, the next one's start.
+        The block `first_block_id` is the one the start node is opened in, so a range can be parsed with
+        BlockChain.sub_nodes(search_path, start_node_path=..., stop_node_path=..., start_block_id=...)
+        without reading the blocks before it.
 
-                while cursor < data_len:
-                    char_at_cursor = data[cursor]
+        With `start_node_path` the first range starts with that node instead of the first child node, with
+        `stop_node_path` the last one ends before that node instead of after the last child node.
 
-                    if 0x01 <= char_at_cursor <= 0x3F:
-                        payload_start = cursor + 2 + char_at_cursor
-                        payload_end = payload_start + data[payload_start - 1]
-                        ref = data[cursor + 1:cursor + 1 + char_at_cursor]
+        The blocks of the path are located with the index, the start of a range is the first node opened
+        in or after the block the range is split at, found by decoding that block's path prefix."""
 
-                        if ref == b'\xff\xff' and search_path[:len(path)] == path:
-                            break
+        if type(search_path) is bytes:
+            search_path = search_path.split(b'/')
 
-                        last_payload = data[payload_start:payload_end]
+        if type(start_node_path) is bytes:
+            start_node_path = start_node_path.split(b'/')
 
-                        cursor += payload_end - cursor
+        if type(stop_node_path) is bytes:
+            stop_node_path = stop_node_path.split(b'/')
 
-                        continue
+        search_path = list(search_path)
 
-                    # 0x00
-                    elif char_at_cursor == 0x00:
-                        payload_start = cursor + 2
-                        payload_end = payload_start + data[cursor + 1]
+        block_range = self.block_range_for_path(search_path)
 
-                        last_payload = data[payload_start:payload_end]
+        if block_range is None:
+            return []
 
-                        cursor += payload_end - cursor
-                        continue
+        if start_node_path is not None:
+            start_order_pos = self.data.node_order_pos(search_path, start_node_path)
 
-                    # FieldRefSimple + DataSimple
-                    elif 0x40 <= char_at_cursor <= 0x7F:
-                        payload_start = cursor + 2
-                        payload_end = payload_start + data[cursor + 1]
+            if start_order_pos is None:
+                return []
 
-                        last_payload = data[payload_start:payload_end]
+            block_range = range(start_order_pos, max(start_order_pos + 1, block_range.stop))
 
-                        cursor += payload_end - cursor
-                        continue
+        if stop_node_path is not None:
+            stop_block_id = self.find_first_block_id_for_path(stop_node_path)
 
-                    # parse 0xC0
-                    elif char_at_cursor == 0xC0:
-                        if len(path) == 0:
-                            break
+            if stop_block_id is not None:
+                stop_order_pos = self.data.order_pos(stop_block_id) + 1
+                block_range = range(block_range.start, max(block_range.start + 1, min(block_range.stop, stop_order_pos)))
 
-                        path.pop()
+        split_points = []
 
-                        cursor += 1
+        for partition in range(1, partition_count):
+            order_pos = block_range.start + len(block_range) * partition // partition_count
 
-                        continue
+            # a node spanning several split points only starts one range
+            if order_pos <= (split_points[-1][1] if split_points else block_range.start):
+                continue
 
-                    # parse 0xCN
-                    elif 0xC1 <= char_at_cursor <= 0xFC:
-                        payload_start = cursor + 1
-                        payload_end = payload_start + (char_at_cursor - 0xC0)
+            (node_path, node_order_pos) = self.data.first_child_path(search_path, order_pos)
 
-                        path.append(data[payload_start:payload_end])
+            if node_path is None or (stop_node_path is not None and node_path >= stop_node_path):
+                break
 
-                        if path >= search_path:
-                            break
+            if start_node_path is not None and node_path <= start_node_path:
+                continue
 
-                        cursor += payload_end - cursor
+            split_points.append((node_path, node_order_pos))
 
-                        continue
-                else:
-                    if cursor != data_len:
-                        print("Parsing incomplete: expected: %d got: %d" % (cursor, data_len))
+        partitions = []
 
-                        raise Exception("Parsing incomplete")
+        start_order_pos = block_range.start
 
-                    is_first_block = False
+        for (node_path, node_order_pos) in split_points:
+            partitions.append(RecordPartition(self.data.order[start_order_pos], start_node_path, node_path))
 
-                    if current_block_order_pos < block_chain.length:
-                        current_block_order_pos += 1
-                        current_block_id = order[current_block_order_pos]
-                        current_block_file_pos = self.block_id_to_block_pos[current_block_id]
-                    else:
-                        block_chain_end_reached = True
+            (start_node_path, start_order_pos) = (node_path, node_order_pos)
 
-                    continue
+        partitions.append(RecordPartition(self.data.order[start_order_pos], start_node_path, stop_node_path))
 
-                if last_payload is None:
-                    if current_block_order_pos > 0:
-                        path = []
+        self.logging.debug("split path %r into %d partitions" % (search_path, len(partitions)))
 
-                        is_first_block = True
-                        block_chain_end_reached = False
+        return partitions
 
-                        current_block_order_pos -= 1
-                        current_block_id = block_chain.order[current_block_order_pos]
-                        current_block_file_pos = self.block_id_to_block_pos[current_block_id]
+    def find_first_block_id_for_path(self, search_path):
+        if type(search_path) is bytes:
+            search_path = search_path.split(b'/')
 
-                        last_payload = None
-                        continue
-                    else:
-                        raise Exception("Error while location start block for path")
+        if self.index_tree is None:
+            self.index_tree = IndexTree(self)
 
-                break
+        block_id = self.index_tree.find_first_block_id(search_path)
 
-        if last_payload is not None:
-            return int.from_bytes(last_payload, byteorder='big')
+        if block_id is not None:
+            return block_id
 
         self.logging.error("could not find block for path %r" % search_path)
         return None
@@ -787,18 +915,176 @@ class FP5File(object):
             self.records_index = list(decode_vli(x) for x in node.keys())
             self.records_count = len(self.records_index)
 
+    def get_record(self, record_id, fields=None):
+        """Returns the record `record_id` as an OrderedDict like the ones BlockChain.sub_nodes yields, None if
+        there is no such record. With `fields` (field refs, e.g. DataField.field_id_bin) only these fields and
+        the mod id are returned.
+
+        The block the record is opened in is located with the index, only the blocks holding the record are read.
+        Raises a ValueError if `record_id` cannot be the id of a record."""
+
+        for (record_id, node) in self.get_records((record_id,), fields):
+            return node
+
+    def get_records(self, record_ids, fields=None):
+        """A generator that yields a tuple of (record_id, node) for every id of `record_ids` in ascending order,
+        node is None if there is no such record, see get_record.
+
+        The data chain is swept forward once: all requested records of a block are taken from it in one pass,
+        blocks without any are skipped by looking up the next requested record in the index. Raises a ValueError
+        if one of `record_ids` cannot be the id of a record."""
+
+        record_ids_bin = set()
+
+        for record_id in record_ids:
+            record_id_bin = encode_vli(record_id)
+
+            if record_id_bin is None:
+                raise ValueError("record id %r is out of range" % record_id)
+
+            record_ids_bin.add(record_id_bin)
+
+        record_ids_bin = sorted(record_ids_bin)
+
+        if fields is not None:
+            fields = set(fields)
+
+        id_pos = 0
+        order_pos = None
+        spans = None
+
+        while id_pos < len(record_ids_bin):
+            if spans is None:
+                # the next requested record is not in a block read so far
+                record_order_pos = self.record_order_pos(record_ids_bin[id_pos])
+
+                if record_order_pos is None:
+                    break
+
+                order_pos = record_order_pos if order_pos is None else max(record_order_pos, order_pos + 1)
+            else:
+                order_pos += 1
+
+            if order_pos >= self.data.length:
+                break
+
+            (data, start_path, block_spans, search_path_left) = self.record_block(order_pos)
+
+            for (span_record_id_bin, start, end, closed) in block_spans:
+                if spans is None:
+                    while id_pos < len(record_ids_bin) and record_ids_bin[id_pos] < span_record_id_bin:
+                        yield (decode_vli(record_ids_bin[id_pos]), None)
+
+                        id_pos += 1
+
+                    if id_pos == len(record_ids_bin) or record_ids_bin[id_pos] != span_record_id_bin:
+                        continue
+
+                    spans = []
+
+                spans += (data, start, end)
+
+                if closed:
+                    node = RecordView(span_record_id_bin, spans).node()
+
+                    if fields is not None:
+                        node = OrderedDict((field_ref, value) for (field_ref, value) in node.items()
+                                           if field_ref == b'\xfc' or split_field_and_sub_ref(field_ref)[0] in fields)
+
+                    yield (decode_vli(span_record_id_bin), node)
+
+                    id_pos += 1
+                    spans = None
+
+            if search_path_left:
+                break
+
+        for record_id_bin in record_ids_bin[id_pos:]:
+            yield (decode_vli(record_id_bin), None)
+
+    def record_order_pos(self, record_id_bin):
+        """Returns the position in the data chain of the block the record `record_id_bin` is (or would be)
+        opened in, None if the index has no block for it."""
+
+        record_path = (b'\x05', record_id_bin)
+
+        block_id = self.find_first_block_id_for_path(list(record_path))
+
+        if block_id is None:
+            return None
+
+        order_pos = self.data.order_pos(block_id)
+
+        # the index may lead to a block after the one the record is opened in, stepping back until a block
+        # starts before the record
+        while order_pos > 0:
+            (data, start_path, block_spans, search_path_left) = self.record_block(order_pos)
+
+            if start_path[:2] < record_path and (not block_spans or block_spans[0][0] <= record_id_bin):
+                break
+
+            order_pos -= 1
+
+        return order_pos
+
+    def record_block(self, order_pos):
+        """Returns the data block at `order_pos` of the chain split into records as a tuple of
+        (data, start_path, spans, search_path_left), see split_records.
+
+        The last RECORD_BLOCK_CACHE_SIZE blocks used are kept, the cache is shared by all threads."""
+
+        with self.record_blocks_lock:
+            record_block = self.record_blocks.get(order_pos)
+
+            if record_block is not None:
+                self.record_blocks.move_to_end(order_pos)
+
+                return record_block
+
+        (block_id, block_pos, data) = self.data.read_block(order_pos)
+
+        cursor = self.directory.skip_bytes[block_pos >> 10] - 1 if order_pos > 0 else 0
+
+        path = prefix_path(data, cursor)
+        start_path = tuple(path)
+
+        (spans, search_path_left) = split_records(data, cursor, path, [b'\x05'], block_id)
+
+        record_block = (data, start_path, spans, search_path_left)
+
+        with self.record_blocks_lock:
+            self.record_blocks[order_pos] = record_block
+
+            if len(self.record_blocks) > RECORD_BLOCK_CACHE_SIZE:
+                self.record_blocks.popitem(last=False)
+
+        return record_block
+
+    def records(self, first_record_id=None, payload_views=False, scan_order='chain', last_record_id=None):
+        """A generator that yields a RecordView per record, starting at `first_record_id` and ending with
+        `last_record_id` if given.
+
+        The fields of a record are only decoded when they are accessed. With `payload_views` the values are
+        memoryviews into the blocks instead of bytes."""
+
+        return RecordView.scan(self.data, first_record_id=first_record_id, payload_views=payload_views,
+                               scan_order=scan_order, last_record_id=last_record_id)
+
     def insert_records_into_postgres(self, fields_to_dump, first_record_to_process=None, table_name=None,
                                      psycopg2_connect_string=None, schema=None, show_progress=False,
-                                     drop_empty_columns=False):
+                                     drop_empty_columns=False, scan_order='chain', jobs=1, last_record_to_process=None):
         self.logging.info("inserting")
 
         exporter = PostgresExporter(self, fields_to_dump,
                                     schema, psycopg2_connect_string,
                                     first_record_to_process=first_record_to_process,
+                                    last_record_to_process=last_record_to_process,
                                     update_table=False,
                                     table_name=table_name,
                                     drop_empty_columns=drop_empty_columns,
-                                    show_progress=show_progress)
+                                    show_progress=show_progress,
+                                    scan_order=scan_order,
+                                    jobs=jobs)
         exporter.run()
 
         if exporter.sampled_errors_for_fields:
@@ -810,16 +1096,18 @@ class FP5File(object):
 
     def update_records_into_postgres(self, fields_to_dump, first_record_to_process=None, table_name=None,
                                      psycopg2_connect_string=None, schema=None, show_progress=False,
-                                     drop_empty_columns=False):
+                                     drop_empty_columns=False, scan_order='chain', last_record_to_process=None):
         self.logging.info("updating")
 
         exporter = PostgresExporter(self, fields_to_dump,
                                     schema, psycopg2_connect_string,
                                     first_record_to_process=first_record_to_process,
+                                    last_record_to_process=last_record_to_process,
                                     update_table=True,
                                     table_name=table_name,
                                     drop_empty_columns=drop_empty_columns,
-                                    show_progress=show_progress)
+                                    show_progress=show_progress,
+                                    scan_order=scan_order)
         exporter.run()
 
         if exporter.sampled_errors_for_fields:
@@ -830,7 +1118,8 @@ class FP5File(object):
         return True
 
     def dump_records_pgsql(self, fields_to_dump, first_record_to_process=None, filename=None, table_name=None,
-                           show_progress=False, drop_empty_columns=False):
+                           show_progress=False, drop_empty_columns=False, scan_order='chain', jobs=1,
+                           last_record_to_process=None):
         self.logging.info("dumping")
 
         if filename is None:
@@ -846,9 +1135,12 @@ class FP5File(object):
 
         exporter = PsqlExporter(self, fields_to_dump, filename,
                                 first_record_to_process=first_record_to_process,
+                                last_record_to_process=last_record_to_process,
                                 table_name=table_name,
                                 drop_empty_columns=drop_empty_columns,
-                                show_progress=show_progress)
+                                show_progress=show_progress,
+                                scan_order=scan_order,
+                                jobs=jobs)
         exporter.run()
 
         if exporter.sampled_errors_for_fields:
@@ -863,6 +1155,9 @@ FieldExportDefinition = namedtuple('FieldExportDefinition', ["field_id", "field"
                                                              "is_array", "split", "subscript",
                                                              "is_enum", "enum", "pos"])
 
+# a range of the child nodes of a path that can be parsed on its own, see FP5File.partition_records
+RecordPartition = namedtuple('RecordPartition', ["first_block_id", "start_node_path", "stop_node_path"])
+
 
 class __OrderedDictYAMLLoader__(yaml.Loader):
     """
@@ -0,0 +1,197 @@
+import logging
+from array import array
+from bisect import bisect_left
+
+# sorts after every path that shares its prefix, path parts are at most 0x3C bytes long
+INDEX_KEY_MAX = (b'\xff' * 0x100,)
+
+
+class IndexLevel(object):
+    """The separator paths and child block ids of one index block chain, decoded once in chain order.
+
+    Every point at which a lookup may stop (a pushed path, the end marker of a level) becomes a key,
+    together with the id of the child block referenced last before it. Keys hold the running maximum
+    of the paths within their block, so the first stop at or above a search path is found by bisect."""
+
+    def __init__(self, fp5file, block_chain):
+        super(IndexLevel, self).__init__()
+
+        self.block_chain = block_chain
+
+        self.keys = []
+        self.children = []
+        self.block_starts = array('I')
+        self.prefix_keys = []
+        self.last_child = None
+
+        self.decode(fp5file)
+
+    def decode(self, fp5file):
+        source = fp5file.source
+        directory = fp5file.directory
+
+        order = self.block_chain.order
+
+        path = []
+        last_child = None
+
+        for order_pos in range(self.block_chain.length):
+            block_pos = fp5file.block_id_to_block_pos[order[order_pos]]
+
+            data_len = directory.length[block_pos >> 10]
+            data = source.read(block_pos + 0x0E, data_len)
+
+            self.block_starts.append(len(self.keys))
+
+            if order_pos == 0:
+                cursor = 0
+                self.prefix_keys.append(None)
+            else:
+                cursor = directory.skip_bytes[block_pos >> 10] - 1
+                self.prefix_keys.append(self.decode_prefix(data[:cursor]))
+
+            block_max_key = None
+
+            while cursor < data_len:
+                char_at_cursor = data[cursor]
+                key = None
+
+                if 0x01 <= char_at_cursor <= 0x3F:
+                    payload_start = cursor + 2 + char_at_cursor
+                    payload_end = payload_start + data[payload_start - 1]
+
+                    if data[cursor + 1:cursor + 1 + char_at_cursor] == b'\xff\xff':
+                        key = tuple(path) + INDEX_KEY_MAX
+
+                    child = data[payload_start:payload_end]
+                    cursor = payload_end
+
+                elif char_at_cursor == 0x00 or 0x40 <= char_at_cursor <= 0x7F:
+                    payload_start = cursor + 2
+                    payload_end = payload_start + data[cursor + 1]
+
+                    child = data[payload_start:payload_end]
+                    cursor = payload_end
+
+                elif char_at_cursor == 0xC0:
+                    if len(path) == 0:
+                        key = INDEX_KEY_MAX
+                    else:
+                        path.pop()
+
+                    child = None
+                    cursor += 1
+
+                elif 0xC1 <= char_at_cursor <= 0xFC:
+                    payload_start = cursor + 1
+                    payload_end = payload_start + (char_at_cursor - 0xC0)
+
+                    path.append(data[payload_start:payload_end])
+
+                    key = tuple(path)
+                    child = None
+                    cursor = payload_end
+
+                else:
+                    raise Exception("unexpected token 0x%02X in index block 0x%08X" % (char_at_cursor, order[order_pos]))
+
+                if key is not None:
+                    if block_max_key is None or key > block_max_key:
+                        block_max_key = key
+
+                    self.keys.append(block_max_key)
+                    self.children.append(last_child)
+
+                if child is not None:
+                    last_child = int.from_bytes(child, byteorder='big')
+
+            if cursor != data_len:
+                raise Exception("Parsing incomplete")
+
+        self.block_starts.append(len(self.keys))
+        self.last_child = last_child
+
+    @staticmethod
+    def decode_prefix(data):
+        """Returns the largest path pushed by the path prefix of a block, None if it pushes nothing."""
+
+        path = []
+        prefix_key = None
+        cursor = 0
+
+        while cursor < len(data):
+            char_at_cursor = data[cursor]
+
+            if char_at_cursor == 0xC0:
+                if path:
+                    path.pop()
+
+                cursor += 1
+            elif 0xC1 <= char_at_cursor <= 0xFC:
+                path.append(data[cursor + 1:cursor + 1 + (char_at_cursor - 0xC0)])
+
+                if prefix_key is None or tuple(path) > prefix_key:
+                    prefix_key = tuple(path)
+
+                cursor += 1 + (char_at_cursor - 0xC0)
+            else:
+                break
+
+        return prefix_key
+
+    def find_child(self, search_key, start_block_id):
+        """Returns the id of the child block that may contain `search_key`, starting at block `start_block_id`."""
+
+        order_pos = self.block_chain.order_pos(start_block_id)
+
+        # a block whose path prefix already reaches the search key is entered from its predecessor
+        while order_pos > 0 and self.prefix_keys[order_pos] is not None and self.prefix_keys[order_pos] >= search_key:
+            order_pos -= 1
+
+        for order_pos in range(order_pos, self.block_chain.length):
+            block_end = self.block_starts[order_pos + 1]
+            key_pos = bisect_left(self.keys, search_key, self.block_starts[order_pos], block_end)
+
+            if key_pos < block_end:
+                if self.children[key_pos] is None:
+                    raise Exception("Error while location start block for path")
+
+                return self.children[key_pos]
+
+        return self.last_child
+
+
+class IndexTree(object):
+    """The index levels of a file, used to locate the first data block of a path with one bisect per level."""
+
+    def __init__(self, fp5file):
+        super(IndexTree, self).__init__()
+
+        self.logging = logging.getLogger('fp5dump.fp5file.indextree')
+
+        self.levels = [IndexLevel(fp5file, fp5file.block_chains[level])
+                       for level in range(1, fp5file.block_chain_levels + 1)]
+
+        self.logging.debug("decoded %d index keys in %d levels" % (sum(len(level.keys) for level in self.levels),
+                                                                   len(self.levels)))
+
+    def find_first_block_id(self, search_path):
+        search_key = tuple(search_path)
+
+        block_id = None
+
+        for index_level in reversed(self.levels):
+            if block_id is None:
+                block_id = index_level.block_chain.order[0]
+
+            block_id = index_level.find_child(search_key, block_id)
+
+            if block_id is None:
+                break
+
+        return block_id
+
+    def find_last_block_id(self, search_path):
+        """Returns the id of the last data block that may contain a node of `search_path` or one of its sub nodes."""
+
+        return self.find_first_block_id(tuple(search_path) + INDEX_KEY_MAX)
@@ -10,7 +10,7 @@ import psycopg2.extras
 import struct
 import re
 
-from .blockchain import decode_vli, encode_vli, split_field_and_sub_ref
+from .blockchain import decode_vli, split_field_and_sub_ref
 from .exporter import Exporter
 
 
@@ -21,8 +21,10 @@ FieldExportDefinition = namedtuple('FieldExportDefinition', ["field_id", "field"
 
 class PostgresExporter(Exporter):
     def __init__(self, fp5file, export_definition, schema, psycopg2_connect_string,
-                 first_record_to_process=None, update_table=False, table_name=None, show_progress=False, drop_empty_columns=False):
-        super(PostgresExporter, self).__init__(fp5file, export_definition, first_record_to_process, table_name, show_progress, drop_empty_columns)
+                 first_record_to_process=None, last_record_to_process=None, update_table=False, table_name=None, show_progress=False,
+                 drop_empty_columns=False, scan_order='chain', jobs=1):
+        super(PostgresExporter, self).__init__(fp5file, export_definition, first_record_to_process, last_record_to_process, table_name,
+                                               show_progress, drop_empty_columns, scan_order, jobs)
 
         self.schema = schema
         self.update_table = update_table
@@ -109,7 +111,9 @@ class PostgresExporter(Exporter):
             pgsql_fields.append('CONSTRAINT "_%s_pkey" PRIMARY KEY ("fm_id")' % self.table_name)
 
             with conn.cursor() as cursor:
-                cursor.execute('DROP TABLE IF EXISTS "%s";' % self.table_name)
+                if not self.is_slice():
+                    cursor.execute('DROP TABLE IF EXISTS "%s";' % self.table_name)
+
                 cursor.execute('CREATE TABLE IF NOT EXISTS "%s" (\n%s\n);\n\n' % (self.table_name, ',\n'.join(pgsql_fields)))
 
                 conn.commit()
@@ -233,10 +237,7 @@ class PostgresExporter(Exporter):
 
         self.start_time = self.eta_last_updated = time.time()
 
-        self.records_to_process_count = self.fp5file.records_count
-
-        if self.first_record_to_process is not None:
-            self.records_to_process_count -= self.fp5file.records_index.index(self.first_record_to_process)
+        self.records_to_process_count = self.count_records_to_process()
 
         if self.update_table:
             self.delete_records(conn)
@@ -270,123 +271,51 @@ class PostgresExporter(Exporter):
                     if not self.pre_run_actions(conn):
                         return False
 
-                    field_count = len(self.export_definition) + 2
-
                     cursor.execute("""PREPARE get_mod_id AS SELECT "fm_mod_id" FROM "%s"."%s" WHERE "fm_id" = $1;""" % (self.schema, self.table_name))
 
-                    if self.first_record_to_process is not None:
-                        start_node_path = b'\x05/' + encode_vli(self.first_record_to_process)
-                    else:
-                        start_node_path = None
-
-                    table_fields_present = set()
-                    token_ids_to_return = set(self.export_definition.keys())
-
-                    for (record_id_bin, record_tokens) in self.fp5file.data.sub_nodes(b'\x05', start_node_path=start_node_path, token_ids_to_return=token_ids_to_return):
-                        # progress counter
-                        self.update_progress()
-
-                        # get basic record infos
-                        record_id = decode_vli(record_id_bin)
-                        mod_id = int.from_bytes(record_tokens[b'\xfc'], byteorder='big') if b'\xfc' in record_tokens else 0
-                        update_record = False
-
-                        # check if insert/update/skip
-                        if self.update_table:
-                            cursor.execute('execute get_mod_id(%s);', (record_id,))
-
-                            mod_id_check = cursor.fetchone()
-
-                            if mod_id_check is not None:
-                                if mod_id == mod_id_check[0]:
-                                    continue
-
-                                update_record = True
-
-                        # prepare values for insert/update statement
-
-                        self.copy_stream.write(pack('>HIq', field_count, 8, record_id))
-                        had_errors = False
-
-                        values = OrderedDict()
+                    if self.use_workers() and not self.update_table:
+                        for encoded_records in self.encoded_partitions():
+                            for encoded_record in encoded_records:
+                                # progress counter
+                                self.update_progress()
 
-                        for (field_id_combined_bin, field_value) in record_tokens.items():
-                            field_id_bin, sub_field_id_bin = split_field_and_sub_ref(field_id_combined_bin)
+                                self.copy_stream.write(encoded_record)
 
-                            if field_id_bin in self.export_definition:
-                                export_def = self.export_definition[field_id_bin]
+                                self.inserted_records += 1
 
-                                if export_def.field.repetitions > 1:
-                                    if not sub_field_id_bin:
-                                        sub_field_id_bin = b'\x01'
-
-                                    sub_field_id = decode_vli(sub_field_id_bin) - 1
-
-                                    if export_def.subscript is not None:
-                                        if sub_field_id == export_def.subscript:
-                                            values[field_id_bin] = field_value
-                                    else:
-                                        if field_id_bin not in values:
-                                            values[field_id_bin] = [None] * export_def.field.repetitions
-
-                                        values[field_id_bin][sub_field_id] = field_value
-                                elif export_def.split:
-                                    values[field_id_bin] = field_value.splitlines()
-                                else:
-                                    values[field_id_bin] = field_value
+                                self.flush_full_batch(conn)
+                    else:
+                        for (record_id_bin, record_tokens) in self.records():
+                            # progress counter
+                            self.update_progress()
 
-                        for field_id_bin, export_def in self.export_definition.items():
-                            if field_id_bin in values:
-                                value = values[field_id_bin]
+                            # get basic record infos
+                            record_id = decode_vli(record_id_bin)
+                            mod_id = int.from_bytes(record_tokens[b'\xfc'], byteorder='big') if b'\xfc' in record_tokens else 0
+                            update_record = False
 
-                                if self.drop_empty_columns:
-                                    table_fields_present.add(field_id_bin)
+                            # check if insert/update/skip
+                            if self.update_table:
+                                cursor.execute('execute get_mod_id(%s);', (record_id,))
 
-                                if type(value) is list:
-                                    stream_pos_before = self.copy_stream.tell()
-                                    self.copy_stream.write(b'\xfe\xfe\xfe\xfe')
+                                mod_id_check = cursor.fetchone()
 
-                                    self.copy_stream.write(pack('>IIIII', 1, 1 if None in value else 0, export_def.pg_oid, len(value), 1))
+                                if mod_id_check is not None:
+                                    if mod_id == mod_id_check[0]:
+                                        continue
 
-                                    for sub_value in value:
-                                        if sub_value is None or (sub_value == b'' and export_def.split):
-                                            self.copy_stream.write(b'\xff\xff\xff\xff')
-                                        else:
-                                            if not self.values_for_field_type(sub_value, export_def):
-                                                had_errors = True
-                                                self.copy_stream.write(b'\xff\xff\xff\xff')
-                                                self.aggregate_errors(export_def, record_id, sub_value)
+                                    update_record = True
 
-                                    stream_pos_end = self.copy_stream.tell()
+                            # prepare values for insert/update statement
+                            self.write_record(record_id, mod_id, record_tokens)
 
-                                    self.copy_stream.seek(stream_pos_before)
-                                    self.copy_stream.write(pack('>I', stream_pos_end - stream_pos_before - 4))
-                                    self.copy_stream.seek(stream_pos_end)
-                                else:
-                                    if not self.values_for_field_type(value, export_def):
-                                        had_errors = True
-                                        self.copy_stream.write(b'\xff\xff\xff\xff')
-                                        self.aggregate_errors(field_id_bin, record_id, values[field_id_bin])
+                            if update_record:
+                                self.updated_records += 1
+                                self.records_to_update.append(record_id)
                             else:
-                                self.copy_stream.write(b'\xff\xff\xff\xff')
-
-                        if had_errors:
-                            self.copy_stream.write(pack('>Iq', 8, -1))
-                        else:
-                            self.copy_stream.write(pack('>Iq', 8, mod_id))
+                                self.inserted_records += 1
 
-                        if update_record:
-                            self.updated_records += 1
-                            self.records_to_update.append(record_id)
-                        else:
-                            self.inserted_records += 1
-
-                        # flush
-                        if self.copy_stream.tell() >= 10485760:
-                            self.flush_batch(conn)
-
-                            self.copy_stream = BytesIO()
-                            self.copy_stream.write(pack('>11sii', b'PGCOPY\n\377\r\n\0', 0, 0))
+                            self.flush_full_batch(conn)
 
                     # final flush
                     if self.copy_stream.tell() > 19:
@@ -396,7 +325,7 @@ class PostgresExporter(Exporter):
                     if self.drop_empty_columns and not self.update_table:
                         with conn.cursor() as cursor:
                             for field_id_bin, export_def in self.export_definition.items():
-                                if field_id_bin not in table_fields_present:
+                                if field_id_bin not in self.table_fields_present:
                                     cursor.execute('ALTER TABLE "%s" DROP COLUMN  "%s";\n' % (self.table_name, export_def.field.label))
 
                     # deallocate prepares statement
@@ -429,6 +358,97 @@ class PostgresExporter(Exporter):
 
         sys.stdout.flush()
 
+    def flush_full_batch(self, conn):
+        if self.copy_stream.tell() >= 10485760:
+            self.flush_batch(conn)
+
+            self.copy_stream = BytesIO()
+            self.copy_stream.write(pack('>11sii', b'PGCOPY\n\377\r\n\0', 0, 0))
+
+    def encode_records(self, records):
+        for (record_id_bin, record_tokens) in records:
+            self.copy_stream = BytesIO()
+
+            record_id = decode_vli(record_id_bin)
+            mod_id = int.from_bytes(record_tokens[b'\xfc'], byteorder='big') if b'\xfc' in record_tokens else 0
+
+            self.write_record(record_id, mod_id, record_tokens)
+
+            yield self.copy_stream.getvalue()
+
+    def write_record(self, record_id, mod_id, record_tokens):
+        field_count = len(self.export_definition) + 2
+
+        self.copy_stream.write(pack('>HIq', field_count, 8, record_id))
+        had_errors = False
+
+        values = OrderedDict()
+
+        for (field_id_combined_bin, field_value) in record_tokens.items():
+            field_id_bin, sub_field_id_bin = split_field_and_sub_ref(field_id_combined_bin)
+
+            if field_id_bin in self.export_definition:
+                export_def = self.export_definition[field_id_bin]
+
+                if export_def.field.repetitions > 1:
+                    if not sub_field_id_bin:
+                        sub_field_id_bin = b'\x01'
+
+                    sub_field_id = decode_vli(sub_field_id_bin) - 1
+
+                    if export_def.subscript is not None:
+                        if sub_field_id == export_def.subscript:
+                            values[field_id_bin] = field_value
+                    else:
+                        if field_id_bin not in values:
+                            values[field_id_bin] = [None] * export_def.field.repetitions
+
+                        values[field_id_bin][sub_field_id] = field_value
+                elif export_def.split:
+                    values[field_id_bin] = field_value.splitlines()
+                else:
+                    values[field_id_bin] = field_value
+
+        for field_id_bin, export_def in self.export_definition.items():
+            if field_id_bin in values:
+                value = values[field_id_bin]
+
+                if self.drop_empty_columns:
+                    self.table_fields_present.add(field_id_bin)
+
+                if type(value) is list:
+                    stream_pos_before = self.copy_stream.tell()
+                    self.copy_stream.write(b'\xfe\xfe\xfe\xfe')
+
+                    self.copy_stream.write(pack('>IIIII', 1, 1 if None in value else 0, export_def.pg_oid, len(value), 1))
+
+                    for sub_value in value:
+                        if sub_value is None or (sub_value == b'' and export_def.split):
+                            self.copy_stream.write(b'\xff\xff\xff\xff')
+                        else:
+                            if not self.values_for_field_type(sub_value, export_def):
+                                had_errors = True
+                                self.copy_stream.write(b'\xff\xff\xff\xff')
+                                self.aggregate_errors(export_def, record_id, sub_value)
+
+                    stream_pos_end = self.copy_stream.tell()
+
+                    self.copy_stream.seek(stream_pos_before)
+                    self.copy_stream.write(pack('>I', stream_pos_end - stream_pos_before - 4))
+                    self.copy_stream.seek(stream_pos_end)
+                else:
+                    if not self.values_for_field_type(value, export_def):
+                        had_errors = True
+                        self.copy_stream.write(b'\xff\xff\xff\xff')
+                        self.aggregate_errors(field_id_bin, record_id, values[field_id_bin])
+            else:
+                self.copy_stream.write(b'\xff\xff\xff\xff')
+
+        if had_errors:
+            self.copy_stream.write(pack('>Iq', 8, -1))
+        else:
+            self.copy_stream.write(pack('>Iq', 8, mod_id))
+
     def values_for_field_type(self, value, export_def):
         try:
             if type(value) is OrderedDict and b'\x01' in value and b'\xff\x00' in value:
@@ -4,16 +4,19 @@ import os
 import sys
 import time
 from binascii import unhexlify
+from io import StringIO
 import uuid
 
-from .blockchain import decode_vli, encode_vli, split_field_and_sub_ref
+from .blockchain import decode_vli, split_field_and_sub_ref
 from .exporter import Exporter
 
 
 class PsqlExporter(Exporter):
     def __init__(self, fp5file, export_definition, filename,
-                 first_record_to_process=None, table_name=None, show_progress=False, drop_empty_columns=False):
-        super(PsqlExporter, self).__init__(fp5file, export_definition, first_record_to_process, table_name, show_progress, drop_empty_columns)
+                 first_record_to_process=None, last_record_to_process=None, table_name=None, show_progress=False,
+                 drop_empty_columns=False, scan_order='chain', jobs=1):
+        super(PsqlExporter, self).__init__(fp5file, export_definition, first_record_to_process, last_record_to_process, table_name,
+                                           show_progress, drop_empty_columns, scan_order, jobs)
 
         self.filename = filename
 
@@ -57,7 +60,9 @@ class PsqlExporter(Exporter):
 
         pgsql_fields.append('  CONSTRAINT "_%s_pkey" PRIMARY KEY ("fm_id")' % self.table_name)
 
-        self.output.write('DROP TABLE IF EXISTS "%s";\n' % self.table_name)
+        if not self.is_slice():
+            self.output.write('DROP TABLE IF EXISTS "%s";\n' % self.table_name)
+
         self.output.write('CREATE TABLE IF NOT EXISTS "%s" (\n%s\n);\n\n' % (self.table_name, ',\n'.join(pgsql_fields)))
 
         self.insert_statement = 'INSERT INTO "%s" (%s) VALUES \n(' % (self.table_name, ', '.join(pgsql_field_names))
@@ -83,10 +88,13 @@ class PsqlExporter(Exporter):
 
         self.start_time = self.eta_last_updated = time.time()
 
-        self.records_to_process_count = self.fp5file.records_count
+        self.records_to_process_count = self.count_records_to_process()
+
+    def __getstate__(self):
+        state = super(PsqlExporter, self).__getstate__()
+        state.update(output=None)
 
-        if self.first_record_to_process is not None:
-            self.records_to_process_count -= self.fp5file.records_index.index(self.first_record_to_process)
+        return state
 
     def run(self):
         with open(os.path.abspath(os.path.expanduser(self.filename)), "w", encoding="utf8") as output:
@@ -94,107 +102,134 @@ class PsqlExporter(Exporter):
 
             self.pre_run_actions()
 
-            if self.first_record_to_process is not None:
-                start_node_path = b'\x05/' + encode_vli(self.first_record_to_process)
+            # without records to export the statement would never be closed
+            if self.records_to_process_count > 0:
+                self.output.write(self.insert_statement)
+
+            if self.use_workers():
+                # the workers encode the records to utf8 already, they are written as they arrive
+                output.flush()
+
+                for encoded_records in self.encoded_partitions():
+                    for encoded_record in encoded_records:
+                        # progress counter
+                        self.update_progress()
+
+                        output.buffer.write(encoded_record)
+                        output.buffer.write(self.record_separator().encode())
+
+                output.buffer.flush()
             else:
-                start_node_path = None
+                for (record_id_bin, record_tokens) in self.records():
+                    # progress counter
+                    self.update_progress()
 
-            table_fields_present = set()
-            token_ids_to_return = set(self.export_definition.keys())
+                    self.write_record(record_id_bin, record_tokens)
 
-            self.output.write(self.insert_statement)
+                    output.write(self.record_separator())
 
-            for (record_id_bin, record_tokens) in self.fp5file.data.sub_nodes(b'\x05', start_node_path=start_node_path, token_ids_to_return=token_ids_to_return):
-                # progress counter
-                self.update_progress()
+            if self.drop_empty_columns:
+                for export_def in self.export_definition.values():
+                    if export_def.field_id not in self.table_fields_present:
+                        output.write('ALTER TABLE "%s" DROP COLUMN  "%s";\n' % (self.table_name, export_def.field.label))
 
-                # get basic record infos
-                record_id = decode_vli(record_id_bin)
-                mod_id = int.from_bytes(record_tokens[b'\xfc'], byteorder='big') if b'\xfc' in record_tokens else 0
+        self.reset_locale()
 
-                output.write("%d, " % record_id)
+        sys.stdout.flush()
+        self.logging.info("exported %d records" % self.processed_records)
 
-                had_errors = False
+    def encode_records(self, records):
+        output = self.output = StringIO()
 
-                values = OrderedDict()
+        for (record_id_bin, record_tokens) in records:
+            self.write_record(record_id_bin, record_tokens)
 
-                for (field_id_combined_bin, field_value) in record_tokens.items():
-                    field_id_bin, sub_field_id_bin = split_field_and_sub_ref(field_id_combined_bin)
+            yield output.getvalue().encode()
 
-                    if field_id_bin in self.export_definition:
-                        export_def = self.export_definition[field_id_bin]
+            output.seek(0)
+            output.truncate()
 
-                        if export_def.field.repetitions > 1:
-                            if not sub_field_id_bin:
-                                sub_field_id_bin = b'\x01'
+    def record_separator(self):
+        if self.processed_records == self.records_to_process_count:
+            return ');\n\n'
+        else:
+            return '),\n(' if self.processed_records % 1000 != 0 else ');\n\n' + self.insert_statement
 
-                            sub_field_id = decode_vli(sub_field_id_bin) - 1
+    def write_record(self, record_id_bin, record_tokens):
+        output = self.output
 
-                            if export_def.subscript is not None:
-                                if sub_field_id == export_def.subscript:
-                                    values[field_id_bin] = field_value
-                            else:
-                                if field_id_bin not in values:
-                                    values[field_id_bin] = [None] * export_def.field.repetitions
+        # get basic record infos
+        record_id = decode_vli(record_id_bin)
+        mod_id = int.from_bytes(record_tokens[b'\xfc'], byteorder='big') if b'\xfc' in record_tokens else 0
 
-                                values[field_id_bin][sub_field_id] = field_value
-                        elif export_def.split:
-                            values[field_id_bin] = field_value.splitlines()
-                        else:
-                            values[field_id_bin] = field_value
+        output.write("%d, " % record_id)
 
-                for field_id_bin, export_def in self.export_definition.items():
-                    if field_id_bin in values:
-                        value = values[field_id_bin]
+        had_errors = False
 
-                        if self.drop_empty_columns:
-                            table_fields_present.add(field_id_bin)
+        values = OrderedDict()
 
-                        if type(value) is list:
-                            self.output.write("ARRAY[")
+        for (field_id_combined_bin, field_value) in record_tokens.items():
+            field_id_bin, sub_field_id_bin = split_field_and_sub_ref(field_id_combined_bin)
 
-                            for sub_value_index, sub_value in enumerate(value):
-                                if sub_value_index != 0:
-                                    output.write(", ")
+            if field_id_bin in self.export_definition:
+                export_def = self.export_definition[field_id_bin]
 
-                                if sub_value is not None and sub_value != '':
-                                    if not self.values_for_field_type(sub_value, export_def):
-                                        had_errors = True
-                                        output.write("NULL")
-                                        self.aggregate_errors(field_id_bin, record_id, sub_value)
-                                else:
-                                    self.output.write("NULL")
+                if export_def.field.repetitions > 1:
+                    if not sub_field_id_bin:
+                        sub_field_id_bin = b'\x01'
 
-                            self.output.write("]" + export_def.psql_cast + ", ")
-                        else:
-                            if not self.values_for_field_type(value, export_def):
-                                had_errors = True
-                                output.write("NULL, ")
-                                self.aggregate_errors(field_id_bin, record_id, values[field_id_bin])
-                            else:
-                                output.write(", ")
+                    sub_field_id = decode_vli(sub_field_id_bin) - 1
+
+                    if export_def.subscript is not None:
+                        if sub_field_id == export_def.subscript:
+                            values[field_id_bin] = field_value
                     else:
-                        output.write("NULL, ")
+                        if field_id_bin not in values:
+                            values[field_id_bin] = [None] * export_def.field.repetitions
 
-                if had_errors:
-                    output.write("-1")
+                        values[field_id_bin][sub_field_id] = field_value
+                elif export_def.split:
+                    values[field_id_bin] = field_value.splitlines()
                 else:
-                    output.write("%d" % mod_id)
+                    values[field_id_bin] = field_value
 
-                if self.processed_records == self.records_to_process_count:
-                    output.write(');\n\n')
-                else:
-                    output.write('),\n(' if self.processed_records % 1000 != 0 else ');\n\n' + self.insert_statement)
+        for field_id_bin, export_def in self.export_definition.items():
+            if field_id_bin in values:
+                value = values[field_id_bin]
 
-            if self.drop_empty_columns:
-                for export_def in self.export_definition.values():
-                    if export_def.field_id not in table_fields_present:
-                        output.write('ALTER TABLE "%s" DROP COLUMN  "%s";\n' % (self.table_name, export_def.field.label))
+                if self.drop_empty_columns:
+                    self.table_fields_present.add(field_id_bin)
 
-        self.reset_locale()
+                if type(value) is list:
+                    self.output.write("ARRAY[")
 
-        sys.stdout.flush()
-        self.logging.info("exported %d records" % self.processed_records)
+                    for sub_value_index, sub_value in enumerate(value):
+                        if sub_value_index != 0:
+                            output.write(", ")
+
+                        if sub_value is not None and sub_value != '':
+                            if not self.values_for_field_type(sub_value, export_def):
+                                had_errors = True
+                                output.write("NULL")
+                                self.aggregate_errors(field_id_bin, record_id, sub_value)
+                        else:
+                            self.output.write("NULL")
+
+                    self.output.write("]" + export_def.psql_cast + ", ")
+                else:
+                    if not self.values_for_field_type(value, export_def):
+                        had_errors = True
+                        output.write("NULL, ")
+                        self.aggregate_errors(field_id_bin, record_id, values[field_id_bin])
+                    else:
+                        output.write(", ")
+            else:
+                output.write("NULL, ")
+
+        if had_errors:
+            output.write("-1")
+        else:
+            output.write("%d" % mod_id)
 
     def values_for_field_type(self, value, export_def):
         if type(value) is OrderedDict and b'\x01' in value and b'\xff\x00' in value:
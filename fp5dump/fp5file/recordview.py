@@ -0,0 +1,246 @@
+from collections import OrderedDict
+from itertools import chain
+
+from .blockchain import TOKEN_CHILD, TOKEN_KEY, TOKEN_KINDS, TOKEN_PARTIAL, TOKEN_PAYLOAD_LENGTHS, \
+    TOKEN_PAYLOAD_OFFSETS, TOKEN_POP, TOKEN_PUSH, build_nodes, decode_vli, encode_vli, span_tokens
+
+
+def split_records(data, cursor, path, search_path, block_id):
+    """Splits the block `data` from `cursor` on into the spans of the child nodes of `search_path` (the records).
+
+    `path` is the path open at `cursor`, it is updated to the one open at the end of the data. Field tokens are
+    skipped by their length, only path tokens are looked at.
+
+    Returns a list of [record_id_bin, start, end, closed] with a span per record open in the block, the first
+    one continues a record opened in a block before if it starts at `cursor`. The second value returned is True if the
+    search path was left within the block, no records follow it."""
+
+    token_kinds = TOKEN_KINDS
+    token_payload_offsets = TOKEN_PAYLOAD_OFFSETS
+    token_payload_lengths = TOKEN_PAYLOAD_LENGTHS
+
+    search_path_len = len(search_path)
+
+    data_len = len(data)
+
+    spans = []
+
+    if len(path) > search_path_len and path[:search_path_len] == search_path:
+        record_span = [path[search_path_len], cursor, data_len, False]
+    else:
+        record_span = None
+
+    while cursor < data_len:
+        char_at_cursor = data[cursor]
+        token_kind = token_kinds[char_at_cursor]
+
+        if token_kind <= TOKEN_CHILD:
+            payload_start = cursor + token_payload_offsets[char_at_cursor]
+            cursor = payload_start + data[payload_start - 1]
+
+        elif token_kind == TOKEN_KEY:
+            cursor += 1 + token_payload_lengths[char_at_cursor]
+
+        elif token_kind == TOKEN_PUSH:
+            payload_start = cursor + 1
+            cursor = payload_start + token_payload_lengths[char_at_cursor]
+
+            path.append(data[payload_start:cursor])
+
+            if len(path) <= search_path_len:
+                if path > search_path[:len(path)]:
+                    return (spans, True)
+            elif len(path) == search_path_len + 1 and path[:search_path_len] == search_path:
+                record_span = [path[-1], cursor, data_len, False]
+
+        elif token_kind == TOKEN_POP:
+            if not path:
+                return (spans, True)
+
+            if record_span is not None and len(path) == search_path_len + 1:
+                record_span[2] = cursor
+                record_span[3] = True
+
+                spans.append(record_span)
+
+                record_span = None
+
+            left_search_path = len(path) == search_path_len and path == search_path
+
+            path.pop()
+
+            if left_search_path:
+                return (spans, True)
+
+            cursor += 1
+
+        elif token_kind == TOKEN_PARTIAL:
+            char_at_cursor = data[cursor + 1]
+
+            if 0x01 <= char_at_cursor <= 0x04:
+                payload_start = cursor + 4 + char_at_cursor
+                cursor = payload_start + (data[payload_start - 2] << 8) + data[payload_start - 1]
+            elif 0x40 <= char_at_cursor < 0x80:
+                payload_start = cursor + 4
+                cursor = payload_start + (data[cursor + 2] << 8) + data[cursor + 3]
+            else:
+                raise Exception("unhandled 0xFF token: %r" % data[cursor:cursor + 20])
+
+        else:
+            raise Exception("unexpected token 0x%02X in data block 0x%08X" % (char_at_cursor, block_id))
+
+    if cursor != data_len:
+        raise Exception("Parsing incomplete")
+
+    if record_span is not None:
+        spans.append(record_span)
+
+    return (spans, False)
+
+
+class RecordView(object):
+    """A record of the data chain, kept as the spans of the blocks holding its tokens.
+
+    Nothing is decoded until it is accessed: `get` looks up a single field (or one repetition of it),
+    iterating yields the fields of the record in the order they are stored."""
+
+    __slots__ = ('record_id_bin', 'spans', 'payload_views')
+
+    def __init__(self, record_id_bin, spans, payload_views=False):
+        super(RecordView, self).__init__()
+
+        self.record_id_bin = record_id_bin
+
+        # block data, start and end for every block the record is stored in, one after the other
+        self.spans = spans
+
+        self.payload_views = payload_views
+
+    @property
+    def record_id(self):
+        return decode_vli(self.record_id_bin)
+
+    @property
+    def mod_id(self):
+        mod_id_bin = self.get(b'\xfc')
+
+        return int.from_bytes(mod_id_bin, byteorder='big') if mod_id_bin is not None else 0
+
+    def tokens(self):
+        """Returns an iterator over the tokens of the record, see BlockChain.tokens."""
+
+        spans = self.spans
+
+        return chain.from_iterable(span_tokens(spans[span_pos], spans[span_pos + 1], spans[span_pos + 2], self.payload_views)
+                                   for span_pos in range(0, len(spans), 3))
+
+    def get(self, field, repetition=1, default=None):
+        """Returns the value of `field` (a field ref, e.g. DataField.field_id_bin), or of its `repetition`
+        for a repeating field. Sub nodes are built for the field only."""
+
+        if repetition == 1:
+            refs = (field, field + b'\x01')
+        else:
+            refs = (field + encode_vli(repetition),)
+
+        value = default
+
+        for (ref, ref_value) in self.build((field,) + refs).items():
+            if ref in refs and ref_value is not None:
+                value = ref_value
+
+        return value
+
+    def node(self):
+        """Decodes the whole record into an OrderedDict, as yielded by BlockChain.sub_nodes."""
+
+        return self.build()
+
+    def build(self, token_ids_to_return=None):
+        """Builds the node of the record with build_nodes, only of the fields `token_ids_to_return` if given.
+
+        The spans are put between a push and a pop of the record id, as they are in the block chain."""
+
+        spans = self.spans
+        push = bytes([0xC0 + len(self.record_id_bin)]) + self.record_id_bin
+
+        record_spans = chain(((push, 0, len(push), False),),
+                             ((spans[span_pos], spans[span_pos + 1], spans[span_pos + 2], False) for span_pos in range(0, len(spans), 3)),
+                             ((b'\xC0', 0, 1, False),))
+
+        for (record_id_bin, node) in build_nodes(record_spans, [], token_ids_to_return=token_ids_to_return,
+                                                 payload_views=self.payload_views):
+            return node
+
+        return OrderedDict()
+
+    def __iter__(self):
+        return iter(self.node().items())
+
+    @staticmethod
+    def scan(block_chain, search_path=(b'\x05',), first_record_id=None, payload_views=False, scan_order='chain',
+             last_record_id=None):
+        """A generator that yields a RecordView for every child node of `search_path` (the records by default),
+        starting at the record `first_record_id` or the one following it and ending with the record
+        `last_record_id` or the one before it, no blocks after it are read.
+
+        The blocks are only split at path tokens, field tokens are skipped by their length."""
+
+        search_path = list(search_path)
+
+        first_record_id_bin = encode_vli(first_record_id) if first_record_id is not None else b''
+        last_record_id_bin = encode_vli(last_record_id) if last_record_id is not None else None
+
+        fp5file = block_chain.fp5file
+        directory = fp5file.directory
+
+        if first_record_id_bin:
+            start_order_pos = block_chain.node_order_pos(search_path, search_path + [first_record_id_bin])
+        else:
+            start_block_id = fp5file.find_first_block_id_for_path(search_path)
+            start_order_pos = block_chain.order_pos(start_block_id) if start_block_id is not None else None
+
+        if start_order_pos is None:
+            return
+
+        path = []
+
+        record_id_bin = None
+        spans = None
+
+        is_first_block = True
+
+        for (block_order_pos, block_id, block_pos, data) in block_chain.blocks(start_order_pos, scan_order):
+            if not is_first_block:
+                cursor = directory.skip_bytes[block_pos >> 10] - 1
+            else:
+                cursor = 0
+
+            (block_spans, search_path_left) = split_records(data, cursor, path, search_path, block_id)
+
+            for (span_record_id_bin, start, end, closed) in block_spans:
+                if spans is None:
+                    # a span at the start of the block continues a record opened before the scan started
+                    if start == cursor or span_record_id_bin < first_record_id_bin:
+                        continue
+
+                    if last_record_id_bin is not None and span_record_id_bin > last_record_id_bin:
+                        return
+
+                    record_id_bin = span_record_id_bin
+                    spans = []
+
+                spans += (data, start, end)
+
+                if closed:
+                    yield RecordView(record_id_bin, spans, payload_views)
+
+                    spans = None
+
+            if search_path_left:
+                return
+
+            is_first_block = False
+
+    def __repr__(self):
+        return "RecordView(%d)" % self.record_id
@@ -0,0 +1,203 @@
+import multiprocessing
+import struct
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# slots per ring and their size, a ring holds at most this many encoded records of its producer
+RING_SLOTS = 8
+RING_SLOT_SIZE = 0x100000
+
+# flags, the record count and the length of the record bytes of a slot
+RING_SLOT_HEADER = struct.Struct('<III')
+
+# the last record of the slot continues in the next one, only records larger than a slot are split
+BATCH_PARTIAL = 0x01
+# the last slot of a partition
+BATCH_END = 0x02
+# the producer failed, the slot holds no records
+BATCH_ERROR = 0x04
+
+# how long one side waits for a slot before it checks whether the other one is still alive
+RING_POLL_INTERVAL = 1.0
+
+
+class SharedRecordRing(object):
+    """A ring of slots in shared memory that carries encoded records from one producer process to one consumer.
+
+    The records of a slot are stored in columns: the header, the end offset of every record and the bytes of
+    all records one after the other. The consumer gets memoryviews into the slot, so nothing is pickled or
+    copied on its side. The producer waits while all slots are filled, which bounds the memory of the ring
+    and keeps the producer at the pace of the consumer.
+
+    The ring is created by the consumer and handed to the producer as an argument of its Process."""
+
+    def __init__(self, slot_count=RING_SLOTS, slot_size=RING_SLOT_SIZE):
+        super(SharedRecordRing, self).__init__()
+
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+
+        self.memory = shared_memory.SharedMemory(create=True, size=slot_count * slot_size)
+
+        self.free_slots = multiprocessing.Semaphore(slot_count)
+        self.filled_slots = multiprocessing.Semaphore(0)
+
+        # the next slot to write in the producer, the next one to read in the consumer
+        self.slot = 0
+
+        # the records of the producer that have not been written to a slot yet
+        self.records = []
+        self.records_length = 0
+
+    def put(self, record):
+        """Adds the bytes of `record` to the ring, the records are written once they fill a slot."""
+
+        if self.records and RING_SLOT_HEADER.size + 4 * (len(self.records) + 1) + self.records_length + len(record) > self.slot_size:
+            self.send()
+
+        self.records.append(record)
+        self.records_length += len(record)
+
+    def send(self, flags=0):
+        """Writes the records added with `put` to the next free slots, waiting while all are filled.
+
+        The last slot written is marked with `flags`, e.g. BATCH_END after the last record of a partition."""
+
+        records = self.records
+        record_pos = 0
+
+        capacity = self.slot_size - RING_SLOT_HEADER.size
+
+        while True:
+            # as many records as fit into the slot, a single record that does not is split
+            record_count = 0
+            records_length = 0
+
+            while record_pos + record_count < len(records) and \
+                    4 * (record_count + 1) + records_length + len(records[record_pos + record_count]) <= capacity:
+                records_length += len(records[record_pos + record_count])
+                record_count += 1
+
+            if record_pos + record_count == len(records):
+                slot_flags = flags
+                slot_records = records[record_pos:]
+            elif record_count > 0:
+                slot_flags = 0
+                slot_records = records[record_pos:record_pos + record_count]
+            else:
+                slot_flags = BATCH_PARTIAL
+                record = memoryview(records[record_pos])
+                slot_records = [record[:capacity - 4]]
+                records[record_pos] = record[capacity - 4:]
+                record_count = 1
+                records_length = capacity - 4
+
+            while not self.free_slots.acquire(timeout=RING_POLL_INTERVAL):
+                consumer = multiprocessing.parent_process()
+
+                if consumer is not None and not consumer.is_alive():
+                    raise Exception("consumer process exited")
+
+            buffer = self.memory.buf
+            slot_start = self.slot * self.slot_size
+            data_start = slot_start + RING_SLOT_HEADER.size + 4 * len(slot_records)
+
+            RING_SLOT_HEADER.pack_into(buffer, slot_start, slot_flags, len(slot_records), records_length)
+
+            offsets = buffer[slot_start + RING_SLOT_HEADER.size:data_start].cast('I')
+            record_end = 0
+
+            for (record_index, record) in enumerate(slot_records):
+                buffer[data_start + record_end:data_start + record_end + len(record)] = record
+                record_end += len(record)
+                offsets[record_index] = record_end
+
+            offsets.release()
+            del buffer
+
+            self.slot = (self.slot + 1) % self.slot_count
+            self.filled_slots.release()
+
+            if slot_flags & BATCH_PARTIAL:
+                continue
+
+            record_pos += record_count
+
+            if record_pos == len(records):
+                break
+
+        self.records = []
+        self.records_length = 0
+
+    def send_error(self):
+        self.records = []
+        self.records_length = 0
+
+        self.send(BATCH_ERROR)
+
+    def receive(self, producer):
+        """A generator that yields the records up to the end of the next partition the producer sends.
+
+        The records are memoryviews into the slots, each one is only valid until the next one is requested.
+        Returns early if the producer sent an error, raises an Exception if the `producer` process died."""
+
+        partial_record = None
+
+        while True:
+            while not self.filled_slots.acquire(timeout=RING_POLL_INTERVAL):
+                if not producer.is_alive():
+                    raise Exception("worker process %s exited with code %s" % (producer.name, producer.exitcode))
+
+            buffer = self.memory.buf
+            slot_start = self.slot * self.slot_size
+            (flags, record_count, records_length) = RING_SLOT_HEADER.unpack_from(buffer, slot_start)
+
+            data_start = slot_start + RING_SLOT_HEADER.size + 4 * record_count
+            offsets = buffer[slot_start + RING_SLOT_HEADER.size:data_start].cast('I')
+            record_start = 0
+
+            for record_index in range(record_count):
+                record_end = offsets[record_index]
+                record = buffer[data_start + record_start:data_start + record_end]
+                record_start = record_end
+
+                if flags & BATCH_PARTIAL and record_index == record_count - 1:
+                    # a record larger than a slot is joined from its parts
+                    if partial_record is None:
+                        partial_record = []
+
+                    partial_record.append(bytes(record))
+                elif partial_record is not None:
+                    partial_record.append(bytes(record))
+
+                    yield b''.join(partial_record)
+
+                    partial_record = None
+                else:
+                    yield record
+
+                record.release()
+
+            offsets.release()
+            del buffer
+
+            self.slot = (self.slot + 1) % self.slot_count
+            self.free_slots.release()
+
+            if flags & (BATCH_END | BATCH_ERROR):
+                return
+
+    def close(self):
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
+
+        # a record of an abandoned receive may still be referenced, the memory is freed once it is dropped
+        try:
+            self.memory.close()
+        except BufferError:
+            pass
@@ -0,0 +1,274 @@
+from binascii import hexlify, unhexlify
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import zlib
+from array import array
+
+from .blockchain import BlockChain
+from .blockdirectory import BlockDirectory
+from .datafield import DataField
+
+CACHE_MAGIC = b'FP5DUMP\x00CACHE\x00\x00\x02'
+CACHE_SUFFIX = '.fp5cache'
+
+
+class SidecarCache(object):
+    """Persists the block ordering, block directory and catalog of opened files in a shared cache directory.
+
+    A cache file holds a small json header followed by the raw arrays, which are memory-mapped and used
+    in place when the file is opened again. Entries are validated against the size, mtime and a checksum
+    of the first and last blocks of the fp5 file. When the directory grows beyond `size_limit` bytes the
+    least recently used entries are removed."""
+
+    def __init__(self, cache_dir, size_limit=1024 * 1024 * 1024):
+        super(SidecarCache, self).__init__()
+
+        self.logging = logging.getLogger('fp5dump.fp5file.sidecarcache')
+
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.size_limit = size_limit
+
+        self.mmap = None
+
+    def cache_path(self, filename):
+        key = hashlib.sha1(os.path.abspath(os.path.expanduser(filename)).encode()).hexdigest()
+
+        return os.path.join(self.cache_dir, key + CACHE_SUFFIX)
+
+    @staticmethod
+    def fingerprint(fp5file):
+        stat = os.stat(os.path.abspath(os.path.expanduser(fp5file.filename)))
+
+        checksum = zlib.crc32(fp5file.source.read(0, 0xC00))
+        checksum = zlib.crc32(fp5file.source.read(max(0, fp5file.file_size - 0x400), 0x400), checksum)
+
+        return {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "checksum": checksum,
+            "byteorder": sys.byteorder
+        }
+
+    def load(self, fp5file):
+        """Restores the block chains, directory, fields and records index of `fp5file`. Returns False on a miss."""
+
+        cache_path = self.cache_path(fp5file.filename)
+
+        try:
+            with open(cache_path, "rb") as file:
+                cache_mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+
+        arrays = {}
+        cache_view = None
+
+        try:
+            (magic, metadata_length) = struct.unpack_from("<16sQ", cache_mmap, 0)
+
+            if magic != CACHE_MAGIC:
+                raise ValueError("unexpected magic number")
+
+            metadata = json.loads(cache_mmap[24:24 + metadata_length].decode())
+
+            if metadata["fingerprint"] != self.fingerprint(fp5file):
+                self.logging.info("cache for \"%s\" is stale" % fp5file.basename)
+
+                cache_mmap.close()
+
+                return False
+
+            cache_view = memoryview(cache_mmap)
+
+            for (name, (offset, typecode, count)) in metadata["arrays"].items():
+                length = count * struct.calcsize(typecode)
+
+                if offset < 0 or count < 0 or offset + length > len(cache_mmap):
+                    raise ValueError("array %s exceeds the cache file" % name)
+
+                arrays[name] = cache_view[offset:offset + length].cast(typecode)
+
+                if len(arrays[name]) != count:
+                    raise ValueError("array %s has %d instead of %d items" % (name, len(arrays[name]), count))
+
+        except (ValueError, KeyError, TypeError, struct.error) as e:
+            self.logging.warning("ignoring unreadable cache file \"%s\": %s" % (cache_path, e))
+
+            # the mapping cannot be closed while views of it exist
+            for view in arrays.values():
+                view.release()
+
+            if cache_view is not None:
+                cache_view.release()
+
+            cache_mmap.close()
+
+            return False
+
+        fp5file.block_chain_levels = metadata["block_chain_levels"]
+        fp5file.largest_block_id = metadata["largest_block_id"]
+
+        fp5file.directory = BlockDirectory.from_columns(dict((field, arrays["directory." + field]) for field in BlockDirectory.fields))
+        fp5file.block_id_to_block_pos = arrays["block_id_to_block_pos"]
+
+        fp5file.block_chains = []
+
+        for (level, chain_info) in enumerate(metadata["block_chains"]):
+            block_chain = BlockChain(fp5file, level)
+            block_chain.length = chain_info["length"]
+            block_chain.first_block_pos = chain_info["first_block_pos"]
+            block_chain.order = arrays["order.%d" % level]
+            block_chain.block_id_to_order_pos = arrays["block_id_to_order_pos.%d" % level]
+
+            fp5file.block_chains.append(block_chain)
+
+        for (level, block_chain) in enumerate(fp5file.block_chains):
+            if level > 0:
+                block_chain.daughter_block_chain = fp5file.block_chains[level - 1]
+
+            if level < fp5file.block_chain_levels:
+                block_chain.parent_block_chain = fp5file.block_chains[level + 1]
+
+        fp5file.index = fp5file.block_chains[fp5file.block_chain_levels]
+        fp5file.data = fp5file.block_chains[0]
+
+        fp5file.fields = {}
+
+        for field_info in metadata["fields"]:
+            field = DataField(field_info["field_id"], unhexlify(field_info["field_id_bin"]), unhexlify(field_info["name"]))
+            field.label_bytes = unhexlify(field_info["label_bytes"])
+            field.label = field.label_bytes.decode(fp5file.encoding)
+            field.type = field_info["type"]
+            field.order = unhexlify(field_info["order"]) if field_info["order"] is not None else None
+            field.repetitions = field_info["repetitions"]
+            field.stored = field_info["stored"]
+            field.indexed = field_info["indexed"]
+
+            fp5file.fields[field.field_id_bin] = field
+
+        fp5file.records_index = arrays["records_index"].tolist()
+        fp5file.records_count = len(fp5file.records_index)
+
+        self.mmap = cache_mmap
+
+        # mark as recently used for the eviction
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+
+        self.logging.info("loaded \"%s\" from cache" % fp5file.basename)
+
+        return True
+
+    def store(self, fp5file):
+        arrays = [("block_id_to_block_pos", fp5file.block_id_to_block_pos)]
+        arrays += [("directory." + field, getattr(fp5file.directory, field)) for field in BlockDirectory.fields]
+        arrays += [("order.%d" % block_chain.level, block_chain.order) for block_chain in fp5file.block_chains]
+        arrays += [("block_id_to_order_pos.%d" % block_chain.level, block_chain.block_id_to_order_pos)
+                   for block_chain in fp5file.block_chains]
+        arrays += [("records_index", array('Q', fp5file.records_index))]
+
+        metadata = {
+            "fingerprint": self.fingerprint(fp5file),
+            "block_chain_levels": fp5file.block_chain_levels,
+            "largest_block_id": fp5file.largest_block_id,
+            "block_chains": [{"length": block_chain.length, "first_block_pos": block_chain.first_block_pos}
+                             for block_chain in fp5file.block_chains],
+            "fields": [{"field_id": field.field_id,
+                        "field_id_bin": hexlify(field.field_id_bin).decode(),
+                        "name": hexlify(field.name).decode(),
+                        "label_bytes": hexlify(field.label_bytes).decode(),
+                        "type": field.type,
+                        "order": hexlify(field.order).decode() if field.order is not None else None,
+                        "repetitions": field.repetitions,
+                        "stored": field.stored,
+                        "indexed": field.indexed} for field in fp5file.fields.values()],
+            "arrays": {}
+        }
+
+        # the array offsets depend on the length of the metadata, so reserve space for them first
+        data_offset = 24 + len(json.dumps(metadata)) + 64 * (len(arrays) + 1)
+        offset = data_offset
+
+        for (name, values) in arrays:
+            offset = (offset + 7) & ~7
+            metadata["arrays"][name] = [offset, values.typecode if type(values) is array else values.format, len(values)]
+            offset += len(values) * values.itemsize
+
+        metadata_bytes = json.dumps(metadata).encode()
+
+        if 24 + len(metadata_bytes) > data_offset:
+            raise Exception("cache metadata exceeds reserved space")
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+            (fd, temp_path) = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+
+            with os.fdopen(fd, "wb") as file:
+                file.write(struct.pack("<16sQ", CACHE_MAGIC, len(metadata_bytes)))
+                file.write(metadata_bytes)
+
+                for (name, values) in arrays:
+                    file.seek(metadata["arrays"][name][0])
+                    file.write(memoryview(values).cast('B'))
+
+            os.replace(temp_path, self.cache_path(fp5file.filename))
+        except OSError as e:
+            self.logging.warning("could not write cache file for \"%s\": %s" % (fp5file.basename, e))
+
+            return False
+
+        self.logging.info("stored \"%s\" in cache" % fp5file.basename)
+
+        self.evict()
+
+        return True
+
+    def evict(self):
+        """Removes the least recently used cache files until the cache directory fits into `size_limit`."""
+
+        entries = []
+
+        for entry_name in os.listdir(self.cache_dir):
+            if entry_name.endswith(CACHE_SUFFIX):
+                entry_path = os.path.join(self.cache_dir, entry_name)
+
+                try:
+                    stat = os.stat(entry_path)
+                except OSError:
+                    continue
+
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+
+        total_size = sum(size for (mtime, size, entry_path) in entries)
+
+        # never remove the most recently used entry
+        for (mtime, size, entry_path) in sorted(entries)[:-1]:
+            if total_size <= self.size_limit:
+                break
+
+            try:
+                os.remove(entry_path)
+                total_size -= size
+
+                self.logging.debug("evicted cache file \"%s\"" % entry_path)
+            except OSError:
+                pass
+
+    def close(self):
+        if self.mmap:
+            try:
+                self.mmap.close()
+            except BufferError:
+                # arrays handed out by load() are still alive, the mapping is freed with them
+                pass
+
+            self.mmap = None
@@ -28,6 +28,10 @@ setup(
         'PyYAML >= 3.11',
         'parsedatetime >= 1.4'
     ],
+    extras_require={
+        'numpy': ['numpy >= 1.9'],
+        'zstd': ['pyzstd >= 0.15.4']
+    },
     entry_points='''
         [console_scripts]
         fp5dump=fp5dump.fp5dump:main
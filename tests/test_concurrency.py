@@ -0,0 +1,87 @@
+"""Reads one FP5File from several threads at once and compares the results with a serial read.
+
+The block sources read with pread or from an mmap, so threads share no seek position. Run with
+
+    python -m unittest discover -s tests
+
+`FP5DUMP_TEST_FILE` names another fp5 file to read instead of the bundled data/sample.fp5."""
+
+import os
+import random
+import sys
+import threading
+import unittest
+
+from fp5dump.fp5file.fp5file import FP5File
+
+TEST_FILE = os.environ.get('FP5DUMP_TEST_FILE', os.path.join(os.path.dirname(__file__), 'data', 'sample.fp5'))
+
+THREAD_COUNT = 8
+PASSES = 3
+
+
+class ConcurrentReadTest(unittest.TestCase):
+    def setUp(self):
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+
+    def read_serial(self, fp5file):
+        data = fp5file.data
+
+        blocks = [data.read_block(order_pos) for order_pos in range(data.length)]
+        records = [(ref, dict(node)) for (ref, node) in data.sub_nodes(b'\x05')]
+
+        return (blocks, records)
+
+    def read_concurrently(self, fp5file, blocks, records):
+        data = fp5file.data
+        errors = []
+        start = threading.Barrier(THREAD_COUNT)
+
+        def worker(seed):
+            order_positions = list(range(data.length))
+            random.Random(seed).shuffle(order_positions)
+
+            try:
+                start.wait()
+
+                for _ in range(PASSES):
+                    for order_pos in order_positions:
+                        if data.read_block(order_pos) != blocks[order_pos]:
+                            errors.append("thread %d read a different block at %d" % (seed, order_pos))
+
+                    if [(ref, dict(node)) for (ref, node) in data.sub_nodes(b'\x05')] != records:
+                        errors.append("thread %d read different records" % seed)
+            except Exception as error:
+                errors.append("thread %d raised %r" % (seed, error))
+
+        threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(THREAD_COUNT)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+    def check_source(self, use_mmap):
+        with FP5File(TEST_FILE, use_mmap=use_mmap, use_block_cache=False) as fp5file:
+            (blocks, records) = self.read_serial(fp5file)
+
+            self.assertTrue(records)
+
+            self.read_concurrently(fp5file, blocks, records)
+
+    def test_mmap_source(self):
+        self.check_source(use_mmap=True)
+
+    def test_file_source(self):
+        self.check_source(use_mmap=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
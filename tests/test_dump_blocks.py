@@ -0,0 +1,90 @@
+"""Dumps the data blocks of single paths of data/sample.fp5 and checks exactly which blocks are written."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from fp5dump.fp5file.blockchain import TOKEN_POP, TOKEN_PUSH, encode_vli, span_tokens
+from fp5dump.fp5file.fp5file import FP5File
+
+SAMPLE_FILE = os.path.join(os.path.dirname(__file__), 'data', 'sample.fp5')
+
+
+class DumpBlocksWithPathTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fp5file = FP5File(SAMPLE_FILE, use_block_cache=False)
+
+    def tearDown(self):
+        self.fp5file.close()
+
+        shutil.rmtree(self.directory)
+
+    def dump(self, search_path):
+        filename = os.path.join(self.directory, 'blocks.data')
+
+        self.assertTrue(self.fp5file.dump_blocks_with_path(search_path, filename))
+
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def blocks(self, order_positions):
+        data = self.fp5file.data
+
+        return b''.join(self.fp5file.source.read(self.fp5file.block_id_to_block_pos[data.order[order_pos]], 0x400)
+                        for order_pos in order_positions)
+
+    def order_positions_with_path(self, search_path):
+        """Returns the positions of the blocks in which `search_path` is open, found by walking the whole chain."""
+
+        data = self.fp5file.data
+        directory = self.fp5file.directory
+
+        path = []
+        order_positions = []
+
+        for (order_pos, block_id, block_pos, block_data) in data.blocks(0):
+            cursor = directory.skip_bytes[block_pos >> 10] - 1 if order_pos > 0 else 0
+            path_found = path[:len(search_path)] == search_path
+
+            for (token_kind, ref, payload) in span_tokens(block_data, cursor, len(block_data)):
+                if token_kind == TOKEN_PUSH:
+                    path.append(ref)
+                elif token_kind == TOKEN_POP and path:
+                    path.pop()
+
+                path_found = path_found or path[:len(search_path)] == search_path
+
+            if path_found:
+                order_positions.append(order_pos)
+
+        return order_positions
+
+    def assert_blocks(self, search_path, order_positions):
+        self.assertEqual(list(self.fp5file.block_range_for_path(search_path)), order_positions)
+        self.assertEqual(self.dump(search_path), self.blocks(order_positions))
+
+    def test_record_path(self):
+        # record 1365 starts in the third block of the chain and ends in the fifth
+        search_path = [b'\x05', encode_vli(1365)]
+
+        self.assertEqual(self.order_positions_with_path(search_path), [2, 3, 4])
+        self.assert_blocks(search_path, [2, 3, 4])
+
+    def test_missing_record_path(self):
+        # no record has this id, the block it would be stored in is written
+        self.assertEqual(self.order_positions_with_path([b'\x05', b'\x7E\x46']), [])
+        self.assert_blocks([b'\x05', b'\x7E\x46'], [0])
+
+    def test_meta_path(self):
+        self.assertEqual(self.order_positions_with_path([b'\x0D']), [191, 192, 193])
+        self.assert_blocks([b'\x0D'], [191, 192, 193])
+
+    def test_records_path(self):
+        self.assertEqual(self.order_positions_with_path([b'\x05']), list(range(0, 192)))
+        self.assert_blocks([b'\x05'], list(range(0, 192)))
+
+
+if __name__ == '__main__':
+    unittest.main()
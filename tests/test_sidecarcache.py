@@ -0,0 +1,66 @@
+"""Opens an fp5 file with a damaged sidecar cache, which has to be ignored in favor of a cold load.
+
+See test_concurrency for `FP5DUMP_TEST_FILE`."""
+
+import glob
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from fp5dump.fp5file.fp5file import FP5File
+from fp5dump.fp5file.sidecarcache import CACHE_MAGIC
+
+TEST_FILE = os.environ.get('FP5DUMP_TEST_FILE', os.path.join(os.path.dirname(__file__), 'data', 'sample.fp5'))
+
+
+class SidecarCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+        with FP5File(TEST_FILE) as fp5file:
+            self.expected = self.summary(fp5file)
+
+        # the first open stores the cache
+        with FP5File(TEST_FILE, cache_dir=self.cache_dir) as fp5file:
+            self.assertIsNone(fp5file.cache.mmap)
+
+        (self.cache_path,) = glob.glob(os.path.join(self.cache_dir, '*'))
+
+        with open(self.cache_path, 'rb') as f:
+            self.cache_bytes = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    @staticmethod
+    def summary(fp5file):
+        return (fp5file.records_index, [list(block_chain.order) for block_chain in fp5file.block_chains],
+                sorted(fp5file.fields.keys()))
+
+    def open_with_cache(self, cache_bytes):
+        with open(self.cache_path, 'wb') as f:
+            f.write(cache_bytes)
+
+        with FP5File(TEST_FILE, cache_dir=self.cache_dir) as fp5file:
+            self.assertEqual(self.summary(fp5file), self.expected)
+
+            return fp5file.cache.mmap is not None
+
+    def test_valid_cache(self):
+        self.assertTrue(self.open_with_cache(self.cache_bytes))
+
+    def test_truncated_cache(self):
+        self.assertFalse(self.open_with_cache(self.cache_bytes[:-3]))
+        self.assertFalse(self.open_with_cache(self.cache_bytes[:len(self.cache_bytes) // 2]))
+
+    def test_garbage_cache(self):
+        garbage = bytes(random.Random(0).getrandbits(8) for _ in range(len(self.cache_bytes)))
+
+        self.assertFalse(self.open_with_cache(garbage))
+        self.assertFalse(self.open_with_cache(CACHE_MAGIC + garbage[len(CACHE_MAGIC):]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""Dumps the records of one fp5 file with a single and with several processes and compares the output.
+
+The locale and encoding set by an export definition have to reach the worker processes, which open the file
+again. See test_concurrency for `FP5DUMP_TEST_FILE`."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from fp5dump.fp5file.fp5file import FP5File
+
+TEST_FILE = os.environ.get('FP5DUMP_TEST_FILE', os.path.join(os.path.dirname(__file__), 'data', 'sample.fp5'))
+
+# a locale and an encoding which differ from the defaults of FP5File, latin1 and the locale of the environment
+EXPORT_DEFINITION = """\
+name: sample_export
+locale: C
+encoding: mac_roman
+columns:
+  NAME: text
+  AMOUNT: numeric
+  WHEN: date
+  TAGS: text[]
+  NOTES: text
+"""
+
+
+# load_export_definition resets the locale to the default of the environment, which therefore has to exist
+@mock.patch.dict(os.environ, LC_ALL='C')
+class WorkerExportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.definition = os.path.join(self.directory, 'definition.yaml')
+
+        with open(self.definition, 'w') as f:
+            f.write(EXPORT_DEFINITION)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def dump(self, jobs):
+        filename = os.path.join(self.directory, 'records-%d.psql' % jobs)
+
+        with FP5File(TEST_FILE) as fp5file:
+            fields_to_dump = fp5file.load_export_definition(self.definition)
+
+            self.assertIsNotNone(fields_to_dump)
+
+            fp5file.dump_records_pgsql(fields_to_dump, filename=filename, jobs=jobs)
+
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def test_jobs_give_same_output(self):
+        single = self.dump(jobs=1)
+
+        self.assertIn(b'INSERT INTO "sample_export"', single)
+        self.assertIn(b'\xe4'.decode('mac_roman').encode(), single)
+
+        self.assertEqual(self.dump(jobs=3), single)
+
+
+if __name__ == '__main__':
+    unittest.main()